@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of the routing cost per update.
+
+Compares the compiled router with the previous per-update regular expressions on a mix
+of commands, callback data and plain text messages.
+
+Usage:
+    python benchmarks/bench_router.py [-n NUMBER]
+"""
+
+import os
+import re
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bot.core.router import Router
+
+
+def _module(hook, prefix, subcommands):
+    return type(prefix, (), {"hook": hook, "_subcommands": dict.fromkeys([None, *subcommands])})
+
+
+MODULES = [
+    _module("/start", "start", []),
+    _module("/weathersg", "weather", ["help", "rainmap", "forecast2h", "forecast24h", "forecast4d"]),
+    _module("/shortcuts", "shortcuts", ["show", "modify", "help", "run"]),
+    _module("/scshow", "shortcuts", ["show", "modify", "help", "run"]),
+    _module("/catgpt", "catgpt", ["settings", "chat", "help"]),
+]
+
+UPDATES = [
+    "/start",
+    "/start@intelligram_bot",
+    "/weathersg forecast2h bishan",
+    "/weathersg forecast24h north",
+    "/shortcuts modify add 'rain' '/weathersg rainmap'",
+    "/catgpt chat ai 1 what is the weather like today?",
+    "hello there",
+    "bishan",
+    "",
+]
+
+
+def legacy_route(text, modules):
+    """Routing as done before the compiled router"""
+
+    if text == '' or re.match("/.*[@[a-zA-Z]*]?", text) == None:
+        return None
+
+    text = re.sub("[@[a-zA-Z]*]", '', text)
+    text = text.strip()
+
+    module = re.search("/\\S*", text)
+    module = module.group(0) if module != None else None
+    return modules.get(module), text.split(" ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--number", type=int, default=20000, help="iterations over the update mix")
+    opts = parser.parse_args()
+
+    modules = {m.hook: m for m in MODULES}
+    router = Router(MODULES, "intelligram_bot")
+
+    def run_legacy():
+        for text in UPDATES:
+            legacy_route(text, modules)
+
+    def run_router():
+        for text in UPDATES:
+            if router.is_command(text):
+                router.match(text)
+
+    for name, func in (("legacy", run_legacy), ("router", run_router)):
+        best = min(timeit.repeat(func, number=opts.number, repeat=5))
+        print(f"{name:<8} {best / (opts.number * len(UPDATES)) * 1e6:8.3f} us/update")
+
+
+if __name__ == "__main__":
+    main()
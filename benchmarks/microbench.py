@@ -0,0 +1,533 @@
+"""
+Micro-benchmarks of the per-update hot paths, with regression check against a baseline.
+
+Every benchmark reports the median time per operation of several timeit runs, each run
+following a run of a fixed calibration workload. The ratios of benchmark to calibration
+time are compared with benchmarks/baseline.json and the script exits with status 1 if a
+benchmark is slower than its baseline by more than the tolerance plus the noise (spread
+of the ratios) of the run. The ratios are only comparable on the machine and python the
+baseline was recorded on, record it again with --save after changing either or after an
+intended change of performance.
+
+Fixtures (update payloads, forecasts, rain area images) come from the local stand-ins of
+tools/stubs, the database is a temporary sqlite file.
+
+Usage:
+    python benchmarks/microbench.py [-k SUBSTRING|GLOB] [--tolerance 0.25] [--memory] [--save]
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import random
+import fnmatch
+import argparse
+import platform
+import tempfile
+import logging
+import statistics
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+# templates are loaded relative to the working directory
+os.chdir(ROOT)
+os.environ.setdefault("BOT_CONFIG_DIR", tempfile.mkdtemp(prefix="microbench-"))
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+# name -> setup function returning the callable to time
+BENCHMARKS = {}
+
+
+def benchmark(name: str, **params):
+    """Register a setup function, stack the decorator to register it with several params"""
+
+    def decorator(func):
+        BENCHMARKS[name] = lambda: func(**params)
+        return func
+
+    return decorator
+
+
+def run(coro):
+    """Run a coroutine that never suspends, without the overhead of an event loop"""
+
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+
+    coro.close()
+    raise RuntimeError("coroutine suspended")
+
+
+def _message(text: str, chat_id: int = 1) -> dict:
+    from tools.loadtest import message
+    return message(chat_id, text)
+
+
+def _callback_query(data: str, chat_id: int = 1) -> dict:
+    from tools.loadtest import callback_query
+    return callback_query(chat_id, data)
+
+
+def _stub_json(path: str) -> dict:
+    from tools.stubs import gov_sg
+
+    gov_sg.CONFIG.update(latency=0, jitter=0)
+    return gov_sg.flask.test_client().get(path).get_json()
+
+
+def _module(cls, text: str, tg_obj=None):
+    from telegrambots.wrapper.serializations import deserialize
+    from telegrambots.wrapper.types.objects import Message
+    from bot.core.objects import UserSession, CollectingClient
+
+    if tg_obj == None:
+        tg_obj = deserialize(Message, _message(text)["message"])
+
+    return cls(*text.split(" "), text=text, tg_obj=tg_obj, session=UserSession(1, 1), client=CollectingClient())
+
+
+# Updates
+
+def _update(kind: str) -> dict:
+    from tools.loadtest import message
+
+    return {
+        "message": lambda: _message("/weathersg forecast2h bishan"),
+        "callback_query": lambda: _callback_query("/weathersg forecast24h north"),
+        "location": lambda: message(1, location=(1.35, 103.84)),
+    }[kind]()
+
+
+@benchmark("deserialize.message", kind="message")
+@benchmark("deserialize.callback_query", kind="callback_query")
+@benchmark("deserialize.location", kind="location")
+def bench_deserialize(kind):
+    from telegrambots.wrapper.serializations import deserialize
+    from telegrambots.wrapper.types.objects import Update
+
+    payload = _update(kind)
+    return lambda: deserialize(Update, payload)
+
+
+@benchmark("lazy_update.message", kind="message")
+@benchmark("lazy_update.callback_query", kind="callback_query")
+@benchmark("lazy_update.location", kind="location")
+def bench_lazy_update(kind):
+    from telegrambots.wrapper.types.objects import CallbackQuery
+    from bot.core.objects import LazyUpdate
+
+    payload = _update(kind)
+
+    # fields read by the handler before dispatch
+    def parse():
+        tg_obj = LazyUpdate(payload).actual_update
+
+        if isinstance(tg_obj, CallbackQuery):
+            return tg_obj.message.chat.id, tg_obj.message.message_id, tg_obj.from_user.id, tg_obj.data
+
+        return tg_obj.chat.id, tg_obj.from_user.id, tg_obj.text
+
+    return parse
+
+
+@benchmark("router.match")
+def bench_router():
+    from bot.core.router import Router
+    from bot.modules import StartModule, WeatherModule, ShortcutsModule, ScShow, CatGPTModule
+
+    router = Router([StartModule, WeatherModule, ShortcutsModule, ScShow, CatGPTModule], "intelligram_bot")
+    texts = [
+        "/start", "/start@intelligram_bot", "/weathersg forecast2h bishan", "/weathersg forecast24h north",
+        "/shortcuts modify add 'rain' '/weathersg rainmap'", "/catgpt chat ai 1 hello", "hello there", "bishan",
+    ]
+
+    def route():
+        for text in texts:
+            if router.is_command(text):
+                router.match(text)
+
+    return route
+
+
+@benchmark("session.get")
+def bench_session_get():
+    from bot.core.objects import UserSession
+
+    session = UserSession(1, 1)
+    session.update_state(["/weathersg", "forecast2h"], True)
+
+    return session.get_state
+
+
+@benchmark("session.update")
+def bench_session_update():
+    from bot.core.objects import UserSession
+
+    session = UserSession(1, 1)
+    return lambda: session.update_state(["/weathersg", "forecast2h"], True)
+
+
+# Templates
+
+@benchmark("template.start", path="start/templates/start.html")
+@benchmark("template.weather_help", path="weather/templates/help.html")
+@benchmark("template.forecast2h", path="weather/templates/forecast2h.html")
+@benchmark("template.forecast24h", path="weather/templates/forecast24h.html")
+@benchmark("template.forecast4d", path="weather/templates/forecast4d.html")
+@benchmark("template.shortcuts_help", path="shortcuts/templates/help.html")
+@benchmark("template.shortcuts_modify", path="shortcuts/templates/modify.html")
+@benchmark("template.catgpt_help", path="catgpt/templates/help.html")
+@benchmark("template.catgpt_settings", path="catgpt/templates/settings.html")
+def bench_template(path):
+    from bot.helper.templates import render_response_template
+    from bot.modules import ALL_MODULES
+
+    forecast_2h = _stub_json("/v1/environment/2-hour-weather-forecast")
+
+    context = {
+        "start/templates/start.html": lambda: {"MODULES": {m.hook: m for m in ALL_MODULES}},
+        "weather/templates/forecast2h.html": lambda: {
+            "title": "2 Hour Nowcast",
+            "update_timestamp": forecast_2h["items"][0]["update_timestamp"],
+            "forecasts": forecast_2h["items"][0]["forecasts"][:5],
+        },
+        "weather/templates/forecast24h.html": lambda: {
+            "title": "24 Hour Forecast (north)",
+            "weather_api": _stub_json("/v1/environment/24-hour-weather-forecast")["items"][0],
+            "region": "north",
+        },
+        "weather/templates/forecast4d.html": lambda: {
+            "title": "4 Day Outlook",
+            "weather_api": _stub_json("/v1/environment/4-day-weather-forecast")["items"][0],
+        },
+        "shortcuts/templates/modify.html": lambda: {},
+        "catgpt/templates/settings.html": lambda: {"yaml_str": "model: cat\ntemperature: 1.0\n"},
+    }.get(path, lambda: {"hook": "/" + path.split("/")[0]})()
+
+    return lambda: render_response_template(path, **context)
+
+
+# Responses
+
+@benchmark("response.text_send")
+@benchmark("response.text_edit", message_id=1)
+def bench_text_response(message_id=None):
+    from telegrambots.wrapper.types.objects import InlineKeyboardMarkup, InlineKeyboardButton
+    from bot.modules.weather.weather import WeatherModule
+
+    module = _module(WeatherModule, "/weathersg forecast4d")
+    module.session.message_id = message_id
+
+    def response():
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("Refresh", callback_data="/weathersg forecast4d")]])
+        return run(module._text_response("4 Day Outlook\n" * 20, markup))
+
+    return response
+
+
+@benchmark("weather.closest_areas")
+def bench_closest_areas():
+    from bot.modules.weather.weather import _closest_areas
+
+    # all the areas of the real api
+    rng = random.Random(0)
+    area_list = [
+        {"name": f"area {i}", "label_location": {"latitude": 1.2 + rng.random() * 0.25, "longitude": 103.6 + rng.random() * 0.4}}
+        for i in range(47)
+    ]
+
+    return lambda: _closest_areas(area_list, 1.35, 103.84)
+
+
+@benchmark("weather.rainmap_compose")
+def bench_rainmap_compose():
+    import io
+    from PIL import Image
+    from tools.stubs.gov_sg import _png
+    from bot.modules.weather.api.gov_sg import _rainmap_compose
+
+    # decoded once, as the static images are cached
+    static_images = tuple(Image.open(io.BytesIO(_png((853, 479), color, seed))).convert("RGBA")
+                          for color, seed in (((230, 230, 230, 255), 1), ((0, 0, 0, 0), 2)))
+    overlay = _png((853, 479), (0, 0, 0, 0), 3)
+
+    return lambda: _rainmap_compose(static_images, Image.open(io.BytesIO(overlay)))
+
+
+# Logging
+
+@benchmark("logging.filtered_debug")
+@benchmark("logging.filtered_debug_fstring", fstring=True)
+def bench_logging_filtered(fstring=False):
+    logger = logging.getLogger("microbench.filtered")
+    logger.setLevel(logging.INFO)
+    text, user_id, chat_id = "/weathersg forecast2h bishan", 1, 1
+
+    if fstring:
+        return lambda: logger.debug(f"Content: '{text}', user:{user_id}, chat:{chat_id}")
+
+    return lambda: logger.debug("Content: '%s', user:%s, chat:%s", text, user_id, chat_id)
+
+
+@benchmark("logging.sync[1x100]", threads=1)
+@benchmark("logging.sync[8x100]", threads=8)
+@benchmark("logging.queued[1x100]", threads=1, queued=True)
+@benchmark("logging.queued[8x100]", threads=8, queued=True)
+def bench_logging(threads, queued=False):
+    import queue
+    import logging.handlers
+    import concurrent.futures
+    from bot.core import logs
+
+    handler = logging.StreamHandler(tempfile.TemporaryFile("w"))
+    handler.setFormatter(logging.Formatter(logs.FORMAT))
+
+    logger = logging.getLogger(f"microbench.{'queued' if queued else 'sync'}{threads}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    q = queue.Queue()
+
+    if queued:
+        logger.addHandler(logs.NonBlockingQueueHandler(q))
+        logging.handlers.QueueListener(q, handler).start()
+    else:
+        logger.addHandler(handler)
+
+    executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def log_records(_):
+        for i in range(100):
+            logger.info("Processing Message from user:%s, chat:%s", i, i)
+
+    # time of the threads logging, the queue is written in the background
+    def log():
+        start = time.perf_counter()
+        list(executor.map(log_records, range(threads)))
+        elapsed = time.perf_counter() - start
+
+        q.join()
+        return elapsed
+
+    log.self_timed = True
+    return log
+
+
+# Shortcuts
+
+def _shortcuts(n: int):
+    from bot.modules.shortcuts.shortcuts import ShortcutsModule
+
+    user_id = 1000 + n
+    module = _module(ShortcutsModule, "/shortcuts show")
+    module.session.user_id = user_id
+
+    if run(module._db_get()) == []:
+        run(module._db_add(*((f"cmd {i}", f"/weathersg forecast2h area {i}") for i in range(n))))
+
+    return module
+
+
+@benchmark("shortcuts.get[10]", n=10)
+@benchmark("shortcuts.get[100]", n=100)
+@benchmark("shortcuts.get[1000]", n=1000)
+def bench_shortcuts_get(n):
+    module = _shortcuts(n)
+    return lambda: run(module._db_get())
+
+
+@benchmark("shortcuts.print_list[10]", n=10)
+@benchmark("shortcuts.print_list[100]", n=100)
+@benchmark("shortcuts.print_list[1000]", n=1000)
+def bench_shortcuts_print_list(n):
+    module = _shortcuts(n)
+    return lambda: run(module._print_command_list())
+
+
+@benchmark("shortcuts.show[10]", n=10)
+@benchmark("shortcuts.show[100]", n=100)
+@benchmark("shortcuts.show[1000]", n=1000)
+def bench_shortcuts_show(n):
+    module = _shortcuts(n)
+    module.args = ("/shortcuts", "show")
+    return lambda: run(module._shortcuts_show_response())
+
+
+@benchmark("shortcuts.add_delete[10]", n=10)
+@benchmark("shortcuts.add_delete[100]", n=100)
+@benchmark("shortcuts.add_delete[1000]", n=1000)
+def bench_shortcuts_add_delete(n):
+    module = _shortcuts(n)
+
+    def add_delete():
+        run(module._db_add(("new", "/start")))
+        run(module._db_delete([n]))
+
+    return add_delete
+
+
+def calibrate():
+    """Fixed pure Python workload, the unit the benchmarks are compared in"""
+
+    ranks = {str(i): i * 7919 % 200 for i in range(200)}
+    sorted(ranks.items(), key=lambda item: item[1])
+
+
+def measure(func, repeat: int) -> tuple[float, float, float]:
+    """
+    Returns the median time per call (s), the median ratio to the calibration workload and
+    the relative spread (interquartile range) of that ratio, over repeat runs of about 0.05s.
+    Each run follows a run of the calibration, so the ratio cancels out the load and clock
+    changes of the machine that make absolute times drift. Benchmarks with a self_timed
+    attribute return their own time, e.g. to exclude background work
+    """
+
+    timer = timeit.Timer(func)
+    number = max(1, timer.autorange()[0] // 4)
+    calibration = timeit.Timer(calibrate)
+    calibration_number = max(1, calibration.autorange()[0] // 4)
+    times, ratios = [], []
+
+    for _ in range(repeat):
+        unit = calibration.timeit(calibration_number) / calibration_number
+
+        if getattr(func, "self_timed", False):
+            took = sum(func() for _ in range(number)) / number
+        else:
+            took = timer.timeit(number) / number
+
+        times.append(took)
+        ratios.append(took / unit)
+
+    ratio = statistics.median(ratios)
+
+    if repeat < 2:
+        return statistics.median(times), ratio, 0
+
+    quartiles = statistics.quantiles(ratios, n=4)
+    return statistics.median(times), ratio, (quartiles[2] - quartiles[0]) / ratio
+
+
+def measure_memory(func) -> int:
+    """Returns the peak memory allocated during a call (bytes)"""
+
+    func()
+    tracemalloc.start()
+
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+
+    return f"{seconds * 1e6:.2f}us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", "--filter", default="", help="substring, or glob if it has *?[, of the benchmarks to run")
+    parser.add_argument("-r", "--repeat", type=int, default=9, help="timeit runs per benchmark")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before a regression, 0.25 = 25%%")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--save", action="store_true", help="record the results as the baseline")
+    parser.add_argument("--memory", action="store_true", help="also report the peak memory allocated per call")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks")
+    opts = parser.parse_args()
+
+    if any(c in opts.filter for c in "*?["):
+        names = sorted(name for name in BENCHMARKS if fnmatch.fnmatch(name, opts.filter))
+    else:
+        names = sorted(name for name in BENCHMARKS if opts.filter in name)
+
+    if opts.list:
+        print("\n".join(names))
+        return
+
+    if names == []:
+        parser.error(f"no benchmark matches {opts.filter}")
+
+    import bot.core.database as db
+
+    logging.basicConfig(level=logging.WARNING)
+    db.setup(os.path.join(os.environ["BOT_CONFIG_DIR"], "microbench.db"))
+
+    baseline = {"results": {}, "ratios": {}}
+
+    if os.path.isfile(opts.baseline):
+        with open(opts.baseline) as f:
+            baseline = {**baseline, **json.load(f)}
+
+        recorded_on = (baseline.get("machine"), baseline.get("python"))
+
+        if recorded_on != (platform.machine(), platform.python_version()):
+            print(
+                f"warning: baseline recorded on {recorded_on[0]} / python {recorded_on[1]}, running on "
+                f"{platform.machine()} / python {platform.python_version()}, changes may not be comparable\n",
+                file=sys.stderr,
+            )
+
+    results = {}
+    ratios = {}
+    regressions = []
+
+    print(f"{'benchmark':<32}{'time/op':>12}" + (f"{'mem/op':>10}" if opts.memory else "") + f"{'baseline':>12}{'change':>9}{'noise':>8}")
+
+    for name in names:
+        func = BENCHMARKS[name]()
+        results[name], ratios[name], noise = measure(func, opts.repeat)
+        before = baseline["ratios"].get(name)
+        line = f"{name:<32}{_format_time(results[name]):>12}"
+
+        if opts.memory:
+            line += f"{measure_memory(func) / 1024:>8.1f}KB"
+
+        if before == None:
+            print(f"{line}{'-':>12}")
+            continue
+
+        # compared in units of the calibration workload, only beyond the noise of this run
+        change = ratios[name] / before - 1
+        flag = ""
+
+        if change > opts.tolerance + noise:
+            regressions.append(name)
+            flag = "  REGRESSION"
+
+        print(f"{line}{_format_time(baseline['results'][name]):>12}{change:>+8.0%}{noise:>7.0%}{flag}")
+
+    if opts.save:
+        # keep the results of the benchmarks that were not run
+        with open(opts.baseline, "w") as f:
+            json.dump({
+                "machine": platform.machine(),
+                "python": platform.python_version(),
+                "recorded": time.strftime("%Y-%m-%d"),
+                "calibration": measure(calibrate, opts.repeat)[0],
+                "results": dict(sorted({**baseline["results"], **results}.items())),
+                "ratios": dict(sorted({**baseline["ratios"], **ratios}.items())),
+            }, f, indent=2)
+            f.write("\n")
+
+        print(f"\nbaseline saved to {os.path.relpath(opts.baseline)}")
+        return
+
+    if regressions != []:
+        print(f"\n{len(regressions)} regression(s) over {opts.tolerance:.0%} plus noise: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Startup time and memory budget check.
+
+Imports main.py in a fresh interpreter, as done when the bot starts, and reports the
+import time, the peak RSS and the heavy dependencies loaded at boot. Exits with status 1
+if the best run is over budget or a heavy dependency is loaded at boot.
+
+Usage:
+    python benchmarks/startup_budget.py [--runs N] [--max-time S] [--max-rss MB]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Dependencies of modules that should only be imported on first use. aiohttp and jinja2
+# are always loaded by telegrambots and flask
+HEAVY_DEPENDENCIES = ("PIL", "yaml", "dataclasses_json", "bot.helper.templates")
+
+_PROBE = """
+import sys, time, json, resource
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({"time": elapsed, "rss": rss, "heavy": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_DEPENDENCIES,)
+
+
+def probe(config_dir: str) -> dict:
+    env = dict(os.environ, BOT_TOKEN=os.getenv("BOT_TOKEN", "0:startup-budget"), BOT_CONFIG_DIR=config_dir)
+
+    out = subprocess.run(
+        [sys.executable, "-c", _PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="number of fresh interpreters")
+    parser.add_argument("--max-time", type=float, default=1.0, help="import time budget (s)")
+    parser.add_argument("--max-rss", type=float, default=80, help="peak RSS budget (MB)")
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        results = [probe(config_dir) for _ in range(opts.runs)]
+
+    best_time = min(r["time"] for r in results)
+    best_rss = min(r["rss"] for r in results)
+    heavy = sorted(set(m for r in results for m in r["heavy"]))
+
+    print(f"import time  {best_time * 1000:8.1f} ms (budget {opts.max_time * 1000:.0f} ms)")
+    print(f"peak rss     {best_rss:8.1f} MB (budget {opts.max_rss:.0f} MB)")
+    print(f"heavy deps   {', '.join(heavy) if heavy != [] else '-'}")
+
+    if best_time > opts.max_time or best_rss > opts.max_rss or heavy != []:
+        print("startup over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
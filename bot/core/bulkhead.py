@@ -0,0 +1,209 @@
+"""
+Concurrency limits per module (bulkheads).
+
+Each hook runs at most max_concurrent updates at once, up to max_queued more updates wait
+for a slot for at most timeout seconds. Updates over the limits fail fast with
+BulkheadFull, so a module waiting on a slow upstream api (e.g. /catgpt) holds a bounded
+number of worker threads and the other modules keep running.
+
+Limits are set per hook with server.setup(modules, bulkheads={...}), hooks that are not
+configured use the defaults below. Commands run by another command of the same update
+(e.g. the commands of a macro) are admitted with the slot of their parent, whatever their
+hook, so that a macro never waits for or is rejected by its own slots. Prefetches only
+run if a slot is free right away (see set_no_wait()), real updates never wait for them.
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_BULKHEAD_MAX_CONCURRENT:
+    Default updates processed at once per hook, defaults 8
+
+BOT_BULKHEAD_MAX_QUEUED:
+    Default updates waiting for a slot per hook, defaults 8
+
+BOT_BULKHEAD_TIMEOUT:
+    Default maximum wait (in s) for a slot, defaults 5
+"""
+
+import os
+import time
+import asyncio
+import contextlib
+import threading
+import contextvars
+import collections
+import logging
+
+from bot.core import metrics
+
+log = logging.getLogger(__name__)
+
+MAX_CONCURRENT = int(os.getenv("BOT_BULKHEAD_MAX_CONCURRENT", 8))
+MAX_QUEUED = int(os.getenv("BOT_BULKHEAD_MAX_QUEUED", 8))
+TIMEOUT = float(os.getenv("BOT_BULKHEAD_TIMEOUT", 5))
+
+# name of the bulkhead that admitted the current update
+_ADMITTED = contextvars.ContextVar("bulkhead_admitted", default=None)
+
+# the current update is skipped instead of waiting for a slot
+_NO_WAIT = contextvars.ContextVar("bulkhead_no_wait", default=False)
+
+
+class BulkheadFull(Exception):
+    """Raised when a bulkhead has no free slot and no room to wait"""
+
+
+def set_no_wait() -> None:
+    """Commands of the current context only run if a slot is free, BulkheadFull otherwise"""
+
+    _NO_WAIT.set(True)
+
+
+def _grant(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Bulkhead:
+    """
+    Concurrency limit shared by the event loops of all worker threads.
+
+    Parameters
+    ----------
+    name : str
+        name in the metrics, the hook of the module
+
+    max_concurrent : int
+        slots, updates running at once
+
+    max_queued : int
+        updates waiting for a slot before new updates are rejected
+
+    timeout : float
+        maximum wait (s) for a slot
+    """
+
+    def __init__(self, name: str, max_concurrent: int = None, max_queued: int = None, timeout: float = None) -> None:
+        self.name = name
+        self.max_concurrent = MAX_CONCURRENT if max_concurrent == None else max_concurrent
+        self.max_queued = MAX_QUEUED if max_queued == None else max_queued
+        self.timeout = TIMEOUT if timeout == None else timeout
+
+        self._active = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "rejected": 0}
+
+        metrics.register_info("bot_bulkhead", "Slots in use and updates waiting per bulkhead", self.info, bulkhead=name)
+
+    def __repr__(self) -> str:
+        return f"Bulkhead({self.name!r}, max_concurrent={self.max_concurrent}, max_queued={self.max_queued}, timeout={self.timeout})"
+
+    def _reject(self, reason: str) -> None:
+        metrics.BULKHEAD_REJECTED.labels(self.name, reason).inc()
+
+        with self._lock:
+            self._stats["rejected"] += 1
+
+        log.info("%s is busy, update rejected (%s)", self.name, reason)
+        raise BulkheadFull(f"{self.name} is busy, please try again later")
+
+    async def acquire(self) -> None:
+        """
+        Take a slot, waiting for at most timeout seconds
+
+        Raises:
+            BulkheadFull: no slot within the timeout or too many updates waiting
+        """
+
+        if self.try_acquire():
+            return
+
+        start = time.perf_counter()
+
+        with self._lock:
+            if len(self._waiters) >= self.max_queued:
+                waiter = None
+            else:
+                waiter = (asyncio.get_running_loop(), asyncio.get_running_loop().create_future())
+                self._waiters.append(waiter)
+
+        if waiter == None:
+            self._reject("full")
+
+        try:
+            await asyncio.wait_for(waiter[1], self.timeout)
+
+        except BaseException as e:
+            with self._lock:
+                granted = waiter not in self._waiters
+
+                if not granted:
+                    self._waiters.remove(waiter)
+
+            # the slot was handed over as the wait ended
+            if granted:
+                self.release()
+
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject("timeout")
+
+            raise
+
+        finally:
+            metrics.BULKHEAD_WAIT.labels(self.name).observe(time.perf_counter() - start)
+
+        with self._lock:
+            self._stats["admitted"] += 1
+
+    def try_acquire(self) -> bool:
+        """Take a slot if one is free and no update is waiting, returns False otherwise"""
+
+        with self._lock:
+            if self._active < self.max_concurrent and len(self._waiters) == 0:
+                self._active += 1
+                self._stats["admitted"] += 1
+                return True
+
+        return False
+
+    def release(self) -> None:
+        """Free a slot, handed over to the longest waiting update if any"""
+
+        with self._lock:
+            if len(self._waiters) == 0:
+                self._active -= 1
+                return
+
+            loop, future = self._waiters.popleft()
+
+        loop.call_soon_threadsafe(_grant, future)
+
+    @contextlib.asynccontextmanager
+    async def hold(self):
+        """Hold a slot for the block, see acquire() and try_acquire() with set_no_wait()"""
+
+        # commands run by an admitted command use the slot of their parent
+        if _ADMITTED.get() != None:
+            yield
+            return
+
+        if not _NO_WAIT.get():
+            await self.acquire()
+
+        elif not self.try_acquire():
+            raise BulkheadFull(f"{self.name} is busy, skipped")
+
+        token = _ADMITTED.set(self.name)
+
+        try:
+            yield
+        finally:
+            _ADMITTED.reset(token)
+            self.release()
+
+    def info(self) -> dict:
+        """Returns the slots in use, updates waiting, limits and number of admitted / rejected updates"""
+
+        with self._lock:
+            return dict(self._stats, active=self._active, queued=len(self._waiters),
+                        max_concurrent=self.max_concurrent, max_queued=self.max_queued)
@@ -8,8 +8,14 @@ BOT_DB_PATH:
 """
 
 import os
+import json
 import sqlite3
 import logging
+import contextlib
+import time
+
+from bot.core.metrics import DB_DURATION
+from bot.core import tracing
 
 _SETUP_COMPLETED = False
 
@@ -74,6 +80,34 @@ def setup(path=None) -> None:
         """
         )
 
+        execute_and_commit(
+            """
+            CREATE TABLE IF NOT EXISTS ShortcutItems (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                position INTEGER,
+                name TEXT,
+                command TEXT,
+                kind TEXT NOT NULL DEFAULT 'command',
+                FOREIGN KEY(user_id) REFERENCES Users(id)
+            );
+        """
+        )
+
+        # kind was added after ShortcutItems was introduced
+        if "kind" not in [c[1] for c in execute("PRAGMA table_info(ShortcutItems)")]:
+            execute_and_commit(
+                "ALTER TABLE ShortcutItems ADD COLUMN kind TEXT NOT NULL DEFAULT 'command'")
+
+        execute_and_commit(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS ShortcutItems_user_position
+            ON ShortcutItems (user_id, position);
+        """
+        )
+
+        _migrate_shortcuts()
+
         execute_and_commit(
             """
             CREATE TABLE IF NOT EXISTS CatGPT (
@@ -83,6 +117,15 @@ def setup(path=None) -> None:
         """
         )
 
+        execute_and_commit(
+            """
+            CREATE TABLE IF NOT EXISTS CatGPTGifs (
+                file_id TEXT PRIMARY KEY,
+                added REAL
+            ) WITHOUT ROWID;
+        """
+        )
+
         global _SETUP_COMPLETED
         _SETUP_COMPLETED = True
 
@@ -91,6 +134,32 @@ def setup(path=None) -> None:
         exit(1)
 
 
+def _migrate_shortcuts() -> None:
+    """Move shortcuts stored as a json list per user in the legacy Shortcuts table to ShortcutItems"""
+
+    with transaction() as cur:
+        rows = cur.execute("SELECT user_id, command_list FROM Shortcuts").fetchall()
+
+        for user_id, command_list in rows:
+            items = [
+                (user_id, name, command)
+                for item in json.loads(command_list)
+                for name, command in item.items()
+            ]
+
+            cur.executemany(
+                """
+                INSERT INTO ShortcutItems (user_id, position, name, command)
+                SELECT ?1, COALESCE(MAX(position) + 1, 0), ?2, ?3
+                FROM ShortcutItems WHERE user_id = ?1
+                """, items)
+
+        cur.execute("DELETE FROM Shortcuts")
+
+    if rows != []:
+        log.info("Shortcuts of %s users migrated to ShortcutItems", len(rows))
+
+
 def commit():
     """
     Commit changes to database
@@ -118,10 +187,15 @@ def execute(sql: str, format: tuple | dict = ()) -> list[tuple]:
             results of sql statement
     """
 
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
+    start = time.perf_counter()
+
+    try:
+        with tracing.span("db.execute"), sqlite3.connect(DB_PATH) as con:
+            cur = con.cursor()
 
-        return cur.execute(sql, format).fetchall()
+            return cur.execute(sql, format).fetchall()
+    finally:
+        DB_DURATION.labels("execute").observe(time.perf_counter() - start)
 
 
 def execute_and_commit(sql: str, format: tuple | dict = ()) -> list[tuple]:
@@ -142,13 +216,62 @@ def execute_and_commit(sql: str, format: tuple | dict = ()) -> list[tuple]:
             result of sql statement
     """
 
-    with sqlite3.connect(DB_PATH) as con:
-        cur = con.cursor()
+    start = time.perf_counter()
+
+    try:
+        with tracing.span("db.execute_and_commit"), sqlite3.connect(DB_PATH) as con:
+            cur = con.cursor()
+
+            res = cur.execute(sql, format).fetchall()
+            con.commit()
+
+            return res
+    finally:
+        DB_DURATION.labels("execute_and_commit").observe(time.perf_counter() - start)
+
+
+def executemany_and_commit(sql: str, format: list[tuple | dict]) -> None:
+    """
+    Execute a sql query for every set of parameters in a single transaction
+
+    Parameters
+    ----------
+    sql: str
+        sql queries
+
+    format: list[tuple | dict]
+        parameters to bind values in sql, one per execution
+    """
+
+    start = time.perf_counter()
+
+    try:
+        with tracing.span("db.executemany_and_commit"), sqlite3.connect(DB_PATH) as con:
+            con.executemany(sql, format)
+            con.commit()
+    finally:
+        DB_DURATION.labels("executemany_and_commit").observe(time.perf_counter() - start)
 
-        res = cur.execute(sql, format).fetchall()
-        con.commit()
 
-        return res
+@contextlib.contextmanager
+def transaction():
+    """
+    Context manager yielding a cursor. Changes are committed on exit or rolled back if an
+    exception is raised
+
+    Yields
+    -------
+        sqlite3.Cursor
+            cursor of the transaction
+    """
+
+    start = time.perf_counter()
+
+    try:
+        with tracing.span("db.transaction"), sqlite3.connect(DB_PATH) as con:
+            yield con.cursor()
+    finally:
+        DB_DURATION.labels("transaction").observe(time.perf_counter() - start)
 
 
 async def async_commit(sql: str, format: tuple | dict = ()) -> list[tuple]:
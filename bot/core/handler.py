@@ -1,35 +1,142 @@
 """
 Module for handling supported telegram request
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_CALLBACK_COALESCE_MS:
+    Identical CallbackQuery (same chat, message and data) received while the first one is
+    processed or within this window (in ms) after it completed are only answered. Defaults 1000
+
+BOT_CALLBACK_ANSWER_MS:
+    CallbackQuery are answered together with the responses of the module if these are ready
+    within this time (in ms), e.g. "Already up to date". Otherwise they are answered right
+    away and the responses follow. 0 to always answer right away. Defaults 50
 """
 
 from telegrambots.wrapper.types.methods import AnswerCallbackQuery, SendMessage
 from telegrambots.wrapper.types.objects import *
 from telegrambots.wrapper import TelegramBotsClient
-from bot.core.objects import UserSession
+from bot.core.objects import UserSession, CollectingClient, MeteredClient, LazyUpdate
+from bot.core import metrics, tracing
+from bot.core.bulkhead import BulkheadFull
 import bot.core.server as server 
 
+import os
+import asyncio
 import logging
-import re
+import time
+import threading
+import contextvars
+import contextlib
 
 log = logging.getLogger(__name__)
 
-async def async_process_update(token, tg_update: Update):
+CALLBACK_COALESCE_WINDOW = int(os.getenv("BOT_CALLBACK_COALESCE_MS", 1000)) / 1000
+CALLBACK_ANSWER_GRACE = int(os.getenv("BOT_CALLBACK_ANSWER_MS", 50)) / 1000
+
+# (chat_id, message_id, data) -> expiry time, None while the callback is processed
+_CALLBACKS = {}
+_CALLBACKS_LOCK = threading.Lock()
+_CALLBACKS_STATS = {"processed": 0, "coalesced": 0}
+
+# [hook, subcommand] of the update being processed, set by the first routed command
+_ROUTE_LABELS = contextvars.ContextVar("route_labels", default=None)
+
+# [answered] of the CallbackQuery being processed, see claim_callback_answer()
+_CALLBACK_ANSWER = contextvars.ContextVar("callback_answer", default=None)
+
+
+def _claim_callback(key: tuple) -> bool:
+    """Returns True if the caller should process the callback, False if it is a duplicate"""
+
+    now = time.monotonic()
+
+    with _CALLBACKS_LOCK:
+        for k in [k for k, expiry in _CALLBACKS.items() if expiry != None and expiry <= now]:
+            del _CALLBACKS[k]
+
+        if key in _CALLBACKS:
+            _CALLBACKS_STATS["coalesced"] += 1
+            return False
+
+        _CALLBACKS[key] = None
+        _CALLBACKS_STATS["processed"] += 1
+        return True
+
+
+def _release_callback(key: tuple) -> None:
+    """Keep coalescing duplicates of a completed callback until the window expires"""
+
+    with _CALLBACKS_LOCK:
+        _CALLBACKS[key] = time.monotonic() + CALLBACK_COALESCE_WINDOW
+
+
+def callback_coalescing_info() -> dict:
+    """Returns number of processed and coalesced CallbackQuery"""
+
+    with _CALLBACKS_LOCK:
+        return dict(_CALLBACKS_STATS)
+
+
+def claim_callback_answer() -> bool:
+    """
+    Returns True if the caller should answer the CallbackQuery of the current update,
+    False if it is already answered or the update is not a CallbackQuery. A query can
+    only be answered once, by the handler or by the module with its responses.
+    """
+
+    answer = _CALLBACK_ANSWER.get()
+
+    if answer == None or answer[0]:
+        return False
+
+    answer[0] = True
+    return True
+
+
+async def _async_answer_callback_query(tg_obj: CallbackQuery) -> None:
+    if not claim_callback_answer():
+        return
+
+    try:
+        # own client, the client of the update may be in use by the module
+        async with MeteredClient(server.BOT_TOKEN) as client:
+            await client(AnswerCallbackQuery(tg_obj.id))
+
+    except Exception:
+        log.debug("Unable to answer CallbackQuery", exc_info=True)
+
+
+metrics.register_info("bot_callback_coalescing", "CallbackQuery coalescing", callback_coalescing_info)
+
+
+async def async_process_update(token, tg_update: LazyUpdate):
     """Process incoming telegram update object"""
 
-    client = TelegramBotsClient(token)
+    client = MeteredClient(token)
     tg_obj = tg_update.actual_update
+    update_type = tg_obj.__class__.__name__
+
+    log.info("Received telegram update %s (%s)", tg_update.update_id, update_type)
 
-    log.info(f"Received telegram update object ...")
+    start = time.perf_counter()
+    labels = ["", ""]
+    _ROUTE_LABELS.set(labels)
 
-    if isinstance(tg_obj, Message):
-        await async_handle_message(client, tg_obj)
+    try:
+        with tracing.trace_update(tg_update.update_id, type=update_type):
+            if isinstance(tg_obj, Message):
+                await async_handle_message(client, tg_obj)
 
-    elif isinstance(tg_obj, CallbackQuery):
-        await async_handle_callback_query(client, tg_obj)
+            elif isinstance(tg_obj, CallbackQuery):
+                await async_handle_callback_query(client, tg_obj)
+
+            else:
+                log.error("Unsupported telegram object, update not processed")
+
+    finally:
+        metrics.UPDATE_DURATION.labels(update_type, *labels).observe(time.perf_counter() - start)
 
-    else:
-        log.error("Unsupported telegram object, update not processed")
-    
 
 async def async_handle_message(client: TelegramBotsClient, tg_obj: Message):
     """Parse message objects"""
@@ -38,19 +145,26 @@ async def async_handle_message(client: TelegramBotsClient, tg_obj: Message):
     user_id = tg_obj.from_user.id if tg_obj.from_user.id != None else 0
     text = tg_obj.text if tg_obj.text != None else ''
 
-    log.info(f"Processing Message from user:{user_id}, chat:{chat_id}")
-    log.debug(f"Content: '{text}', user:{user_id}, chat:{chat_id}")
+    log.info("Processing Message from user:%s, chat:%s", user_id, chat_id)
+    log.debug("Content: '%s', user:%s, chat:%s", text, user_id, chat_id)
 
     session = UserSession(user_id, chat_id)
 
-    if text == '' or re.match("/.*[@[a-zA-Z]*]?",text) == None:
-        log.debug(f"Message is not a text / does not contain a command, checking previous session")
+    if text.startswith("/") and not server.ROUTER.is_command(text):
+        log.debug("Command addressed to another bot, ignored")
+        return
+
+    if not server.ROUTER.is_command(text):
+        log.debug("Message is not a text / does not contain a command, checking previous session")
         is_addl_args, last_command = await session.async_get_state()
 
         text = last_command + " " + text if is_addl_args else text
     
     try:
         await async_handle_request(client,tg_obj,session,text)
+    except BulkheadFull as e:
+        async with client:
+            await client(SendMessage(chat_id, str(e), reply_to_message_id=tg_obj.message_id))
     except Exception as e:
         async with client:
             await client(SendMessage(chat_id, f"ERROR: Not a command / sessions missing / unsupported object. \n\nTry running a command e.g. /start: {e}", reply_to_message_id=tg_obj.message_id))
@@ -58,39 +172,96 @@ async def async_handle_message(client: TelegramBotsClient, tg_obj: Message):
 async def async_handle_callback_query(client: TelegramBotsClient, tg_obj: CallbackQuery):
     """Parse CallbackQuery objects"""
 
-    async with client:
-        await client(AnswerCallbackQuery(tg_obj.id))
-
     chat_id = tg_obj.message.chat.id
     user_id = tg_obj.from_user.id if not None else 0
     text = tg_obj.data
 
-    log.info(f"Processing CallbackQuery from user:{user_id}, chat:{chat_id}")
-    log.debug(f"Content: '{text}', user:{user_id}, chat:{chat_id}")
+    log.info("Processing CallbackQuery from user:%s, chat:%s", user_id, chat_id)
+    log.debug("Content: '%s', user:%s, chat:%s", text, user_id, chat_id)
+
+    key = (chat_id, tg_obj.message.message_id, text)
+
+    if not _claim_callback(key):
+        log.info("Duplicate CallbackQuery coalesced, user:%s, chat:%s", user_id, chat_id)
+
+        async with client:
+            await client(AnswerCallbackQuery(tg_obj.id))
+
+        return
 
     session = UserSession(user_id, chat_id)
+    _CALLBACK_ANSWER.set([False])
+
+    request = asyncio.ensure_future(async_handle_request(client,tg_obj,session,text))
 
     try:
-        await async_handle_request(client,tg_obj,session,text)
+        # the spinner of the button stops right away if the responses take longer
+        done, _ = await asyncio.wait({request}, timeout=CALLBACK_ANSWER_GRACE)
+
+        if request not in done:
+            await _async_answer_callback_query(tg_obj)
+
+        await request
+
     except Exception as e:
         async with client:
             await client(SendMessage(chat_id,str(e)))
 
+        await _async_answer_callback_query(tg_obj)
+
+    finally:
+        # stops the module if the handler is cancelled
+        request.cancel()
+        _release_callback(key)
+
     log.info("Completed CallbackQuery Request")
 
 
 async def async_handle_request(client,tg_obj,session,text):
-    text = re.sub("[@[a-zA-Z]*]",'',text)
-    text = text.strip()
-    
-    module = re.search("/\S*", text)
-    module = module.group(0) if module != None else None
-    module = server.ENABLED_MODULES[module]
-    
+    route = server.ROUTER.match(text.strip())
+
+    if route == None:
+        raise ValueError(f"Unknown command: '{text.strip()}'")
+
+    labels = _ROUTE_LABELS.get()
+
+    if labels != None and labels[0] == "":
+        labels[:] = route.hook, route.subcommand or ""
+
     kwargs = {
         "client": client,
         "tg_obj": tg_obj,
         "session": session,
-        'text': text
+        "text": route.text,
+        "args": route.args
     }
-    await module.handle_request(**kwargs)
\ No newline at end of file
+
+    bulkhead = server.BULKHEADS.get(route.hook)
+
+    with tracing.span("module.handle_request", hook=route.hook, subcommand=route.subcommand):
+        async with bulkhead.hold() if bulkhead != None else contextlib.nullcontext():
+            await route.module.handle_request(**kwargs)
+
+
+def is_collectable(text: str) -> bool:
+    """True if the command can be run by async_collect_request, see BaseModule.collectable"""
+
+    route = server.ROUTER.match(text.strip())
+    return route != None and route.subcommand in route.module.collectable
+
+
+async def async_collect_request(tg_obj, session, text) -> list:
+    """
+    Handle a command and returns the responses instead of sending them
+
+    Raises:
+        ValueError: the command is unknown or its responses cannot be collected
+    """
+
+    if server.ROUTER.match(text.strip()) != None and not is_collectable(text):
+        raise ValueError(f"'{text.strip()}' cannot be run in a macro")
+
+    client = CollectingClient()
+    await async_handle_request(client, tg_obj, session, text)
+
+    return client.responses
\ No newline at end of file
@@ -0,0 +1,329 @@
+"""
+Ingress rate limiting and fair scheduling of updates.
+
+Updates are checked against a token bucket per user and per chat as they arrive, before
+any database or module work. Updates over the limit are dropped and the user is told to
+slow down, at most once per BOT_INGRESS_NOTICE_INTERVAL. Dropped callback queries are
+always answered, so that the spinner of the button stops.
+
+Admitted updates are queued per user and run by BOT_WORKERS worker threads in deficit
+round-robin order: every user with queued updates gets BOT_SCHEDULER_QUANTUM_MS of
+processing time per round, the cost of an update being the average processing time of
+the previous updates of the user. A user with many or slow updates (e.g. /catgpt) only
+delays their own updates.
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_INGRESS_USER_RATE:
+    Updates per second per user, 0 to disable. Defaults 1
+
+BOT_INGRESS_USER_BURST:
+    Updates a user can send at once, defaults 10
+
+BOT_INGRESS_CHAT_RATE:
+    Updates per second per chat, 0 to disable. Defaults 5
+
+BOT_INGRESS_CHAT_BURST:
+    Updates a chat can send at once, defaults 30
+
+BOT_INGRESS_NOTICE_INTERVAL:
+    Minimum time (in s) between two "slow down" notices to a user, defaults 30
+
+BOT_WORKERS:
+    Worker threads processing updates, defaults 32
+
+BOT_SCHEDULER_QUANTUM_MS:
+    Processing time (in ms) given to each user per scheduling round, defaults 50
+
+BOT_SCHEDULER_MAX_QUEUED:
+    Updates queued per user before new updates are dropped, defaults 20
+"""
+
+import os
+import math
+import time
+import threading
+import collections
+import logging
+
+from telegrambots.wrapper.types.methods import AnswerCallbackQuery, SendMessage
+
+import bot.core.server as server
+from bot.core import metrics
+from bot.core.objects import LazyUpdate, MeteredClient
+from bot.helper import aio
+
+log = logging.getLogger(__name__)
+
+USER_RATE = float(os.getenv("BOT_INGRESS_USER_RATE", 1))
+USER_BURST = float(os.getenv("BOT_INGRESS_USER_BURST", 10))
+CHAT_RATE = float(os.getenv("BOT_INGRESS_CHAT_RATE", 5))
+CHAT_BURST = float(os.getenv("BOT_INGRESS_CHAT_BURST", 30))
+NOTICE_INTERVAL = float(os.getenv("BOT_INGRESS_NOTICE_INTERVAL", 30))
+
+WORKERS = int(os.getenv("BOT_WORKERS", 32))
+QUANTUM = max(0.001, float(os.getenv("BOT_SCHEDULER_QUANTUM_MS", 50)) / 1000)
+MAX_QUEUED = int(os.getenv("BOT_SCHEDULER_MAX_QUEUED", 20))
+
+NOTICE_TEXT = "Too many requests, please slow down"
+
+# Entries kept for idle users before the oldest are dropped
+MAX_KEYS = 10000
+
+
+class TokenBuckets:
+    """
+    Token bucket per key, refilled at rate tokens per second up to burst tokens.
+    Disabled if rate is 0.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(1.0, burst)
+
+        # key -> (tokens, last refill)
+        self._buckets: dict = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key) -> bool:
+        """Take a token of the key, returns False if the bucket is empty"""
+
+        if self.rate <= 0 or key == None:
+            return True
+
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+
+            # most recently used last, the oldest buckets are dropped (as if full)
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+
+            if len(self._buckets) > MAX_KEYS:
+                del self._buckets[next(iter(self._buckets))]
+
+        return allowed
+
+
+class _Flow:
+    __slots__ = ("queue", "deficit")
+
+    def __init__(self) -> None:
+        self.queue = collections.deque()
+        self.deficit = 0.0
+
+
+class FairScheduler:
+    """
+    Run tasks in worker threads in deficit round-robin order across keys. Workers are
+    started on the first task.
+
+    Parameters
+    ----------
+    workers : int
+        number of worker threads
+
+    quantum : float
+        processing time (s) given to each key with queued tasks per round
+
+    max_queued : int
+        tasks queued per key before new tasks are rejected
+    """
+
+    def __init__(self, workers: int, quantum: float, max_queued: int, name: str = "worker") -> None:
+        self.workers = workers
+        self.quantum = quantum
+        self.max_queued = max_queued
+        self.name = name
+
+        self._flows: dict[object, _Flow] = {}
+        self._active = collections.deque()
+
+        # key -> moving average of the processing time of its tasks
+        self._costs: dict[object, float] = {}
+
+        self._busy = 0
+        self._queued = 0
+        self._started = False
+        self._cond = threading.Condition()
+
+    def submit(self, key, func, *args) -> bool:
+        """Queue func(*args), returns False if too many tasks of the key are queued"""
+
+        with self._cond:
+            flow = self._flows.get(key)
+
+            if flow != None and len(flow.queue) >= self.max_queued:
+                return False
+
+            if flow == None:
+                flow = self._flows[key] = _Flow()
+                self._active.append(key)
+
+            flow.queue.append((func, args, time.perf_counter()))
+            self._queued += 1
+
+            if not self._started:
+                self._start()
+
+            self._cond.notify()
+
+        return True
+
+    def _start(self) -> None:
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True).start()
+
+        self._started = True
+
+    def _pick(self) -> tuple:
+        """Returns the next (key, task), the lock must be held and a task queued"""
+
+        key = self._active[0]
+        flow = self._flows[key]
+        cost = self._costs.get(key, self.quantum)
+
+        if flow.deficit < cost:
+            # rounds of quantum each key needs to reach its cost, computed instead of
+            # running the rounds (a slow key needs cost / quantum of them)
+            n = len(self._active)
+            rounds = [
+                max(0, math.ceil((self._costs.get(k, self.quantum) - self._flows[k].deficit) / self.quantum))
+                for k in self._active
+            ]
+
+            # first key to reach its cost in round-robin order
+            index = min(range(n), key=lambda i: rounds[i] * n + i)
+
+            # keys before it are visited once more in the last round
+            for i, k in enumerate(self._active):
+                self._flows[k].deficit += (rounds[index] + (1 if i < index else 0)) * self.quantum
+
+            self._active.rotate(-index)
+            key = self._active[0]
+            flow = self._flows[key]
+            cost = self._costs.get(key, self.quantum)
+
+        flow.deficit -= cost
+        task = flow.queue.popleft()
+        self._queued -= 1
+
+        # idle keys do not keep their deficit
+        if len(flow.queue) == 0:
+            self._active.popleft()
+            del self._flows[key]
+
+        return key, task
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while len(self._active) == 0:
+                    self._cond.wait()
+
+                key, (func, args, queued) = self._pick()
+                self._busy += 1
+
+            start = time.perf_counter()
+            metrics.UPDATE_QUEUE_DURATION.labels().observe(start - queued)
+
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Scheduled task failed")
+
+            finally:
+                elapsed = time.perf_counter() - start
+
+                with self._cond:
+                    self._busy -= 1
+                    self._costs[key] = 0.8 * self._costs.pop(key, elapsed) + 0.2 * elapsed
+
+                    if len(self._costs) > MAX_KEYS:
+                        del self._costs[next(iter(self._costs))]
+
+    def info(self) -> dict:
+        """Returns the number of queued tasks, keys with queued tasks and busy workers"""
+
+        with self._cond:
+            return {"queued": self._queued, "keys": len(self._active), "busy": self._busy, "workers": self.workers}
+
+
+USER_BUCKETS = TokenBuckets(USER_RATE, USER_BURST)
+CHAT_BUCKETS = TokenBuckets(CHAT_RATE, CHAT_BURST)
+SCHEDULER = FairScheduler(WORKERS, QUANTUM, MAX_QUEUED)
+
+_NOTIFIED: dict = {}
+_NOTIFIED_LOCK = threading.Lock()
+
+metrics.register_info("bot_scheduler", "Updates queued and workers of the fair scheduler", SCHEDULER.info)
+
+
+async def _async_notify(tg_update: LazyUpdate, notice: bool) -> None:
+    if tg_update.type == "callback_query":
+        method = AnswerCallbackQuery(tg_update.actual_update.id, text=NOTICE_TEXT if notice else None)
+    else:
+        method = SendMessage(tg_update.chat_id, NOTICE_TEXT, disable_notification=True)
+
+    try:
+        async with MeteredClient(server.BOT_TOKEN) as client:
+            await client(method)
+
+    except Exception:
+        log.debug("Unable to send notice to user:%s, chat:%s", tg_update.user_id, tg_update.chat_id, exc_info=True)
+
+
+def _reject(tg_update: LazyUpdate, reason: str) -> None:
+    metrics.UPDATES_REJECTED.labels(reason).inc()
+    log.info("Update rejected (%s), user:%s, chat:%s", reason, tg_update.user_id, tg_update.chat_id)
+
+    callback = tg_update.type == "callback_query"
+
+    if tg_update.chat_id == None and not callback:
+        return
+
+    key = tg_update.user_id or tg_update.chat_id
+    now = time.monotonic()
+
+    with _NOTIFIED_LOCK:
+        notice = now - _NOTIFIED.get(key, -NOTICE_INTERVAL) >= NOTICE_INTERVAL
+
+        if notice:
+            _NOTIFIED.pop(key, None)
+            _NOTIFIED[key] = now
+
+            if len(_NOTIFIED) > MAX_KEYS:
+                del _NOTIFIED[next(iter(_NOTIFIED))]
+
+    # callback queries are always answered, without the notice if it was sent recently
+    if notice or callback:
+        aio.get_background_loop().submit(_async_notify(tg_update, notice))
+
+
+def submit(tg_update: LazyUpdate, func) -> bool:
+    """
+    Rate limit an update and schedule func(tg_update) in a worker thread.
+
+    Returns
+    -------
+    bool:
+        False if the update was rejected
+    """
+
+    if not USER_BUCKETS.acquire(tg_update.user_id):
+        _reject(tg_update, "user_rate")
+        return False
+
+    if not CHAT_BUCKETS.acquire(tg_update.chat_id):
+        _reject(tg_update, "chat_rate")
+        return False
+
+    key = tg_update.user_id if tg_update.user_id != None else tg_update.chat_id
+
+    if not SCHEDULER.submit(key, func, tg_update):
+        _reject(tg_update, "queue_full")
+        return False
+
+    return True
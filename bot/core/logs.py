@@ -0,0 +1,213 @@
+"""
+Logging setup.
+
+Records are put on a queue by the thread that logs them and formatted and written to
+stderr by a background thread, the request path never waits on the output. Records are
+dropped (and counted) when the queue is full. Log calls use %-style arguments, which
+are only formatted if the record is kept.
+
+DEBUG and INFO records of hot path loggers can be sampled or rate limited, warnings and
+errors are always kept. Logger settings apply to the children of the logger, e.g.
+"bot.core" applies to "bot.core.handler".
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_LOG_LEVEL:
+    Level of the root logger, defaults "DEBUG"
+
+BOT_LOG_LEVELS:
+    Level per logger, e.g. "bot.core.handler=INFO,urllib3=WARNING", defaults ""
+
+BOT_LOG_SAMPLE:
+    Fraction of the DEBUG and INFO records kept per logger, e.g. "bot.core.handler=0.1",
+    defaults ""
+
+BOT_LOG_RATE_LIMIT:
+    Maximum DEBUG and INFO records per second per logger, e.g. "bot.modules=50", defaults ""
+
+BOT_LOG_QUEUE_SIZE:
+    Records waiting to be written before new records are dropped, defaults 10000
+"""
+
+import os
+import time
+import queue
+import atexit
+import random
+import threading
+import logging
+import logging.handlers
+
+from bot.core import metrics
+
+FORMAT = "[%(asctime)s] [%(levelname)-5s] [%(name)-20s] -- %(message)s (%(filename)s:%(lineno)s) "
+
+
+def _parse(value: str, convert) -> dict:
+    """Parse "name=value,name=value" settings"""
+
+    settings = {}
+
+    for item in value.split(","):
+        if item.strip() == "":
+            continue
+
+        name, _, setting = item.partition("=")
+        settings[name.strip()] = convert(setting.strip())
+
+    return settings
+
+
+def _level(name: str) -> int:
+    return int(name) if name.isdigit() else logging.getLevelName(name.upper())
+
+
+LEVEL = _level(os.getenv("BOT_LOG_LEVEL", "DEBUG"))
+LEVELS = _parse(os.getenv("BOT_LOG_LEVELS", ""), _level)
+SAMPLE = _parse(os.getenv("BOT_LOG_SAMPLE", ""), float)
+RATE_LIMIT = _parse(os.getenv("BOT_LOG_RATE_LIMIT", ""), float)
+QUEUE_SIZE = int(os.getenv("BOT_LOG_QUEUE_SIZE", 10000))
+
+_STATS = {"dropped": 0, "sampled_out": 0, "rate_limited": 0}
+_STATS_LOCK = threading.Lock()
+
+_LISTENER: logging.handlers.QueueListener = None
+
+
+def _count(stat: str) -> None:
+    with _STATS_LOCK:
+        _STATS[stat] += 1
+
+
+def info() -> dict:
+    """Returns the number of records dropped by a full queue, sampling and rate limits"""
+
+    with _STATS_LOCK:
+        return dict(_STATS)
+
+
+metrics.register_info("bot_log", "Log records not written", info)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a fraction or a maximum rate of the DEBUG and INFO records of loggers.
+
+    Parameters
+    ----------
+    sample : dict[str, float]
+        logger name -> fraction of records kept
+
+    rate_limit : dict[str, float]
+        logger name -> records per second, bursts of up to one second of records (at
+        least one record)
+    """
+
+    def __init__(self, sample: dict[str, float], rate_limit: dict[str, float]) -> None:
+        super().__init__()
+
+        self._sample = sample
+        self._rate_limit = rate_limit
+
+        # logger name -> (sample, rate limit) of the closest configured logger
+        self._settings = {}
+
+        # configured logger -> [tokens, last refill]
+        self._buckets = {name: [max(1.0, rate), time.monotonic()] for name, rate in rate_limit.items()}
+        self._lock = threading.Lock()
+
+    def _lookup(self, settings: dict, name: str) -> str | None:
+        while name not in settings:
+            if "." not in name:
+                return None
+
+            name = name.rpartition(".")[0]
+
+        return name
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        settings = self._settings.get(record.name)
+
+        if settings == None:
+            settings = self._settings[record.name] = (
+                self._sample.get(self._lookup(self._sample, record.name)),
+                self._lookup(self._rate_limit, record.name)
+            )
+
+        sample, bucket = settings
+
+        if sample != None and random.random() >= sample:
+            _count("sampled_out")
+            return False
+
+        if bucket != None:
+            rate = self._rate_limit[bucket]
+
+            with self._lock:
+                tokens, last = self._buckets[bucket]
+                now = time.monotonic()
+                # at least one record, rates below 1/s would never fill a whole token
+                tokens = min(max(1.0, rate), tokens + (now - last) * rate)
+                allowed = tokens >= 1
+                self._buckets[bucket] = [tokens - 1 if allowed else tokens, now]
+
+            if not allowed:
+                _count("rate_limited")
+                return False
+
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks and leaves the formatting to the listener thread.
+    Arguments of log calls must not be modified after the call.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _count("dropped")
+
+
+def setup(handler: logging.Handler = None) -> None:
+    """
+    Configure the root logger and the loggers in BOT_LOG_LEVELS. Records are written
+    from a background thread, stopped (and flushed) at exit.
+
+    Parameters
+    ----------
+    handler : logging.Handler, optional
+        handler writing the records, defaults a stderr StreamHandler with FORMAT
+    """
+
+    global _LISTENER
+
+    if _LISTENER != None:
+        return
+
+    if handler == None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(FORMAT))
+
+    q = queue.Queue(QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(q)
+    queue_handler.addFilter(SamplingFilter(SAMPLE, RATE_LIMIT))
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(LEVEL)
+
+    for name, level in LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+
+    _LISTENER = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)
@@ -0,0 +1,273 @@
+"""
+Metrics in the Prometheus text format, served by the flask server at /metrics.
+
+Metrics are plain counters / histograms updated under a per metric lock, an observation
+costs a dict lookup, a bisect and a few additions. Statistics that already exist as
+*_info() functions (e.g. response cache, prefetch) are registered with register_info()
+and only read when the metrics are scraped.
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_METRICS_TOKEN:
+    If set, /metrics requires the header "Authorization: Bearer {BOT_METRICS_TOKEN}". If unset,
+    /metrics is only served to loopback clients (e.g. a local Prometheus or a reverse proxy
+    on the same host, which must then restrict /metrics itself), optional
+"""
+
+import os
+import hmac
+import ipaddress
+import bisect
+import threading
+import logging
+from typing import Callable
+
+log = logging.getLogger(__name__)
+
+METRICS_TOKEN = os.getenv("BOT_METRICS_TOKEN")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+PARSE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005)
+
+_METRICS: list["_Metric"] = []
+
+# name -> [help, [(constant labels, info function)]]
+_INFO: dict[str, list] = {}
+_INFO_LOCK = threading.Lock()
+
+
+def _format_labels(names, values) -> str:
+    if len(names) == 0:
+        return ""
+
+    pairs = ",".join(
+        '%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    )
+    return "{%s}" % pairs
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+        self._children = {}
+        self._lock = threading.Lock()
+
+        # metrics without labels are exported from the start
+        if self.labelnames == ():
+            self.labels()
+
+        _METRICS.append(self)
+
+    def labels(self, *values):
+        """Returns the child metric for the label values"""
+
+        child = self._children.get(values)
+
+        if child == None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+
+        return child
+
+    def items(self) -> list[tuple]:
+        """Returns (label values, child metric) of all children"""
+
+        with self._lock:
+            return list(self._children.items())
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+        with self._lock:
+            lines += self._samples()
+
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self, lock: threading.Lock) -> None:
+        self.value = 0.0
+        self._lock = lock
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    """Monotonically increasing value"""
+
+    type = "counter"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {c.value}" for k, c in self._children.items()]
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    type = "gauge"
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: tuple[float], lock: threading.Lock) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = lock
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (e.g. latency in seconds)"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str] = (), buckets: tuple[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets, self._lock)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        names = self.labelnames + ("le",)
+
+        for k, h in self._children.items():
+            total = 0
+            for le, count in zip(self.buckets + ("+Inf",), h.counts):
+                total += count
+                lines.append(f"{self.name}_bucket{_format_labels(names, k + (le,))} {total}")
+
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, k)} {h.sum}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, k)} {total}")
+
+        return lines
+
+
+def register_info(name: str, help: str, func: Callable[[], dict], **labels) -> None:
+    """
+    Expose the numeric values of a dict returned by func (e.g. response_cache_info) as
+    a gauge {name}{**labels, stat="key"}, read when the metrics are scraped.
+    """
+
+    with _INFO_LOCK:
+        _INFO.setdefault(name, [help, []])[1].append((labels, func))
+
+
+def _render_info() -> list[str]:
+    with _INFO_LOCK:
+        families = [(name, help, list(sources)) for name, (help, sources) in _INFO.items()]
+
+    out = []
+
+    for name, help, sources in families:
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+
+        for labels, func in sources:
+            try:
+                values = func()
+            except Exception:
+                log.warning("Unable to collect %s", name, exc_info=True)
+                continue
+
+            for stat, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"{name}{_format_labels((*labels, 'stat'), (*labels.values(), stat))} {value}")
+
+        out.append("\n".join(lines))
+
+    return out
+
+
+def render() -> str:
+    """Returns all metrics in the Prometheus text format"""
+
+    THREADS.labels().set(threading.active_count())
+
+    return "\n".join([m.render() for m in _METRICS] + _render_info()) + "\n"
+
+
+def is_authorized(authorization: str | None, remote_addr: str | None) -> bool:
+    """Check the Authorization header of a /metrics request, loopback clients only if no token is set"""
+
+    if METRICS_TOKEN == None:
+        try:
+            return ipaddress.ip_address(remote_addr).is_loopback
+        except ValueError:
+            return False
+
+    return authorization != None and hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode())
+
+
+UPDATE_DURATION = Histogram(
+    "bot_update_duration_seconds", "Time to process a telegram update", ("type", "hook", "subcommand"))
+
+UPDATE_PARSE_DURATION = Histogram(
+    "bot_update_parse_duration_seconds", "Time to read updates (summary) and to build the objects used by modules",
+    ("object",), buckets=PARSE_BUCKETS)
+
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Updates being processed")
+
+UPDATES_REJECTED = Counter(
+    "bot_updates_rejected_total", "Updates rejected at ingress (user_rate, chat_rate, queue_full)", ("reason",))
+
+UPDATE_QUEUE_DURATION = Histogram(
+    "bot_update_queue_duration_seconds", "Time of updates waiting for a worker")
+
+THREADS = Gauge("bot_threads", "Live threads of the process")
+
+TELEGRAM_DURATION = Histogram(
+    "bot_telegram_request_duration_seconds", "Latency of telegram bot api calls", ("method",))
+
+TELEGRAM_REQUESTS = Counter(
+    "bot_telegram_requests_total", "Telegram bot api calls by result (ok or error code)", ("method", "result"))
+
+UPSTREAM_DURATION = Histogram(
+    "bot_upstream_request_duration_seconds", "Latency of upstream api calls", ("api", "endpoint"))
+
+UPSTREAM_REQUESTS = Counter(
+    "bot_upstream_requests_total", "Upstream api calls by result (http status or error)", ("api", "endpoint", "result"))
+
+BULKHEAD_REJECTED = Counter(
+    "bot_bulkhead_rejected_total", "Updates rejected by the bulkhead of a module (full, timeout)", ("bulkhead", "reason"))
+
+BULKHEAD_WAIT = Histogram(
+    "bot_bulkhead_wait_seconds", "Time of updates waiting for a slot of the bulkhead of a module", ("bulkhead",))
+
+DB_DURATION = Histogram(
+    "bot_db_query_duration_seconds", "Time of database queries", ("op",), buckets=DB_BUCKETS)
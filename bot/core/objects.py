@@ -1,6 +1,26 @@
+"""
+Objects shared by the core and the modules
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_TELEGRAM_API_URL:
+    Base url of the telegram bot api, defaults "https://api.telegram.org"
+"""
+
 from typing import Union, Optional, Iterable
+import os
+import time
+
+from telegrambots.wrapper import TelegramBotsClient
+from telegrambots.wrapper.api_response_exception import ApiResponseException
+from telegrambots.wrapper.serializations import deserialize
+from telegrambots.wrapper.types.objects import Update, Message, CallbackQuery, Chat, User
 
 import bot.core.database as db
+from bot.core.metrics import TELEGRAM_DURATION, TELEGRAM_REQUESTS, UPDATE_PARSE_DURATION
+from bot.core import tracing
+
+TELEGRAM_API_URL = os.getenv("BOT_TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
 
 class UserSession:
     """
@@ -51,7 +71,7 @@ class UserSession:
 
         db.execute_and_commit(
             """
-            INSERT INTO UserSession 
+            INSERT INTO UserSession (user_id, chat_id, command, listening)
             VALUES(:user_id,:chat_id,:command,:listening) 
             ON CONFLICT(chat_id,user_id) 
             DO UPDATE SET 
@@ -76,4 +96,186 @@ class UserSession:
     async def async_update_state(self, command: str | Iterable, require_addl_args: bool):
         """Asynchronous update user session status and last executed command"""
 
-        return self.update_state(command,require_addl_args)
\ No newline at end of file
+        return self.update_state(command,require_addl_args)
+
+
+class ReadOnlyUserSession(UserSession):
+    """
+    User session whose state updates are discarded. Used to run commands on behalf of a user
+    (e.g. macros) without changing how the next message of the user is handled.
+    """
+
+    def update_state(self, command: str | Iterable, require_addl_args: bool):
+        pass
+
+    async def async_update_state(self, command: str | Iterable, require_addl_args: bool):
+        pass
+
+
+class CollectingClient:
+    """
+    Stand-in for TelegramBotsClient that records the methods instead of sending them.
+    Calls return None, only subcommands that do not use the results of the client can be
+    collected (see BaseModule.collectable).
+
+    Attributes
+    ----------
+    responses : list[TelegramBotsMethod]
+        methods "sent" to the client, in order
+    """
+
+    def __init__(self) -> None:
+        self.responses = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def __call__(self, method):
+        self.responses.append(method)
+
+
+class MeteredClient(TelegramBotsClient):
+    """
+    TelegramBotsClient recording the latency and result (ok or error code) of every
+    bot api call in the metrics and the trace of the update. Calls are sent to
+    BOT_TELEGRAM_API_URL.
+    """
+
+    def __init__(self, token: str, session=None):
+        super().__init__(token, session)
+        self._base_url = f"{TELEGRAM_API_URL}/bot{token}/"
+
+    async def __call__(self, method):
+        start = time.perf_counter()
+        result = "ok"
+
+        try:
+            with tracing.span(f"telegram.{method.endpoint}"):
+                return await super().__call__(method)
+
+        except ApiResponseException as e:
+            result = str(e.error_code)
+            raise
+
+        except Exception as e:
+            result = type(e).__name__
+            raise
+
+        finally:
+            TELEGRAM_DURATION.labels(method.endpoint).observe(time.perf_counter() - start)
+            TELEGRAM_REQUESTS.labels(method.endpoint, result).inc()
+
+
+# Fields read from the json without building the object, None for values, type for objects
+_LAZY_FIELDS = {
+    Message: {"message_id": None, "text": None, "chat": Chat, "from_user": User},
+    CallbackQuery: {"id": None, "data": None, "message": Message, "from_user": User},
+    Chat: {"id": None, "type": None},
+    User: {"id": None},
+}
+
+# attribute name -> json key, if different
+_JSON_KEYS = {"from_user": "from"}
+
+# update json key -> type of the actual update, other updates are built on arrival
+_UPDATE_TYPES = {
+    "message": Message,
+    "edited_message": Message,
+    "channel_post": Message,
+    "edited_channel_post": Message,
+    "callback_query": CallbackQuery,
+}
+
+
+class LazyObject:
+    """
+    Stand-in for a telegrambots object that is built from its json on first use.
+
+    The fields needed to dispatch an update (ids, text, callback data, chat and sender) are
+    read from the json, any other field builds the object with deserialize. Passes
+    isinstance checks of the object type.
+    """
+
+    __slots__ = ("_cls", "_json", "_obj")
+
+    def __init__(self, cls: type, json: dict) -> None:
+        self._cls = cls
+        self._json = json
+        self._obj = None
+
+    @property
+    def __class__(self):
+        return self._cls
+
+    def __getattr__(self, name):
+        fields = _LAZY_FIELDS[self._cls]
+
+        if self._obj == None and name in fields:
+            value = self._json.get(_JSON_KEYS.get(name, name))
+
+            return value if fields[name] == None or value == None else LazyObject(fields[name], value)
+
+        return getattr(self.unwrap(), name)
+
+    def __repr__(self) -> str:
+        return f"LazyObject({self._cls.__name__}, built={self._obj != None})"
+
+    def unwrap(self):
+        """Returns the telegrambots object, built on the first call"""
+
+        if self._obj == None:
+            start = time.perf_counter()
+            self._obj = deserialize(self._cls, self._json)
+            UPDATE_PARSE_DURATION.labels(self._cls.__name__).observe(time.perf_counter() - start)
+
+        return self._obj
+
+
+class LazyUpdate:
+    """
+    Telegram update read from the webhook json without building the telegrambots objects.
+
+    Attributes
+    ----------
+    update_id : int
+        Update identifier
+
+    type : str
+        Json key of the update, e.g. "message", "callback_query"
+
+    actual_update : LazyObject | TelegramBotsObject
+        Message or CallbackQuery built on first use, other updates are built on arrival
+
+    raw : dict
+        Update json
+
+    user_id : int | None
+        Sender of the update, None if unknown (e.g. channel posts)
+
+    chat_id : int | None
+        Chat of the message or of the message of the callback query, None if unknown
+    """
+
+    __slots__ = ("update_id", "type", "actual_update", "raw", "user_id", "chat_id")
+
+    def __init__(self, raw: dict) -> None:
+        start = time.perf_counter()
+
+        self.raw = raw
+        self.update_id = raw["update_id"]
+        self.type = next((k for k in raw if k != "update_id"), None)
+
+        obj = raw.get(self.type)
+        obj = obj if isinstance(obj, dict) else {}
+        self.user_id = (obj.get("from") or {}).get("id")
+        self.chat_id = (obj.get("chat") or (obj.get("message") or {}).get("chat") or {}).get("id")
+
+        if self.type in _UPDATE_TYPES:
+            self.actual_update = LazyObject(_UPDATE_TYPES[self.type], obj)
+        else:
+            self.actual_update = deserialize(Update, raw).actual_update
+
+        UPDATE_PARSE_DURATION.labels("summary").observe(time.perf_counter() - start)
@@ -0,0 +1,176 @@
+"""
+Predictive prefetch of the commands shown in an inline keyboard.
+
+When a menu or a shortcut list is sent, the next tap is likely one of its buttons. The
+commands of the buttons are run in the background with the response discarded, so that
+upstream data and cached responses are warm when the tap arrives. Only subcommands listed
+in the prefetch_safe attribute of a module are prefetched, they must not change any state.
+Prefetches are skipped if the bulkhead of the module has no free slot.
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_PREFETCH:
+    Enable prefetching, defaults 0
+
+BOT_PREFETCH_WORKERS:
+    Number of background prefetch threads, defaults 2
+
+BOT_PREFETCH_QUEUE:
+    Maximum pending prefetches, further prefetches are dropped, defaults 16
+"""
+
+import os
+import asyncio
+import threading
+import contextvars
+import concurrent.futures
+import logging
+
+import cachetools
+
+import bot.core.server
+import bot.core.handler
+from bot.core.objects import ReadOnlyUserSession
+from bot.core import metrics, bulkhead
+
+log = logging.getLogger(__name__)
+
+ENABLED = os.getenv("BOT_PREFETCH", "0").lower() in ("1", "true", "yes")
+WORKERS = int(os.getenv("BOT_PREFETCH_WORKERS", 2))
+QUEUE_SIZE = int(os.getenv("BOT_PREFETCH_QUEUE", 16))
+
+# Placeholder message_id of prefetched edits. Responses are cached without their ids,
+# prefetching an edit warms the response of a tap on any message
+PLACEHOLDER_MESSAGE_ID = 0
+
+_EXECUTOR: concurrent.futures.ThreadPoolExecutor = None
+
+# Commands waiting for or being prefetched
+_PENDING = set()
+_LOCK = threading.Lock()
+
+# Cache keys warmed by a prefetch and not yet used
+_WARMED = cachetools.TTLCache(maxsize=1024, ttl=300)
+_STATS = {"scheduled": 0, "dropped": 0, "skipped": 0, "failed": 0, "warmed": 0, "hits": 0}
+
+_PREFETCHING = contextvars.ContextVar("prefetching", default=False)
+
+
+def is_prefetching() -> bool:
+    """True when called from a prefetch, responses must not be sent"""
+
+    return _PREFETCHING.get()
+
+
+def mark_warmed(key) -> None:
+    """Record a response cache entry created by a prefetch"""
+
+    with _LOCK:
+        _WARMED[key] = True
+        _STATS["warmed"] += 1
+
+
+def consume(key) -> None:
+    """Record a response cache hit, counted if the entry was created by a prefetch"""
+
+    with _LOCK:
+        if _WARMED.pop(key, None) != None:
+            _STATS["hits"] += 1
+
+
+def prefetch_info() -> dict:
+    """Returns prefetch counts, hit ratio (warmed entries used) and waste ratio"""
+
+    with _LOCK:
+        warmed = _STATS["warmed"]
+        ratio = _STATS["hits"] / warmed if warmed > 0 else 0.0
+
+        return dict(_STATS, pending=len(_PENDING), hit_ratio=ratio, waste_ratio=1 - ratio if warmed > 0 else 0.0)
+
+
+metrics.register_info("bot_prefetch", "Inline keyboard prefetches, pending is queued work", prefetch_info)
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _EXECUTOR
+
+    with _LOCK:
+        if _EXECUTOR == None:
+            _EXECUTOR = concurrent.futures.ThreadPoolExecutor(WORKERS, thread_name_prefix="prefetch")
+
+        return _EXECUTOR
+
+
+async def _async_prefetch(tg_obj, session, text):
+    _PREFETCHING.set(True)
+
+    # only free slots of the module are used, updates of users never wait for a prefetch
+    bulkhead.set_no_wait()
+
+    await bot.core.handler.async_collect_request(tg_obj, session, text)
+
+
+def _prefetch(tg_obj, session, text):
+    try:
+        asyncio.run(_async_prefetch(tg_obj, session, text))
+        log.debug("Prefetched '%s'", text)
+
+    except bulkhead.BulkheadFull:
+        with _LOCK:
+            _STATS["skipped"] += 1
+
+        log.debug("Module busy, prefetch of '%s' skipped", text)
+
+    except Exception:
+        with _LOCK:
+            _STATS["failed"] += 1
+
+        log.debug("Unable to prefetch '%s'", text, exc_info=True)
+
+    finally:
+        with _LOCK:
+            _PENDING.discard(text)
+
+
+def _is_safe(text: str) -> bool:
+    route = bot.core.server.ROUTER.match(text)
+
+    return route != None and route.subcommand in route.module.prefetch_safe
+
+
+def schedule(tg_obj, user_id, chat_id, commands) -> None:
+    """
+    Prefetch commands in the background, does nothing if prefetching is disabled.
+
+    Parameters
+    ----------
+    tg_obj : Message
+        message the commands are run for
+
+    user_id, chat_id : int | str
+        user and chat the commands are run for
+
+    commands : Iterable[str]
+        e.g. callback_data of inline keyboard buttons
+    """
+
+    if not ENABLED or is_prefetching():
+        return
+
+    for text in dict.fromkeys(commands):
+        if text == None or not _is_safe(text):
+            continue
+
+        with _LOCK:
+            if text in _PENDING:
+                continue
+
+            if len(_PENDING) >= QUEUE_SIZE:
+                _STATS["dropped"] += 1
+                continue
+
+            _PENDING.add(text)
+            _STATS["scheduled"] += 1
+
+        session = ReadOnlyUserSession(user_id, chat_id, PLACEHOLDER_MESSAGE_ID)
+        _get_executor().submit(_prefetch, tg_obj, session, text)
@@ -0,0 +1,126 @@
+"""
+Sampling profiler of the running process, served by the flask server at /debug/profile.
+
+The stacks of all threads (update threads, background loops, prefetch workers) are sampled
+with sys._current_frames() at a fixed interval, the profiled code is not instrumented.
+The result is in the collapsed stack format ("thread;module:function;... count") read by
+flamegraph.pl, speedscope or inferno.
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_PROFILE_TOKEN:
+    /debug/profile requires the header "Authorization: Bearer {BOT_PROFILE_TOKEN}", the
+    endpoint is disabled if unset
+"""
+
+import os
+import re
+import hmac
+import sys
+import time
+import threading
+import collections
+import logging
+
+log = logging.getLogger(__name__)
+
+PROFILE_TOKEN = os.getenv("BOT_PROFILE_TOKEN")
+
+MAX_DURATION = 60
+MIN_INTERVAL = 0.001
+
+# One profile at a time
+_LOCK = threading.Lock()
+
+
+def is_enabled() -> bool:
+    return PROFILE_TOKEN != None
+
+
+def is_authorized(authorization: str | None) -> bool:
+    """Check the Authorization header of a /debug/profile request"""
+
+    return PROFILE_TOKEN != None and authorization != None and \
+        hmac.compare_digest(authorization.encode(), f"Bearer {PROFILE_TOKEN}".encode())
+
+
+def _thread_name(name: str) -> str:
+    # group the threads started per update, e.g. "Thread-12 (request_callback)"
+    return re.sub(r"\d+", "N", name).replace(";", ":")
+
+
+def _collapse(frame) -> list[str]:
+    stack = []
+
+    while frame != None:
+        code = frame.f_code
+        stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+        frame = frame.f_back
+
+    stack.reverse()
+    return stack
+
+
+def sample(duration: float, interval: float = 0.01) -> dict[str, int]:
+    """
+    Sample the stacks of all other threads.
+
+    Parameters
+    ----------
+    duration : float
+        profile duration (s), at most MAX_DURATION
+
+    interval : float, optional
+        time between samples (s), at least MIN_INTERVAL
+
+    Returns
+    -------
+        dict[str, int]
+            number of samples of each collapsed stack
+
+    Raises
+    ------
+        RuntimeError
+            if a profile is already running
+    """
+
+    duration = min(duration, MAX_DURATION)
+    interval = max(interval, MIN_INTERVAL)
+
+    if not _LOCK.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+
+    try:
+        counts = collections.Counter()
+        me = threading.get_ident()
+        names = {}
+        end = time.monotonic() + duration
+        n = 0
+
+        while time.monotonic() < end:
+            frames = sys._current_frames()
+
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+
+                if ident not in names:
+                    names = {t.ident: _thread_name(t.name) for t in threading.enumerate()}
+
+                counts[";".join([names.get(ident, "unknown"), *_collapse(frame)])] += 1
+
+            del frames
+            n += 1
+            time.sleep(interval)
+
+        log.info("Profiled %s samples in %ss", n, duration)
+        return counts
+
+    finally:
+        _LOCK.release()
+
+
+def format_collapsed(counts: dict[str, int]) -> str:
+    """Returns the stacks in the collapsed stack format, most frequent first"""
+
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda x: -x[1]))
@@ -0,0 +1,196 @@
+"""
+Recording of incoming updates, replayed with tools/replay.py.
+
+Raw update json is appended with its arrival time to gzip compressed json lines files
+in BOT_RECORD_DIR. A new file is started when a file reaches BOT_RECORD_MAX_MB
+(uncompressed) and only the newest BOT_RECORD_KEEP files are kept.
+
+Redaction (BOT_RECORD_REDACT, comma separated):
+    ids:  user and chat ids are replaced by a keyed hash (the same id maps to the same
+          value in a recording), names and usernames are replaced by "x"
+    text: text and captions that are not commands are replaced by "x"
+    args: arguments of commands are replaced by "x"
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_RECORD:
+    Record incoming updates, defaults 0
+
+BOT_RECORD_DIR:
+    Directory of the recordings, defaults "{BOT_CONFIG_DIR}/recordings"
+
+BOT_RECORD_MAX_MB:
+    Size of a recording file before a new one is started, defaults 16
+
+BOT_RECORD_KEEP:
+    Number of recording files kept, defaults 10
+
+BOT_RECORD_REDACT:
+    Fields to redact (ids, text, args), defaults "ids"
+
+BOT_RECORD_SALT:
+    Key of the id hash, random per process if unset. Set it to keep ids consistent
+    between restarts
+"""
+
+import os
+import glob
+import gzip
+import json
+import time
+import hmac
+import hashlib
+import secrets
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+ENABLED = os.getenv("BOT_RECORD", "0").lower() in ("1", "true", "yes")
+RECORD_DIR = os.getenv("BOT_RECORD_DIR", os.path.join(os.getenv("BOT_CONFIG_DIR", "."), "recordings"))
+MAX_BYTES = int(float(os.getenv("BOT_RECORD_MAX_MB", 16)) * 1024 * 1024)
+KEEP = int(os.getenv("BOT_RECORD_KEEP", 10))
+REDACT = set(s.strip() for s in os.getenv("BOT_RECORD_REDACT", "ids").split(",") if s.strip() != "")
+SALT = os.getenv("BOT_RECORD_SALT", secrets.token_hex(16)).encode()
+
+FILE_PATTERN = "updates-*.jsonl.gz"
+
+_ID_KEYS = ("id", "user_id", "chat_id")
+_NAME_KEYS = ("first_name", "last_name", "username", "title", "phone_number")
+
+_FILE: gzip.GzipFile = None
+_WRITTEN = 0
+_LOCK = threading.Lock()
+
+
+def _redact_id(value: int) -> int:
+    digest = hmac.new(SALT, str(value).encode(), hashlib.sha256).digest()
+
+    # keep the sign, group chats have negative ids
+    return int.from_bytes(digest[:6], "big") * (-1 if value < 0 else 1)
+
+
+def _redact_text(text: str) -> str:
+    if text.startswith("/"):
+        if "args" not in REDACT:
+            return text
+
+        command, *args = text.split()
+        return " ".join([command, *["x" * len(a) for a in args]])
+
+    return "x" * len(text) if "text" in REDACT else text
+
+
+def redact(obj, key: str = None):
+    """Returns a copy of update json with the fields in BOT_RECORD_REDACT redacted"""
+
+    if isinstance(obj, dict):
+        out = {}
+
+        for k, v in obj.items():
+            # first_name is required by telegrambots, names are replaced instead of removed
+            if "ids" in REDACT and k in _NAME_KEYS and isinstance(v, str):
+                out[k] = "x"
+            else:
+                out[k] = redact(v, k)
+
+        return out
+
+    if isinstance(obj, list):
+        return [redact(v, key) for v in obj]
+
+    if "ids" in REDACT and key in _ID_KEYS and isinstance(obj, int):
+        return _redact_id(obj)
+
+    if key in ("text", "caption", "data") and isinstance(obj, str) and REDACT & {"text", "args"}:
+        return _redact_text(obj)
+
+    return obj
+
+
+def _rotate() -> None:
+    global _FILE
+    global _WRITTEN
+
+    if _FILE != None:
+        _FILE.close()
+
+    os.makedirs(RECORD_DIR, exist_ok=True)
+
+    # the new file is one of the KEEP files
+    existing = sorted(glob.glob(os.path.join(RECORD_DIR, FILE_PATTERN)))
+
+    for old in existing[:max(0, len(existing) - KEEP + 1)]:
+        os.remove(old)
+
+    now = time.time()
+    path = os.path.join(RECORD_DIR, time.strftime("updates-%Y%m%d-%H%M%S", time.localtime(now)) + f".{int(now * 1000) % 1000:03d}.jsonl.gz")
+    _FILE = gzip.open(path, "at")
+    _WRITTEN = 0
+
+    log.info("Recording updates to %s", path)
+
+
+def record(update: dict, received: float = None) -> None:
+    """
+    Append an update to the recording, does nothing if recording is disabled.
+
+    Parameters
+    ----------
+    update : dict
+        raw update json
+
+    received : float, optional
+        arrival time (unix time), defaults now
+    """
+
+    global _WRITTEN
+
+    if not ENABLED:
+        return
+
+    line = json.dumps({"t": time.time() if received == None else received, "update": redact(update)}) + "\n"
+
+    try:
+        with _LOCK:
+            if _FILE == None or _WRITTEN + len(line) > MAX_BYTES:
+                _rotate()
+
+            _FILE.write(line)
+            _FILE.flush()
+            _WRITTEN += len(line)
+
+    except OSError:
+        log.warning("Unable to record update", exc_info=True)
+
+
+def read(paths: list[str]):
+    """
+    Yields (arrival time, update json) of recordings, in order of the files
+
+    Parameters
+    ----------
+    paths : list[str]
+        recording files or directories of recordings
+    """
+
+    files = []
+
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, FILE_PATTERN))) if os.path.isdir(path) else [path]
+
+    for path in files:
+        # the end of a file that was being written may be truncated
+        try:
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        log.warning("Truncated record in %s", path)
+                        continue
+
+                    yield entry["t"], entry["update"]
+
+        except EOFError:
+            log.warning("Truncated recording %s", path)
@@ -0,0 +1,118 @@
+"""
+Routing of command text to the enabled modules.
+
+The routing table is built once by server.setup(). It is a two level trie of hook and
+subcommand, so that routing an update is a string split and two dict lookups instead of
+several regular expressions. The subcommands of a module are added on its first use.
+"""
+
+import logging
+from typing import NamedTuple
+
+log = logging.getLogger(__name__)
+
+class Route(NamedTuple):
+    """
+    Result of routing a command.
+
+    Attributes
+    ----------
+    module : type[BaseModule]
+        module handling the command
+
+    hook : str
+        e.g. "/weathersg"
+
+    subcommand : str | None
+        args[1] if it is a subcommand of the module
+
+    args : tuple[str]
+        command split on whitespace, without the bot username
+
+    text : str
+        command text without the bot username, whitespace in the arguments is kept
+    """
+
+    module: type
+    hook: str
+    subcommand: str | None
+    args: tuple[str]
+    text: str
+
+
+class _Node:
+    __slots__ = ("module", "children")
+
+    def __init__(self, module=None) -> None:
+        self.module = module
+
+        # filled on first match, reading the subcommands of a lazily loaded module imports it
+        self.children: dict[str, "_Node"] = None
+
+
+class Router:
+    """
+    Compiled routing table of the enabled modules.
+
+    Parameters
+    ----------
+    modules : list[type[BaseModule]]
+        enabled modules
+
+    username : str, optional
+        username of the bot. Commands addressed to another bot (/start@other_bot) are
+        not routed. If None, any @username suffix is removed.
+    """
+
+    def __init__(self, modules, username: str = None) -> None:
+        self.username = username.lower() if username != None else None
+        self._root: dict[str, _Node] = {}
+
+        for module in modules:
+            self._root[module.hook] = _Node(module)
+
+        log.debug("Routing table built for %s hooks", len(self._root))
+
+    def _split(self, text: str) -> tuple[str, str] | None:
+        """
+        Returns command without bot username and the text after the command, None if
+        text is not a command for this bot
+        """
+
+        if not text.startswith("/"):
+            return None
+
+        parts = text.split(maxsplit=1)
+        command, _, username = parts[0].partition("@")
+
+        if username != "" and self.username != None and username.lower() != self.username:
+            return None
+
+        return command, text[len(parts[0]):] if len(parts) > 1 else ""
+
+    def is_command(self, text: str) -> bool:
+        """True if text is a command addressed to this bot, it may not be a known command"""
+
+        return text != None and self._split(text) != None
+
+    def match(self, text: str) -> Route | None:
+        """Route a command, returns None if it is not a command of an enabled module"""
+
+        parts = self._split(text)
+
+        if parts == None:
+            return None
+
+        command, rest = parts
+        node = self._root.get(command)
+
+        if node == None:
+            return None
+
+        if node.children == None:
+            node.children = {s: _Node(node.module) for s in getattr(node.module, "_subcommands", {}) if s != None}
+
+        args = rest.split()
+        subcommand = args[0] if len(args) > 0 and args[0] in node.children else None
+
+        return Route(node.module, command, subcommand, (command, *args), command + rest.rstrip())
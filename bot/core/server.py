@@ -12,6 +12,7 @@ BOT_TOKEN:
 
 BOT_SERVER_HOSTNAME: optional
     Hostname or IP address to be published to telegram bot api, defaults "current.public.ip.address"
+    (looked up during setup)
 
 BOT_SERVER_PUBLISHED_PORT:
     Port to be published to telegram bot api, default 88
@@ -24,99 +25,276 @@ BOT_SERVER_CERT_PATH:
 
 BOT_SERVER_KEY_PATH:
     SSL private key path, default "{BOT_CONFIG_DIR}/ssl/key.pem"
+
+BOT_METRICS_TOKEN: optional
+    Bearer token required to read the Prometheus metrics at /metrics, loopback clients only
+    if unset. See bot.core.metrics
+
+BOT_RECORD: optional
+    Record incoming updates for tools/replay.py, defaults 0. See bot.core.recorder
+
+BOT_PROFILE_TOKEN: optional
+    Bearer token required to profile the process at /debug/profile, disabled if unset.
+    See bot.core.profiler
+
+BOT_INGRESS_*, BOT_WORKERS, BOT_SCHEDULER_*: optional
+    Rate limits per user and chat and worker threads processing the updates, see
+    bot.core.ingress
+
+BOT_BULKHEAD_*: optional
+    Default concurrency limits of the modules, see bot.core.bulkhead
     
 """
 
 
 import json
 import os
+import hashlib
 import requests
 import threading
 import asyncio
+import concurrent.futures
 
 import bot.core.database as db
+from bot.core.router import Router
+from bot.core.objects import TELEGRAM_API_URL, LazyUpdate
+from bot.core.bulkhead import Bulkhead
+from bot.core import metrics, profiler, recorder, ingress, bulkhead
 
 from bot.core.handler import *
-from telegrambots.wrapper.serializations import serialize, deserialize
 import requests
 
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 
 ENABLED_MODULES = {}
+ROUTER = Router([])
+
+# hook -> concurrency limit of the module
+BULKHEADS = {}
 
 # configured in main.py
 CONFIG_DIR = os.getenv('BOT_CONFIG_DIR')
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
-HOSTNAME = os.getenv('BOT_SERVER_HOSTNAME') if os.getenv(
-    'BOT_SERVER_HOSTNAME') != None else requests.get(
-        'https://api.ipify.org').content.decode('utf8')
+# Public ip address is looked up during setup if not set
+HOSTNAME = os.getenv('BOT_SERVER_HOSTNAME')
 
 PUBLISHED_PORT = int(os.getenv('BOT_SERVER_PUBLISHED_PORT', 88))
 SERVER_PORT = int(os.getenv('BOT_SERVER_PORT', 88))
 
 # For standalone operation
 IS_STANDALONE = True if os.getenv("BOT_SERVER_IS_STANDALONE", 'true').lower() == 'true' else False
-PUBLISHED_URL = os.getenv('BOT_SERVER_PUBLISHED_URL', f"https://{HOSTNAME}:{PUBLISHED_PORT}/")
+PUBLISHED_URL = os.getenv('BOT_SERVER_PUBLISHED_URL')
 
 # Default values are set later
 CERT_PATH = os.getenv('BOT_SERVER_CERT_PATH')
 KEY_PATH = os.getenv('BOT_SERVER_KEY_PATH')
 
+# Fingerprints of the last webhook, cert and command list registered with telegram,
+# stored in CONFIG_DIR
+REGISTRATION_FILE = "registration.json"
+
 _SETUP_COMPLETED = False
 
 flask = Flask(__name__)
 
 
-def setup(modules):
+def _get_public_ip() -> str:
+    r = requests.get('https://api.ipify.org', timeout=10)
+    r.raise_for_status()
+
+    return r.content.decode('utf8')
+
+
+def _get_bot_username() -> str:
+    r = requests.get(f'{TELEGRAM_API_URL}/bot{BOT_TOKEN}/getMe', timeout=10)
+    r.raise_for_status()
+
+    return r.json()["result"].get("username")
+
+
+def _load_registration() -> dict:
+    """Fingerprints of the last registration, empty if there is none"""
+
+    try:
+        with open(os.path.join(CONFIG_DIR, REGISTRATION_FILE)) as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_registration(registration: dict) -> None:
+    path = os.path.join(CONFIG_DIR, REGISTRATION_FILE)
+    tmp = f"{path}.{os.getpid()}.tmp"
+
+    try:
+        with open(tmp, "w") as f:
+            json.dump(registration, f)
+
+        os.replace(tmp, path)
+
+    except OSError:
+        log.warning("Unable to save registration, the next start registers the bot again", exc_info=True)
+
+
+def _fingerprint(*parts: str | bytes) -> str:
+    h = hashlib.sha256()
+
+    for p in parts:
+        h.update(p.encode() if isinstance(p, str) else p)
+        h.update(b"\0")
+
+    return h.hexdigest()
+
+
+def _bot_api(method: str, **kwargs) -> dict | list | bool:
+    r = requests.post(f'{TELEGRAM_API_URL}/bot{BOT_TOKEN}/{method}', timeout=30, **kwargs)
+    r.raise_for_status()
+
+    return r.json()["result"]
+
+
+def _setup_cert(saved: dict) -> dict:
+    """Generate a self-signed cert if none is configured, existing key material is reused"""
+
+    global CERT_PATH
+    global KEY_PATH
+
+    if CERT_PATH != None and KEY_PATH != None and os.path.isfile(CERT_PATH) and os.path.isfile(KEY_PATH):
+        return {}
+
+    log.info("ssl cert or key path not set. Using default values ssl/cert.pem & ssl/key.pem")
+
+    CERT_PATH = os.path.join(CONFIG_DIR, "ssl/cert.pem")
+    KEY_PATH = os.path.join(CONFIG_DIR, "ssl/key.pem")
+
+    # The cert is only valid for the hostname it was generated for
+    if os.path.isfile(CERT_PATH) and os.path.isfile(KEY_PATH) and saved.get("cert_hostname") == HOSTNAME:
+        log.info("Reusing generated ssl cert")
+        return {"cert_hostname": HOSTNAME}
+
+    # Generate ssl certs, signed with the existing key if any
+    os.makedirs(os.path.join(CONFIG_DIR, "ssl/"), exist_ok=True)
+    key = f"-key {KEY_PATH}" if os.path.isfile(KEY_PATH) else f"-newkey rsa:4096 -keyout {KEY_PATH}"
+
+    status = os.system(f'openssl req -x509 {key} -out {CERT_PATH} \
+               -sha256 -days 3650 -nodes -subj \
+              "/C=US/ST=StateName/L=CityName/O=CompanyName/OU=CompanySectionName/CN={HOSTNAME}"')
+
+    # not recorded, the cert is generated again on the next start
+    if status != 0:
+        raise RuntimeError(f"Unable to generate ssl cert, openssl exited with status {status}")
+
+    return {"cert_hostname": HOSTNAME}
+
+
+def _register_webhook(saved: dict) -> dict:
+    """setWebhook, skipped if the url and cert are unchanged and registered"""
+
+    registration = {}
+    cert = b""
+
+    if IS_STANDALONE == True:
+        registration = _setup_cert(saved)
+
+        with open(CERT_PATH, "rb") as f:
+            cert = f.read()
+
+    registration["webhook"] = _fingerprint(PUBLISHED_URL, cert)
+
+    if saved.get("webhook") == registration["webhook"]:
+        info = _bot_api("getWebhookInfo")
+
+        if info.get("url") == PUBLISHED_URL and info.get("has_custom_certificate", False) == IS_STANDALONE:
+            log.info("Webhook unchanged, setWebhook skipped")
+            return registration
+
+    if IS_STANDALONE == True:
+        _bot_api("setWebhook", params={"url": PUBLISHED_URL}, files={"certificate": cert})
+    else:
+        _bot_api("setWebhook", params={"url": PUBLISHED_URL})
+
+    log.info("Webhook registered")
+    return registration
+
+
+def _register_commands(modules, saved: dict) -> dict:
+    """setMyCommands, skipped if the command list is unchanged and registered"""
+
+    commands_list = [{"command": m.hook.replace(
+        "/", ""), "description": m.description} for m in modules]
+
+    registration = {"commands": _fingerprint(json.dumps(commands_list, sort_keys=True))}
+
+    if saved.get("commands") == registration["commands"] and _bot_api("getMyCommands") == commands_list:
+        log.info("Commands unchanged, setMyCommands skipped")
+        return registration
+
+    _bot_api("setMyCommands", params={"commands": json.dumps(commands_list)})
+
+    log.info("Commands registered")
+    return registration
+
+
+def setup(modules, bulkheads: dict[str, dict] = None):
     """
-    Configures the server
+    Configures the server and registers the bot with telegram. Registration steps that
+    are unchanged since the last start are skipped.
 
     Parameters
     ----------
         modules: list[BaseModule]
             list of BaseModule object
 
+        bulkheads: dict[str, dict], optional
+            concurrency limits per hook, keyword arguments of bot.core.bulkhead.Bulkhead
+            e.g. {"/catgpt": {"max_concurrent": 4, "max_queued": 4}}. Hooks that are not
+            set use the defaults of bot.core.bulkhead. Set the hooks waiting on upstream
+            apis here, a warning is logged if together they can hold so many of the
+            BOT_WORKERS threads that less than a default bulkhead is left to the others
+
     """
-    global CERT_PATH
-    global KEY_PATH
     global ENABLED_MODULES
+    global ROUTER
+    global BULKHEADS
+    global HOSTNAME
+    global PUBLISHED_URL
 
     ENABLED_MODULES = {m.hook: m for m in modules}
+    ROUTER = Router(modules)
+
+    bulkheads = bulkheads or {}
+    BULKHEADS = {m.hook: Bulkhead(m.hook, **bulkheads.get(m.hook, {})) for m in modules}
+
+    # running and waiting updates both hold a worker thread
+    held = sum(b.max_concurrent + b.max_queued for hook, b in BULKHEADS.items() if hook in bulkheads)
+
+    if held > ingress.WORKERS - bulkhead.MAX_CONCURRENT:
+        log.warning(
+            "Configured bulkheads can hold %d of the %d worker threads, the other modules may stall, "
+            "lower their limits or raise BOT_WORKERS", held, ingress.WORKERS)
 
     try:
+        saved = _load_registration()
 
-        if IS_STANDALONE == True:
-            # Setup self-signed ssl certs for webhook operations
-            if CERT_PATH == None or KEY_PATH == None or not os.path.isfile(CERT_PATH) or not os.path.isfile(KEY_PATH):
-
-                log.info(
-                    "ssl cert or key path not set. Using default values ssl/cert.pem & ssl/key.pem")
-
-                CERT_PATH = os.path.join(CONFIG_DIR, "ssl/cert.pem")
-                KEY_PATH = os.path.join(CONFIG_DIR, "ssl/key.pem")
-
-                # Generate ssl certs
-                os.makedirs(os.path.join(CONFIG_DIR, "ssl/"), exist_ok=True)
-                os.system(f'openssl req -x509 -newkey rsa:4096 -keyout {KEY_PATH} -out {CERT_PATH} \
-                           -sha256 -days 3650 -nodes -subj \
-                          "/C=US/ST=StateName/L=CityName/O=CompanyName/OU=CompanySectionName/CN={HOSTNAME}"')
-
-            with open(CERT_PATH) as cert:
-                url = f'https://api.telegram.org/bot{BOT_TOKEN}/setWebhook?url={PUBLISHED_URL}'
-                requests.post(
-                    url, files={'certificate': cert}).raise_for_status()
-        
-        else:
-            url = f'https://api.telegram.org/bot{BOT_TOKEN}/setWebhook?url={PUBLISHED_URL}'
-            requests.post(url).raise_for_status()
-
-        # Setup commands in telegram
-        commands_list = [{"command": m.hook.replace(
-            "/", ""), "description": m.description} for m in modules]
-        url = f'https://api.telegram.org/bot{BOT_TOKEN}/setMyCommands'
-        requests.post(url, params={"commands": json.dumps(
-            commands_list)}).raise_for_status()
+        # Independent calls run in parallel
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            username = pool.submit(_get_bot_username)
+            commands = pool.submit(_register_commands, modules, saved)
+
+            if HOSTNAME == None and (PUBLISHED_URL == None or IS_STANDALONE):
+                HOSTNAME = pool.submit(_get_public_ip).result()
+
+            if PUBLISHED_URL == None:
+                PUBLISHED_URL = f"https://{HOSTNAME}:{PUBLISHED_PORT}/"
+
+            webhook = pool.submit(_register_webhook, saved)
+
+            # Commands addressed to other bots in groups are not routed
+            ROUTER = Router(modules, username.result())
+
+            _save_registration({**commands.result(), **webhook.result()})
 
     except:
         log.fatal("Failed to setup bot", exc_info=True)
@@ -127,12 +305,13 @@ def setup(modules):
 
 
 def request_callback(args):
-    """Run incoming requests in async loops"""
+    """Run incoming requests in async loops, called by the worker threads of bot.core.ingress"""
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(async_process_update(BOT_TOKEN, args))
-    loop.close()
+    # asyncio.run closes the loop even if the update fails, the worker threads are long lived
+    try:
+        asyncio.run(async_process_update(BOT_TOKEN, args))
+    finally:
+        metrics.UPDATES_IN_FLIGHT.labels().dec()
 
 
 @flask.route('/', methods=['POST'])
@@ -141,10 +320,14 @@ def request_handler():
 
     if request.method == 'POST':
         api_json = request.json
-        tg_update = deserialize(Update, api_json)
+        recorder.record(api_json)
+        tg_update = LazyUpdate(api_json)
 
-        thread = threading.Thread(target=request_callback, args=(tg_update,))
-        thread.start()
+        # Rejected updates are still acknowledged, telegram would send them again
+        metrics.UPDATES_IN_FLIGHT.labels().inc()
+
+        if not ingress.submit(tg_update, request_callback):
+            metrics.UPDATES_IN_FLIGHT.labels().dec()
 
         return '', 200
 
@@ -152,6 +335,43 @@ def request_handler():
         return '', 400
 
 
+@flask.route('/metrics', methods=['GET'])
+def metrics_handler():
+    """Prometheus metrics"""
+
+    if not metrics.is_authorized(request.headers.get("Authorization"), request.remote_addr):
+        abort(401)
+
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@flask.route('/debug/profile', methods=['GET'])
+def profile_handler():
+    """
+    Sample the stacks of the process for ?seconds= (default 10) every ?interval_ms=
+    (default 10), returns collapsed stacks for flame graphs
+    """
+
+    if not profiler.is_enabled():
+        abort(404)
+
+    if not profiler.is_authorized(request.headers.get("Authorization")):
+        abort(401)
+
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval = float(request.args.get("interval_ms", 10)) / 1000
+    except ValueError:
+        abort(400)
+
+    try:
+        counts = profiler.sample(seconds, interval)
+    except RuntimeError:
+        abort(409)
+
+    return Response(profiler.format_collapsed(counts), content_type="text/plain; charset=utf-8")
+
+
 def run(debug=False):
     """Starts the flask http server"""
 
@@ -0,0 +1,237 @@
+"""
+Per update tracing spans.
+
+The processing of an update is recorded as a tree of spans (module, database, upstream
+and telegram calls) tied to its update_id. Sampled traces are appended to a file in the
+Trace Event Format (JSON array), which can be opened in chrome://tracing or Perfetto.
+Updates slower than a threshold are logged with their span tree, sampled or not.
+
+Spans are only recorded inside trace_update(), span() is a no-op elsewhere (e.g. prefetch).
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_TRACE_SAMPLE:
+    Fraction of updates written to BOT_TRACE_FILE, defaults 0
+
+BOT_TRACE_FILE:
+    Trace file, defaults "{BOT_CONFIG_DIR}/traces/trace.json"
+
+BOT_TRACE_SLOW_MS:
+    Updates taking longer (in ms) are logged with their span tree, 0 to disable. Defaults 2000
+"""
+
+import os
+import json
+import time
+import random
+import itertools
+import threading
+import contextvars
+import logging
+
+log = logging.getLogger(__name__)
+
+SAMPLE_RATE = float(os.getenv("BOT_TRACE_SAMPLE", 0))
+TRACE_FILE = os.getenv("BOT_TRACE_FILE", os.path.join(os.getenv("BOT_CONFIG_DIR", "."), "traces/trace.json"))
+SLOW_THRESHOLD = float(os.getenv("BOT_TRACE_SLOW_MS", 2000)) / 1000
+
+_TRACE = contextvars.ContextVar("trace", default=None)
+_PARENT = contextvars.ContextVar("trace_parent", default=0)
+
+_FILE_LOCK = threading.Lock()
+
+# wall clock time of perf_counter() == 0, for the timestamps of exported traces
+_EPOCH = time.time() - time.perf_counter()
+
+
+class _Span:
+    __slots__ = ("id", "parent", "name", "start", "end", "tid", "attrs")
+
+    def __init__(self, id: int, parent: int, name: str, attrs: dict) -> None:
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.attrs = attrs
+        self.tid = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end != None else time.perf_counter()) - self.start
+
+
+class Trace:
+    """
+    Spans recorded for an update.
+
+    Attributes
+    ----------
+    update_id : int
+        telegram update_id
+
+    sampled : bool
+        True if the trace is written to the trace file
+
+    spans : list[_Span]
+        completed spans
+    """
+
+    def __init__(self, update_id: int, sampled: bool) -> None:
+        self.update_id = update_id
+        self.sampled = sampled
+        self.spans: list[_Span] = []
+        self._ids = itertools.count(1)
+
+    def format_tree(self) -> str:
+        """Returns the spans as an indented tree"""
+
+        children = {}
+        for s in sorted(self.spans, key=lambda s: s.start):
+            children.setdefault(s.parent, []).append(s)
+
+        lines = []
+
+        def walk(parent, depth):
+            for s in children.get(parent, []):
+                attrs = " ".join(f"{k}={v}" for k, v in s.attrs.items())
+                lines.append(f"{'  ' * depth}{s.name} {s.duration * 1000:.1f} ms {attrs}".rstrip())
+                walk(s.id, depth + 1)
+
+        walk(0, 1)
+        return "\n".join(lines)
+
+    def to_events(self) -> list[dict]:
+        """Returns the spans as Trace Event Format complete ("X") events"""
+
+        pid = os.getpid()
+
+        return [
+            {
+                "name": s.name,
+                "cat": s.name.partition(".")[0],
+                "ph": "X",
+                "ts": round((_EPOCH + s.start) * 1e6),
+                "dur": round(s.duration * 1e6),
+                "pid": pid,
+                "tid": s.tid,
+                "args": dict(s.attrs, update_id=self.update_id),
+            }
+            for s in self.spans
+        ]
+
+
+class _SpanContext:
+    __slots__ = ("_trace", "_span", "_token")
+
+    def __init__(self, trace: Trace, name: str, attrs: dict) -> None:
+        self._trace = trace
+        self._span = _Span(next(trace._ids), _PARENT.get(), name, attrs)
+
+    def __enter__(self):
+        self._span.start = time.perf_counter()
+        self._token = _PARENT.set(self._span.id)
+        return self._span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._span.end = time.perf_counter()
+        _PARENT.reset(self._token)
+
+        if exc_type != None:
+            self._span.attrs["error"] = exc_type.__name__
+
+        self._trace.spans.append(self._span)
+
+
+class _NullContext:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL = _NullContext()
+
+
+def span(name: str, **attrs):
+    """
+    Context manager recording a span of the current update, e.g.
+
+        with tracing.span("db.execute"):
+            ...
+
+    Parameters
+    ----------
+    name : str
+        "{category}.{operation}", e.g. "telegram.sendMessage"
+
+    **attrs
+        attributes of the span
+    """
+
+    trace = _TRACE.get()
+
+    if trace == None:
+        return _NULL
+
+    return _SpanContext(trace, name, attrs)
+
+
+class _UpdateContext:
+    def __init__(self, update_id: int, attrs: dict) -> None:
+        self._trace = Trace(update_id, random.random() < SAMPLE_RATE)
+        self._attrs = attrs
+
+    def __enter__(self):
+        self._token = _TRACE.set(self._trace)
+        self._span = _SpanContext(self._trace, "update", self._attrs)
+        self._span.__enter__()
+        return self._trace
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._span.__exit__(exc_type, exc_val, exc_tb)
+        _TRACE.reset(self._token)
+
+        elapsed = self._span._span.duration
+
+        if SLOW_THRESHOLD > 0 and elapsed > SLOW_THRESHOLD:
+            log.warning("Slow update %s (%.0f ms):\n%s", self._trace.update_id, elapsed * 1000, self._trace.format_tree())
+
+        if self._trace.sampled:
+            export(self._trace)
+
+
+def trace_update(update_id: int, **attrs):
+    """
+    Context manager tracing the processing of an update, spans created inside are
+    recorded in its trace. No-op if sampling and the slow update log are disabled.
+    """
+
+    if SAMPLE_RATE <= 0 and SLOW_THRESHOLD <= 0:
+        return _NULL
+
+    return _UpdateContext(update_id, attrs)
+
+
+def export(trace: Trace, path: str = None) -> None:
+    """Append the spans of a trace to the trace file"""
+
+    path = TRACE_FILE if path == None else path
+    lines = "".join(json.dumps(e, default=str) + ",\n" for e in trace.to_events())
+
+    try:
+        with _FILE_LOCK:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+            # The Trace Event Format allows the array to be left unterminated
+            with open(path, "a") as f:
+                if f.tell() == 0:
+                    f.write("[\n")
+
+                f.write(lines)
+
+    except OSError:
+        log.warning("Unable to write trace to %s", path, exc_info=True)
@@ -0,0 +1,79 @@
+"""
+Shared asyncio event loop running in a background thread.
+
+Each telegram update is processed in a worker thread with its own event loop. Resources that must be
+shared between updates (e.g. connection pools, semaphores) live in this loop instead and
+are used through BackgroundLoop.run()
+"""
+
+import asyncio
+import threading
+import concurrent.futures
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class BackgroundLoop:
+    """
+    Event loop running forever in a daemon thread.
+
+    Attributes
+    ----------
+    name : str
+        name of the background thread
+
+    loop : asyncio.AbstractEventLoop
+        the event loop, None until started
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.loop: asyncio.AbstractEventLoop = None
+        self._lock = threading.Lock()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        """Start the background thread if it is not running"""
+
+        with self._lock:
+            if self.loop == None:
+                ready = threading.Event()
+                threading.Thread(target=self._run, args=(ready,), name=self.name, daemon=True).start()
+                ready.wait()
+
+                log.debug("Background event loop '%s' started", self.name)
+
+        return self.loop
+
+    def _run(self, ready: threading.Event):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        ready.set()
+        self.loop.run_forever()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Schedule a coroutine in the background loop from any thread"""
+
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    async def run(self, coro):
+        """
+        Run a coroutine in the background loop and await its result from another loop.
+        Cancelling the caller cancels the coroutine.
+        """
+
+        return await asyncio.wrap_future(self.submit(coro))
+
+
+_LOOPS: dict[str, BackgroundLoop] = {}
+_LOOPS_LOCK = threading.Lock()
+
+
+def get_background_loop(name: str = "background") -> BackgroundLoop:
+    """Returns the shared background loop with the given name"""
+
+    with _LOOPS_LOCK:
+        if name not in _LOOPS:
+            _LOOPS[name] = BackgroundLoop(name)
+
+        return _LOOPS[name]
@@ -1,7 +1,10 @@
-from .weather.weather import *
-from .shortcuts.shortcuts import *
-from .base import *
-from .start.start import *
-from .catgpt.catgpt import *
+from .registry import LazyModule
 
-ALL_MODULES = [WeatherModule,ShortcutsModule,StartModule,CatGPTModule]
\ No newline at end of file
+# Implementations are imported on first use, see registry.py
+StartModule = LazyModule("/start", "Show All Modules", "bot.modules.start.start:StartModule")
+WeatherModule = LazyModule("/weathersg", "Get the latest Singapore Weather", "bot.modules.weather.weather:WeatherModule")
+ShortcutsModule = LazyModule("/shortcuts", "Set custom inline keyboard", "bot.modules.shortcuts.shortcuts:ShortcutsModule")
+ScShow = LazyModule("/scshow", "Show Saved Shortcuts", "bot.modules.shortcuts.shortcuts:ScShow")
+CatGPTModule = LazyModule("/catgpt", "Talk to a Cat!", "bot.modules.catgpt.catgpt:CatGPTModule")
+
+ALL_MODULES = [WeatherModule,ShortcutsModule,StartModule,CatGPTModule]
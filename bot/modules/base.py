@@ -1,12 +1,12 @@
-import bot.modules.weather.api.gov_sg as api
 import io
 import json
 import datetime
-import requests
-import random
-import random
-from requests.exceptions import HTTPError
-from bot.helper.templates import render_response_template
+import hashlib
+import shlex
+import functools
+import threading
+import dataclasses
+import cachetools
 
 from telegrambots.wrapper import TelegramBotsClient
 from telegrambots.wrapper.types.api_method import TelegramBotsMethod
@@ -15,20 +15,250 @@ from telegrambots.wrapper.types.objects import *
 
 from bot.core.objects import UserSession
 import bot.core.database as db
-import pickle
-from dataclasses import dataclass, KW_ONLY
-from dataclasses_json import dataclass_json, DataClassJsonMixin
+import bot.core.prefetch as prefetch
+import bot.core.handler as handler
+from bot.core import metrics
+import logging
+from dataclasses import dataclass
 
 
 from telegrambots.wrapper.types.api_method import TelegramBotsMethod
 from telegrambots.wrapper.types.methods import SendMessage, EditMessageText, SendPhoto, EditMessageMedia, EditMessageCaption
 from telegrambots.wrapper.types.objects import InlineKeyboardMarkup, InlineKeyboardButton, InputFile, CallbackQuery, InputMediaPhoto, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegrambots.wrapper.api_response_exception import ApiResponseException
+from telegrambots.wrapper.serializations import serialize
+
+log = logging.getLogger(__name__)
+
+RESPONSE_CACHE_MAXSIZE = 256
+RESPONSE_CACHE_TTL = 60
+
+_RESPONSE_CACHE = cachetools.TTLCache(maxsize=RESPONSE_CACHE_MAXSIZE, ttl=RESPONSE_CACHE_TTL)
+_RESPONSE_CACHE_LOCK = threading.Lock()
+_RESPONSE_CACHE_STATS = {"hits": 0, "misses": 0}
+
+EDIT_TRACKER_MAXSIZE = 4096
+
+# Digest of the last content sent, by (chat_id, message_id)
+_EDIT_TRACKER = cachetools.LRUCache(maxsize=EDIT_TRACKER_MAXSIZE)
+_EDIT_TRACKER_LOCK = threading.Lock()
+_EDIT_TRACKER_STATS = {"hits": 0, "misses": 0}
+
+_ID_FIELDS = ("chat_id", "message_id")
+
+
+def _content_digest(*parts) -> str:
+    """Hash the visible content of a message (text/caption, photo and reply markup)"""
+
+    h = hashlib.blake2b(digest_size=16)
+
+    for p in parts:
+        if p == None:
+            p = b""
+        elif isinstance(p, str):
+            p = p.encode()
+        elif not isinstance(p, bytes):
+            p = json.dumps(serialize(p), sort_keys=True).encode()
+
+        h.update(len(p).to_bytes(8, "little"))
+        h.update(p)
+
+    return h.hexdigest()
+
+
+def edit_tracker_info() -> dict:
+    """Returns skipped (hits) and sent (misses) edits and current size of the edit tracker"""
+
+    with _EDIT_TRACKER_LOCK:
+        return dict(_EDIT_TRACKER_STATS, size=len(_EDIT_TRACKER))
+
+
+def _strip_ids(method: TelegramBotsMethod) -> TelegramBotsMethod:
+    """Return a copy of method without the chat_id / message_id it is addressed to"""
+
+    names = [f.name for f in dataclasses.fields(method)]
+    return dataclasses.replace(method, **{k: None for k in _ID_FIELDS if k in names})
+
+
+def _address(method: TelegramBotsMethod, chat_id, message_id) -> TelegramBotsMethod:
+    """Return a copy of a cached method addressed to chat_id / message_id"""
+
+    names = [f.name for f in dataclasses.fields(method)]
+    ids = {"chat_id": chat_id, "message_id": message_id}
+    return dataclasses.replace(method, **{k: ids[k] for k in _ID_FIELDS if k in names})
+
+
+def response_cache_info() -> dict:
+    """Returns hits, misses and current size of the shared response cache"""
+
+    with _RESPONSE_CACHE_LOCK:
+        return dict(_RESPONSE_CACHE_STATS, size=len(_RESPONSE_CACHE))
+
+
+metrics.register_info("bot_cache", "Hits, misses and size of caches", response_cache_info, cache="response")
+metrics.register_info("bot_cache", "Hits, misses and size of caches", edit_tracker_info, cache="edit_tracker")
+
+
+def cached_response(key=None):
+    """
+    Decorator marking a subcommand response as user independent, so that the finished
+    responses can be shared between all users.
+
+    The cache key is made of the module hook, the subcommand, the parsed args and whether
+    the response edits an existing message. Responses are cached without their chat_id
+    and message_id and readdressed on every hit. Only text responses may be cached,
+    photos are sent as file streams that cannot be reused.
+
+    Parameters
+    ----------
+    key: Callable[[BaseModule], tuple | None], optional
+        returns additional key parts (e.g. upstream update_timestamp). Return None
+        to bypass the cache for the current request.
+    """
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+
+            try:
+                extra = key(self) if key != None else ()
+            except Exception:
+                log.debug("Unable to compute cache key, bypassing response cache", exc_info=True)
+                extra = None
+
+            if extra == None:
+                return await func(self, *args, **kwargs)
+
+            cache_key = (
+                self.hook,
+                func.__name__,
+                tuple(self.args),
+                self.session.message_id == None,
+                tuple(extra)
+            )
+
+            with _RESPONSE_CACHE_LOCK:
+                cached = _RESPONSE_CACHE.get(cache_key)
+                _RESPONSE_CACHE_STATS["hits" if cached != None else "misses"] += 1
+
+            if cached != None:
+                if not prefetch.is_prefetching():
+                    prefetch.consume(cache_key)
+
+                res = []
+                for template, digest in cached:
+                    res += self._track_response(
+                        _address(template, self.session.chat_id, self.session.message_id), digest)
+
+                return res
+
+            res = await func(self, *args, **kwargs)
+
+            if self._response_cacheable:
+                with _RESPONSE_CACHE_LOCK:
+                    _RESPONSE_CACHE[cache_key] = [(_strip_ids(r), self._digests.get(id(r))) for r in res]
+
+                if prefetch.is_prefetching():
+                    prefetch.mark_warmed(cache_key)
+
+            return res
+
+        return wrapper
+
+    return decorator
+
+
+# Parsing of the command text into args
+_PARSERS = {
+    # whitespace separated
+    "split": str.split,
+    # quoted arguments, e.g. add "NAME" "/COMMAND ..."
+    "shlex": shlex.split,
+    # single space separated, newlines are kept in the arguments (e.g. prompts)
+    "space": lambda text: text.split(" "),
+}
+
+
+@dataclass(frozen=True)
+class Subcommand:
+    """
+    Declaration of a subcommand, see subcommand()
+    """
+
+    name: str | None
+    func: object
+    min_args: int = 0
+    max_args: int | None = None
+    parse: str = "split"
+    listen: bool = False
+
+    def accepts(self, argc: int) -> bool:
+        """True if argc (including hook and subcommand) is within the declared arity"""
+
+        n = argc - (1 if self.name == None else 2)
+        return n >= self.min_args and (self.max_args == None or n <= self.max_args)
+
+
+def subcommand(name: str = None, *, min_args: int = 0, max_args: int = None, parse: str = "split", listen: bool = False):
+    """
+    Decorator registering a response method as the handler of a subcommand (args[1]).
+    The dispatch table of a module is built once when the class is created.
+
+    Parameters
+    ----------
+    name: str, optional
+        subcommand, None for the hook itself (e.g. "/weathersg" without arguments).
+        The hook handler also receives commands with an unknown subcommand if its
+        arity allows them.
+
+    min_args, max_args: int, optional
+        number of arguments after the subcommand, max_args None for no limit
+
+    parse: str, optional
+        "split" (whitespace), "shlex" (quoted arguments) or "space" (newlines kept)
+
+    listen: bool, optional
+        the session listens for additional arguments of the subcommand after the response
+    """
+
+    if parse not in _PARSERS:
+        raise ValueError(f"Unknown parse mode: '{parse}'")
+
+    def decorator(func):
+        func._subcommand = Subcommand(name, func, min_args, max_args, parse, listen)
+        return func
+
+    return decorator
 
 
 class BaseModule:
     hook = "/base"
     description = "Base Module Object"
 
+    # subcommands (args[1]) without side effects that may be run ahead of a tap
+    prefetch_safe: tuple[str] = ()
+
+    # subcommands (args[1], None for the hook) that may be run in a macro. Their responses
+    # must be returned, not sent through self.client (see handler.async_collect_request)
+    collectable: tuple[str | None] = ()
+
+    # subcommand name (None for the hook) -> Subcommand, built by __init_subclass__
+    _subcommands: dict[str | None, Subcommand] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+
+        table = {}
+        for klass in reversed(cls.__mro__):
+            for attr in vars(klass).values():
+                spec = getattr(attr, "_subcommand", None)
+
+                if isinstance(spec, Subcommand):
+                    table[spec.name] = spec
+
+        cls._subcommands = table
+
     def __init__(self,*args, **kwargs) -> None:
         
         assert kwargs["text"].startswith(self.hook)  # Sanity check
@@ -40,6 +270,12 @@ class BaseModule:
         self.session: UserSession = kwargs["session"]
         self.client: TelegramBotsClient = kwargs["client"]
 
+        # Set to False by responses that must not be shared (e.g. errors)
+        self._response_cacheable = True
+
+        # Content digest of pending responses, by id(response)
+        self._digests = {}
+
         if isinstance(self.tg_obj, CallbackQuery):
             self.session.message_id = self.tg_obj.message.message_id
 
@@ -110,9 +346,10 @@ class BaseModule:
                 **kwargs
             )
 
-        return [response]
+        return self._track_response(response, _content_digest(text, reply_markup))
 
     async def _exception_response(self, text: str,reply_markup: InlineKeyboardMarkup | ReplyKeyboardMarkup | ReplyKeyboardRemove = None, print_label=True, args: list[str] = None, chat_id: int | str = None, message_id: int | str = None,**kwargs) -> list[TelegramBotsMethod]:
+        self._response_cacheable = False
         text = f"{text}\n\nts:{datetime.datetime.now()}"
 
         if args != None and len(args) > 1:
@@ -150,12 +387,133 @@ class BaseModule:
         #     else:
         #         reply_markup.inline_keyboard.append([back_button])
 
+        digest = _content_digest(photo, caption, reply_markup)
+
+        if message_id != None:
+            response = EditMessageMedia(InputMediaPhoto(
+                file, caption=caption), chat_id, message_id, reply_markup=reply_markup)
+
+        else:
+            response = SendPhoto(chat_id, file, caption=caption, reply_markup=reply_markup)
+
+        return self._track_response(response, digest)
+
+    def _track_response(self, response: TelegramBotsMethod, digest: str = None) -> list[TelegramBotsMethod]:
+        """
+        Replace an edit by an "already up to date" answer if the message already shows the
+        same content. Otherwise the digest is recorded once the response has been sent.
+        """
+
+        if digest == None:
+            return [response]
+
+        message_id = getattr(response, "message_id", None)
+
         if message_id != None:
+            with _EDIT_TRACKER_LOCK:
+                unchanged = _EDIT_TRACKER.get((response.chat_id, message_id)) == digest
+                _EDIT_TRACKER_STATS["hits" if unchanged else "misses"] += 1
 
-            return [
-                EditMessageMedia(InputMediaPhoto(
-                    file, caption=caption), chat_id, message_id, reply_markup=reply_markup)
-            ]
+            if unchanged:
+                log.debug("Content unchanged, edit skipped for chat:%s, message:%s", response.chat_id, message_id)
+                self._response_cacheable = False
 
+                if isinstance(self.tg_obj, CallbackQuery):
+                    return [AnswerCallbackQuery(self.tg_obj.id, text="Already up to date")]
+
+                return []
+
+        self._digests[id(response)] = digest
+        return [response]
+
+    async def _send_responses(self, res: list[TelegramBotsMethod]) -> None:
+        """
+        Send the responses and record the content of sent messages. CallbackQuery are
+        answered first, with the answer of the responses if any, unless the handler already
+        answered them (responses not ready within BOT_CALLBACK_ANSWER_MS).
+        """
+
+        if isinstance(self.tg_obj, CallbackQuery):
+            answers = [r for r in res if isinstance(r, AnswerCallbackQuery)]
+            res = [r for r in res if not isinstance(r, AnswerCallbackQuery)]
+
+            if handler.claim_callback_answer():
+                res = (answers[:1] or [AnswerCallbackQuery(self.tg_obj.id)]) + res
+
+        async with self.client as client:
+            for r in res:
+                try:
+                    result = await client(r)
+
+                except ApiResponseException as e:
+                    if e.error_code == 400 and "message is not modified" in e.description:
+                        log.debug("Message is not modified, edit skipped")
+                        continue
+
+                    raise
+
+                digest = self._digests.pop(id(r), None)
+                message_id = getattr(r, "message_id", None)
+
+                if message_id == None and isinstance(result, Message):
+                    message_id = result.message_id
+
+                if digest != None and message_id != None and not prefetch.is_prefetching():
+                    with _EDIT_TRACKER_LOCK:
+                        _EDIT_TRACKER[(r.chat_id, message_id)] = digest
+
+        # the next tap is likely one of the buttons sent
+        commands = [
+            button.callback_data
+            for r in res if isinstance(getattr(r, "reply_markup", None), InlineKeyboardMarkup)
+            for row in r.reply_markup.inline_keyboard for button in row
+        ]
+
+        if commands != []:
+            tg_obj = self.tg_obj.message if isinstance(self.tg_obj, CallbackQuery) else self.tg_obj
+            prefetch.schedule(tg_obj, self.session.user_id, self.session.chat_id, commands)
+
+    @classmethod
+    async def handle_request(cls, **kwargs) -> None:
+        """
+        Dispatch a command to the registered subcommand and send the responses
+
+        Args (required):
+            **text: command text
+            **args: command split on whitespace
+            **tg_obj: Message / CallbackQuery
+            **session: UserSession
+            **client: TelegramBotsClient
+        """
+
+        args = kwargs["args"]
+        spec = cls._subcommands.get(args[1]) if len(args) > 1 else None
+
+        if spec == None:
+            spec = cls._subcommands.get(None)
+
+        if spec == None:
+            slf = cls(*args, **kwargs)
+            await slf.session.async_update_state(args, False)
+            return await slf._send_responses(await slf._exception_response(f"Invalid arguments: {list(args[1:])}"))
+
+        args = _PARSERS[spec.parse](kwargs["text"])
+        slf = cls(*args, **kwargs)
+
+        if spec.listen:
+            await slf.session.async_update_state(args[0:1 if spec.name == None else 2], True)
         else:
-            return [SendPhoto(chat_id, file, caption=caption, reply_markup=reply_markup)]
+            await slf.session.async_update_state(args, False)
+
+        if spec.accepts(len(args)):
+            res = await spec.func(slf)
+
+        elif spec.name == None and len(args) > 1:
+            res = await slf._exception_response(f"Invalid arguments: {list(args[1:])}")
+
+        else:
+            expected = spec.min_args if spec.max_args == spec.min_args else f"{spec.min_args} to {spec.max_args if spec.max_args != None else 'any'}"
+            res = await slf._exception_response(
+                f"Too many/few arguments for '{spec.name}': expected {expected}, got {len(args) - 2}", args=args[0:1])
+
+        await slf._send_responses(res)
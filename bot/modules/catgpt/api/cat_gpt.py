@@ -0,0 +1,155 @@
+"""
+Async client for the cat-gpt.com conversation api.
+
+All calls share one connection pool in a background event loop and are limited by a
+global and a per user concurrency cap. Each call is bound by a deadline that includes
+the time spent waiting for a slot and retries.
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_CATGPT_API_URL:
+    Base url of the api, defaults "https://cat-gpt.com"
+
+BOT_CATGPT_TIMEOUT:
+    Deadline (s) of a conversation call, defaults 30
+
+BOT_CATGPT_MAX_CONCURRENCY:
+    Maximum concurrent calls to the api, defaults 8
+
+BOT_CATGPT_MAX_CONCURRENCY_PER_USER:
+    Maximum concurrent calls to the api per user, defaults 1
+
+BOT_CATGPT_RETRIES:
+    Maximum retries of a call that was not processed by the api, defaults 2
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+
+import aiohttp
+import requests
+
+from bot.helper.aio import get_background_loop
+from bot.core import metrics, tracing
+
+log = logging.getLogger(__name__)
+
+API_URL = os.getenv("BOT_CATGPT_API_URL", "https://cat-gpt.com").rstrip("/")
+TIMEOUT = float(os.getenv("BOT_CATGPT_TIMEOUT", 30))
+MAX_CONCURRENCY = int(os.getenv("BOT_CATGPT_MAX_CONCURRENCY", 8))
+MAX_CONCURRENCY_PER_USER = int(os.getenv("BOT_CATGPT_MAX_CONCURRENCY_PER_USER", 1))
+RETRIES = int(os.getenv("BOT_CATGPT_RETRIES", 2))
+
+# The conversation call is not idempotent, only retry when the request was not processed
+RETRY_STATUS = (429, 503)
+
+# Only accessed from the background loop
+_SESSION: aiohttp.ClientSession = None
+_SEMAPHORE: asyncio.Semaphore = None
+_USER_SEMAPHORES: dict[int | str, list] = {}
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _SESSION
+    global _SEMAPHORE
+
+    if _SESSION == None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONCURRENCY, keepalive_timeout=60)
+        )
+        _SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    return _SESSION
+
+
+async def _put(session: aiohttp.ClientSession, payload: dict, headers: dict) -> str:
+    """Single PUT request, returns the message content"""
+
+    start = time.perf_counter()
+    result = "error"
+
+    try:
+        async with session.put(f"{API_URL}/api/conversation", json=payload, headers=headers) as r:
+            result = str(r.status)
+
+            if r.status >= 400:
+                e = requests.HTTPError(f"{r.status} {r.reason}")
+                e.status = r.status
+                e.retry_after = r.headers.get("Retry-After")
+                raise e
+
+            return (await r.json())["data"]["message"]["content"]
+
+    finally:
+        metrics.UPSTREAM_DURATION.labels("cat_gpt", "conversation").observe(time.perf_counter() - start)
+        metrics.UPSTREAM_REQUESTS.labels("cat_gpt", "conversation", result).inc()
+
+
+async def _conversation(payload: dict, headers: dict, user_id: int | str) -> str:
+    session = _get_session()
+
+    # [semaphore, number of waiting or running calls]
+    user_semaphore = _USER_SEMAPHORES.setdefault(user_id, [asyncio.Semaphore(MAX_CONCURRENCY_PER_USER), 0])
+    user_semaphore[1] += 1
+
+    try:
+        async with user_semaphore[0], _SEMAPHORE:
+            for attempt in range(RETRIES + 1):
+                try:
+                    return await _put(session, payload, headers)
+
+                except aiohttp.ClientConnectorError as e:
+                    if attempt == RETRIES:
+                        raise requests.ConnectionError(e)
+
+                    delay = 0.5 * 2 ** attempt
+
+                except requests.HTTPError as e:
+                    if getattr(e, "status", None) not in RETRY_STATUS or attempt == RETRIES:
+                        raise
+
+                    retry_after = e.retry_after
+                    delay = float(retry_after) if retry_after != None and retry_after.isdigit() else 0.5 * 2 ** attempt
+
+                log.info("cat-gpt api call not processed, retrying in %.1fs", delay)
+                await asyncio.sleep(delay * random.uniform(1, 1.5))
+
+    finally:
+        user_semaphore[1] -= 1
+        if user_semaphore[1] == 0:
+            del _USER_SEMAPHORES[user_id]
+
+
+async def async_conversation(payload: dict, headers: dict, user_id: int | str, timeout: float = None) -> str:
+    """
+    Send a conversation request to the api.
+
+    Args:
+        payload: request body
+        headers: request headers (Authorization)
+        user_id: telegram user id, used for the per user concurrency cap
+        timeout: deadline (s) of the call, defaults BOT_CATGPT_TIMEOUT
+
+    Returns:
+        message content (str)
+
+    Raises:
+        requests.HTTPError: API error
+        requests.ConnectionError: API unreachable
+        asyncio.TimeoutError: deadline exceeded
+    """
+
+    timeout = TIMEOUT if timeout == None else timeout
+
+    try:
+        # the call runs in the background loop, outside of the trace of the update
+        with tracing.span("cat_gpt.conversation"):
+            return await get_background_loop().run(
+                asyncio.wait_for(_conversation(payload, headers, user_id), timeout)
+            )
+
+    except asyncio.TimeoutError:
+        raise asyncio.TimeoutError(f"No response from cat-gpt within {timeout}s")
@@ -1,9 +1,16 @@
-import bot.modules.weather.api.gov_sg as api
+import bot.modules.catgpt.api.cat_gpt as api
+import bot.modules.catgpt.gif_pool as gif_pool
 import io
 import os
+import math
+import time
 import yaml
 import json
+import asyncio
+import logging
 import datetime
+import threading
+import cachetools
 import requests
 import random
 import random
@@ -16,22 +23,64 @@ from telegrambots.wrapper.types.api_method import TelegramBotsMethod
 from telegrambots.wrapper.types.methods import *
 from telegrambots.wrapper.types.objects import *
 
-from ..base import BaseModule
+from ..base import BaseModule, cached_response, subcommand
 from bot.core.objects import UserSession
 import bot.core.database as db
+import bot.core.server
+from bot.core import metrics
 
 import pickle
-from dataclasses import dataclass, KW_ONLY
-from dataclasses_json import dataclass_json, DataClassJsonMixin
+from dataclasses import dataclass
+
+from telegrambots.wrapper.types.api_method import TelegramBotsMethodNoOutput
+from telegrambots.wrapper.api_response_exception import ApiResponseException
+
+log = logging.getLogger(__name__)
 
 CATGPT_AUTH = os.getenv('BOT_CATGPT_AUTH')
 CATGPT_EMAIL = os.getenv('BOT_CATGPT_EMAIL')
 
+STREAM_INTERVAL = int(os.getenv('BOT_CATGPT_STREAM_INTERVAL_MS', 700)) / 1000
+STREAM_DURATION = float(os.getenv('BOT_CATGPT_STREAM_DURATION', 6))
+
+SETTINGS_CACHE_MAXSIZE = 1024
+
+# user_id -> CatGPTSettings, write-through
+_SETTINGS_CACHE = cachetools.LRUCache(maxsize=SETTINGS_CACHE_MAXSIZE)
+_SETTINGS_LOCK = threading.Lock()
+
+# (chat_id, user_id) -> (loop, task) of the reply being fetched or streamed
+_GENERATIONS = {}
+_GENERATIONS_LOCK = threading.Lock()
+_CANCELLED_STATS = {"fetch": 0, "stream": 0}
+
+# chat_id -> time of the last scheduled edit
+_STREAM_LAST_EDIT = cachetools.TTLCache(maxsize=4096, ttl=60)
+_STREAM_LOCK = threading.Lock()
+
+
+def catgpt_cancellation_info() -> dict:
+    """Returns number of replies cancelled while fetching / streaming"""
+
+    with _GENERATIONS_LOCK:
+        return dict(_CANCELLED_STATS)
+
+
+metrics.register_info("bot_catgpt_cancelled", "/catgpt replies cancelled while fetching / streaming", catgpt_cancellation_info)
+
+
+class _SendChatAction(SendChatAction):
+    """SendChatAction of telegrambots==0.0.13rc0 cannot be created (NameError in __new__)"""
+
+    def __new__(cls, *args, **kwargs):
+        obj = object.__new__(cls)
+        TelegramBotsMethodNoOutput.__init__(obj, "sendChatAction")
+        return obj
+
 
-@dataclass
-class CatGPTSettings(DataClassJsonMixin):
+@dataclass(slots=True, kw_only=True)
+class CatGPTSettings:
 
-    _: KW_ONLY
     send_gif: bool = True
 
     # Required for AI
@@ -42,7 +91,47 @@ class CatGPTSettings(DataClassJsonMixin):
     threadId: str | int = None
     isNewThread: bool = None
 
+    def to_dict(self) -> dict:
+        return {
+            "send_gif": self.send_gif,
+            "email": self.email,
+            "Authorization": self.Authorization,
+            "threadId": self.threadId,
+            "isNewThread": self.isNewThread
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    def copy(self) -> "CatGPTSettings":
+        return CatGPTSettings(
+            send_gif=self.send_gif,
+            email=self.email,
+            Authorization=self.Authorization,
+            threadId=self.threadId,
+            isNewThread=self.isNewThread
+        )
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "CatGPTSettings":
+        if not isinstance(d, dict):
+            raise ValueError(f"Expected a mapping of settings, got {type(d).__name__}")
+
+        return cls(
+            send_gif=d.get("send_gif", True),
+            email=d.get("email"),
+            Authorization=d.get("Authorization"),
+            threadId=d.get("threadId"),
+            isNewThread=d.get("isNewThread")
+        )
+
+    @classmethod
+    def from_json(cls, s: str) -> "CatGPTSettings":
+        return cls.from_dict(json.loads(s))
+
     async def async_update_db(self, user_id):
+        """Write the whole settings to database and cache"""
+
         db.execute_and_commit(
             """
             INSERT INTO CatGPT
@@ -57,47 +146,226 @@ class CatGPTSettings(DataClassJsonMixin):
             }
         )
 
+        with _SETTINGS_LOCK:
+            _SETTINGS_CACHE[user_id] = self.copy()
+
+    async def async_update_fields(self, user_id, **fields):
+        """Set fields, only the given fields are rewritten in the stored json"""
+
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+        paths = ", ".join(f"'$.{name}', json(:{name})" for name in fields)
+
+        db.execute_and_commit(
+            f"""
+            INSERT INTO CatGPT
+            VALUES(:user_id,:settings_json)
+            ON CONFLICT(user_id)
+            DO UPDATE SET settings_json=json_set(settings_json, {paths})
+            WHERE user_id = :user_id
+            """,
+            {
+                "user_id": user_id,
+                "settings_json": self.to_json(),
+                **{name: json.dumps(value) for name, value in fields.items()}
+            }
+        )
+
+        with _SETTINGS_LOCK:
+            cached = _SETTINGS_CACHE.get(user_id)
+
+            if cached != None:
+                for name, value in fields.items():
+                    setattr(cached, name, value)
+
     @classmethod
     async def async_load_from_db(cls, user_id):
         return cls.load_from_db(user_id)
     
     @classmethod
     def load_from_db(cls, user_id):
-        query = db.execute(
-            "SELECT settings_json FROM CatGPT WHERE user_id = ?", (user_id,))
+        """Returns a copy of the user settings, only read from database on a cache miss"""
 
-        if len(query) == 1:
-            return cls.from_json(query[0][0])
-        else:
-            return cls()
+        with _SETTINGS_LOCK:
+            cached = _SETTINGS_CACHE.get(user_id)
+
+        if cached == None:
+            query = db.execute(
+                "SELECT settings_json FROM CatGPT WHERE user_id = ?", (user_id,))
+
+            cached = cls.from_json(query[0][0]) if len(query) == 1 else cls()
+
+            with _SETTINGS_LOCK:
+                _SETTINGS_CACHE[user_id] = cached
+
+        return cached.copy()
     
 
 class CatGPTModule(BaseModule):
     hook = "/catgpt"
     description = "Talk to a Cat!"
 
+    # replies are streamed through the client
+    collectable = (None, "help")
+
     def __init__(self,*args, **kwargs) -> None:
         super().__init__(*args,**kwargs)
         self.settings = CatGPTSettings.load_from_db(self.session.user_id)
 
+        # Stage of the reply being generated: "fetch" or "stream"
+        self._catgpt_stage = "fetch"
+
+
+    async def _catgpt_generation(self, coro):
+        """
+        Run the fetch and stream of a reply. A previous reply of the same user in the chat
+        that is still being fetched or streamed is cancelled.
+        """
+
+        key = (self.session.chat_id, self.session.user_id)
+        task = asyncio.ensure_future(coro)
+        loop = asyncio.get_running_loop()
+
+        with _GENERATIONS_LOCK:
+            previous = _GENERATIONS.get(key)
+            _GENERATIONS[key] = (loop, task)
+
+        if previous != None:
+            previous[0].call_soon_threadsafe(previous[1].cancel)
+
+        try:
+            return await task
+
+        except asyncio.CancelledError:
+            with _GENERATIONS_LOCK:
+                superseded = _GENERATIONS.get(key) != (loop, task)
+
+            # cancelled from outside (e.g. shutdown, timeout) and not by a newer reply
+            if not superseded:
+                raise
+
+            log.info("Reply superseded during %s, user:%s, chat:%s", self._catgpt_stage, self.session.user_id, self.session.chat_id)
+
+            with _GENERATIONS_LOCK:
+                _CANCELLED_STATS[self._catgpt_stage] += 1
 
-    async def _catgpt_split_send_response(self, text: str, gif=None):
-        "Send responses in a AI like way with delay"
+            return []
 
-        text_list = text.split(" ")
+        finally:
+            with _GENERATIONS_LOCK:
+                if _GENERATIONS.get(key) == (loop, task):
+                    del _GENERATIONS[key]
+
+    def _catgpt_stream_reserve(self) -> float:
+        """
+        Reserve the next edit of the chat (at most one every STREAM_INTERVAL, shared by all
+        the replies streamed in the chat), returns its time.monotonic() send time
+        """
+
+        chat_id = self.session.chat_id
+
+        with _STREAM_LOCK:
+            send_at = max(time.monotonic(), _STREAM_LAST_EDIT.get(chat_id, 0) + STREAM_INTERVAL)
+            _STREAM_LAST_EDIT[chat_id] = send_at
+
+        return send_at
+
+    async def _catgpt_stream_response(self, text: str, gif=None):
+        """
+        Reveal the response in a AI like way. Edits are throttled per chat and the chunk
+        size adapts to the remaining words and the edits left before the deadline, so that
+        streaming ends within STREAM_DURATION even if other replies stream in the chat
+        """
+
+        words = text.split(" ")
         chat_id = self.session.chat_id
 
         async with self.client:
             if self.settings.send_gif == True and gif != None:
-                msg_obj: Message = await self.client(SendDocument(chat_id, gif))    
-                return [EditMessageCaption(msg_obj.chat.id, msg_obj.message_id, caption=" ".join(text_list[0:i+1])) for i in range(len(text_list))]
-            
+                msg_obj: Message = await self._catgpt_send_gif(gif)
+                shown = 0
+                edit = lambda t: EditMessageCaption(msg_obj.chat.id, msg_obj.message_id, caption=t)
+
             else:
-                msg_obj: Message = await self.client(SendMessage(chat_id, text_list[0]))
-                return [EditMessageText(" ".join(text_list[0:i+2]), msg_obj.chat.id, msg_obj.message_id) for i in range(len(text_list)-1)]
+                msg_obj: Message = await self.client(SendMessage(chat_id, words[0]))
+                shown = 1
+                edit = lambda t: EditMessageText(t, msg_obj.chat.id, msg_obj.message_id)
+
+            self._catgpt_stage = "stream"
+
+            try:
+                deadline = time.monotonic() + STREAM_DURATION
+                last_send_at = None
+
+                while shown < len(words):
+                    send_at = self._catgpt_stream_reserve()
+
+                    # spacing of the edits of this reply, larger if other replies share the chat
+                    spacing = max(STREAM_INTERVAL, send_at - last_send_at if last_send_at != None else STREAM_INTERVAL)
+                    edits_left = 1 + max(0, int((deadline - send_at) / spacing))
+                    last_send_at = send_at
+
+                    await asyncio.sleep(max(0, send_at - time.monotonic()))
+
+                    next_shown = shown + math.ceil((len(words) - shown) / edits_left)
+                    await self.client(edit(" ".join(words[0:next_shown])))
+                    shown = next_shown
+
+            except asyncio.CancelledError:
+                # Superseded by a new prompt, leave the partial reply marked as interrupted
+                await self.client(edit(" ".join(words[0:shown] + ["…"])))
+                raise
+
+        if self.settings.send_gif == True and gif != None:
+            gif_pool.schedule_refresh(bot.core.server.BOT_TOKEN)
+
+        return []
+
+    async def _catgpt_send_gif(self, gif: str) -> Message:
+        """Send a GIF by pooled file_id or url, file_id of new GIFs are added to the pool"""
+
+        chat_id = self.session.chat_id
+
+        if gif_pool.is_file_id(gif):
+            try:
+                return await self.client(SendAnimation(chat_id, gif))
+
+            except ApiResponseException as e:
+                log.warning("Pooled GIF can not be sent, removed from pool: %s", e)
+                gif_pool.discard(gif)
+                gif = gif_pool.get()
+
+                if gif_pool.is_file_id(gif):
+                    return await self.client(SendAnimation(chat_id, gif))
+
+        msg_obj: Message = await self.client(SendAnimation(chat_id, gif))
+        gif_pool.add(gif_pool.file_id_of(msg_obj))
+
+        return msg_obj
+
+    async def _catgpt_while_typing(self, coro):
+        """Await coro while showing a typing indicator in the chat"""
+
+        async def typing():
+            while True:
+                try:
+                    await self.client(_SendChatAction(self.session.chat_id, "typing"))
+                except Exception:
+                    log.debug("Unable to send chat action", exc_info=True)
+
+                # Telegram shows the indicator for 5s
+                await asyncio.sleep(4)
+
+        task = asyncio.create_task(typing())
+
+        try:
+            return await coro
+        finally:
+            task.cancel()
 
     async def _catgpt_meow_fetch_api(self):
-        return f"https://www.cat-gpt.com/cats/gif?{datetime.datetime.now().microsecond}", "CAT:" + " meow" * random.randint(1, 10)
+        return gif_pool.get(), "CAT:" + " meow" * random.randint(1, 10)
 
     async def _catgpt_meow_response(self):
         if self.argc <= 3:
@@ -105,10 +373,13 @@ class CatGPTModule(BaseModule):
             return await self._text_response("CAT: Meow?")
 
         else:
-            gif, text = await self._catgpt_meow_fetch_api()
+            # Keep listening while the reply is generated, a new prompt supersedes it
             await self.session.async_update_state(self.args[0:3], True)
+            return await self._catgpt_generation(self._catgpt_meow_generate())
 
-            return await self._catgpt_split_send_response(text, gif)
+    async def _catgpt_meow_generate(self):
+        gif, text = await self._catgpt_meow_fetch_api()
+        return await self._catgpt_stream_response(text, gif)
 
     async def _catgpt_ai_fetch_api(self, prompt: str):
         
@@ -126,29 +397,21 @@ class CatGPTModule(BaseModule):
             }
 
         if self.settings.isNewThread == True:
-            payload = json.dumps(
-                {"userPrompt": "", "email": email, "threadId": self.settings.threadId, "userRequests": [
+            payload = {"userPrompt": "", "email": email, "threadId": self.settings.threadId, "userRequests": [
                     {"role": "system", "content": "Respond to whatever I say here as if you’re a sassy cat that cares about me but doesn’t want me to know, and you want to be helpful but you want me to want you to be helpful. Make sure to sprinkle in some meows every now and then, especially when replacing words like now and how."},
                     {"role": "user", "content": str(self.settings.threadId) + " " + prompt}], "isNewThread": True
                  }
-            )
 
-            self.settings.isNewThread = False
-            await self.settings.async_update_db(self.session.user_id)
+            await self.settings.async_update_fields(self.session.user_id, isNewThread=False)
 
         else:
-            payload = json.dumps(
-                {"userPrompt": "", "email": email, "threadId": str(self.settings.threadId), "userRequests": [{"role": "user", "content": prompt}], "isNewThread": False})
-        
-        try:
-            re = requests.put("https://cat-gpt.com/api/conversation",data=payload, headers=headers)
-            re.raise_for_status()
-            text = "CAT:" + re.json()["data"]["message"]["content"]
-        
-        except Exception as e:
-            raise HTTPError(e)
+            payload = {"userPrompt": "", "email": email, "threadId": str(self.settings.threadId), "userRequests": [{"role": "user", "content": prompt}], "isNewThread": False}
 
-        return f"https://www.cat-gpt.com/cats/gif?{datetime.datetime.now().microsecond}", text
+        async with self.client:
+            text = "CAT:" + await self._catgpt_while_typing(
+                api.async_conversation(payload, headers, self.session.user_id))
+
+        return gif_pool.get(), text
 
     async def _catgpt_ai_session(self):
         if (CATGPT_EMAIL == None or CATGPT_AUTH == None) and (self.settings.email == None or self.settings.Authorization == None):
@@ -179,9 +442,7 @@ class CatGPTModule(BaseModule):
             else:
                 thread_id = str(random.randint(1, 9000000000000000))
 
-                self.settings.threadId = thread_id
-                self.settings.isNewThread = True
-                await self.settings.async_update_db(self.session.user_id)
+                await self.settings.async_update_fields(self.session.user_id, threadId=thread_id, isNewThread=True)
 
             self.args = self.args[0:3] + (thread_id,)
 
@@ -199,17 +460,20 @@ class CatGPTModule(BaseModule):
         
         self.args = self.args[0:4]
 
+        # Keep listening while the reply is generated, a new prompt supersedes it
+        await self.session.async_update_state(self.args, True)
+        return await self._catgpt_generation(self._catgpt_ai_generate(prompt))
+
+    async def _catgpt_ai_generate(self, prompt: str):
         try:
             gif, text = await self._catgpt_ai_fetch_api(prompt)
             
         except Exception as e:
-            await self.session.async_update_state(self.args, True)
             return await self._exception_response("API Error\n\n" + str(e))
 
-        await self.session.async_update_state(self.args, True)
-
-        return await self._catgpt_split_send_response(text, gif)
+        return await self._catgpt_stream_response(text, gif)
 
+    @subcommand("chat", parse="space")
     async def _catgpt_chat_response(self):
         assert self.args[1] == "chat"
 
@@ -231,6 +495,7 @@ class CatGPTModule(BaseModule):
         elif self.args[2] == "ai":
             return await self._catgpt_ai_response()
 
+    @subcommand("settings", parse="space")
     async def _catgpt_settings_response(self):
         assert self.args[1] == "settings"
         
@@ -258,6 +523,8 @@ class CatGPTModule(BaseModule):
         else:
             return await self._exception_response("Too many arguments expected 3")
 
+    @subcommand("help", max_args=0)
+    @cached_response()
     async def _catgpt_help_response(self):
         assert (self.args[1] == "help")
         msg = render_response_template(
@@ -265,6 +532,7 @@ class CatGPTModule(BaseModule):
 
         return await self._text_response(msg)
 
+    @subcommand(max_args=0)
     async def _catgpt_hook_response(self):
         reply_markup = InlineKeyboardMarkup(
             [
@@ -280,29 +548,3 @@ class CatGPTModule(BaseModule):
         )
 
         return await self._text_response(f"Select an option", reply_markup)
-
-    @classmethod
-    async def handle_request(cls, **kwargs) -> list[TelegramBotsMethod]:
-        args = kwargs['text'].split(" ")
-
-        slf = cls(*args, **kwargs)
-        await slf.session.async_update_state(args,False)
-
-        if slf.argc == 1:
-            res =  await slf._catgpt_hook_response()
-
-        elif slf.args[1] == "settings":
-            res =  await slf._catgpt_settings_response()
-
-        elif slf.args[1] == "chat":
-            res =  await slf._catgpt_chat_response()
-        
-        elif slf.args[1] == "help":
-            res=  await slf._help_response()
-        
-        else:
-            res = await slf._exception_response(f"Invalid Argument: '{slf.args[1]}'")
-
-        async with slf.client as client:
-            for r in res:
-                await client(r)
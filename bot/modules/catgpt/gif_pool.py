@@ -0,0 +1,210 @@
+"""
+Pool of cat GIFs already uploaded to telegram.
+
+Replies reuse the telegram file_id of a GIF from the pool, so that the first message is
+sent immediately instead of waiting for telegram to download a new GIF from cat-gpt.com.
+If BOT_CATGPT_GIF_CHAT_ID is set, the pool is filled at startup (see setup()) and refreshed
+in the background by uploading new GIFs to that chat. Otherwise there is no chat to upload
+to and the pool is only filled by the replies themselves, a reply uploads a new GIF with a
+probability proportional to the free space in the pool. The pool is kept in the database
+across restarts.
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_CATGPT_GIF_URL:
+    Url of a random cat GIF, defaults "https://www.cat-gpt.com/cats/gif"
+
+BOT_CATGPT_GIF_POOL_SIZE:
+    Maximum number of GIFs in the pool, defaults 50
+
+BOT_CATGPT_GIF_CHAT_ID:
+    Chat used to upload new GIFs in the background, optional
+
+BOT_CATGPT_GIF_REFRESH:
+    Interval (s) between background refreshes of the pool, defaults 3600
+"""
+
+import os
+import time
+import asyncio
+import random
+import datetime
+import threading
+import logging
+
+from telegrambots.wrapper.types.methods import SendAnimation, DeleteMessage
+from telegrambots.wrapper.types.objects import Message
+
+import bot.core.database as db
+from bot.core import metrics
+from bot.core.objects import MeteredClient
+from bot.helper.aio import get_background_loop
+
+log = logging.getLogger(__name__)
+
+GIF_URL = os.getenv("BOT_CATGPT_GIF_URL", "https://www.cat-gpt.com/cats/gif")
+POOL_SIZE = int(os.getenv("BOT_CATGPT_GIF_POOL_SIZE", 50))
+WARMUP_CHAT_ID = os.getenv("BOT_CATGPT_GIF_CHAT_ID")
+REFRESH_INTERVAL = float(os.getenv("BOT_CATGPT_GIF_REFRESH", 3600))
+
+# GIFs uploaded per background refresh
+REFRESH_BATCH = 5
+
+# file_id, oldest first. None until loaded from database
+_POOL: list[str] = None
+_POOL_LOCK = threading.Lock()
+
+# Interval (s) between checks whether a background refresh is due
+REFRESH_CHECK_INTERVAL = 60
+
+_REFRESH = {"running": False, "last": float("-inf")}
+_STATS = {"pooled": 0, "uploaded": 0}
+
+
+def _load() -> list[str]:
+    global _POOL
+
+    if _POOL == None:
+        _POOL = [r[0] for r in db.execute("SELECT file_id FROM CatGPTGifs ORDER BY added")]
+
+    return _POOL
+
+
+def is_file_id(gif: str) -> bool:
+    return not gif.startswith(("http://", "https://"))
+
+
+def get() -> str:
+    """Returns the file_id of a random GIF from the pool, or a new GIF url to be uploaded"""
+
+    with _POOL_LOCK:
+        pool = _load()
+
+        refill = WARMUP_CHAT_ID == None and random.random() < (POOL_SIZE - len(pool)) / POOL_SIZE
+
+        if len(pool) > 0 and not refill:
+            _STATS["pooled"] += 1
+            return random.choice(pool)
+
+        _STATS["uploaded"] += 1
+
+    return f"{GIF_URL}?{datetime.datetime.now().microsecond}"
+
+
+def file_id_of(msg_obj: Message) -> str:
+    """Returns the file_id of a sent GIF"""
+
+    if msg_obj.animation != None:
+        return msg_obj.animation.file_id
+
+    if msg_obj.document != None:
+        return msg_obj.document.file_id
+
+    return None
+
+
+def add(file_id: str) -> None:
+    """Add a GIF to the pool, the oldest GIF is removed if the pool is full"""
+
+    if file_id == None:
+        return
+
+    with _POOL_LOCK:
+        pool = _load()
+
+        if file_id in pool:
+            return
+
+        pool.append(file_id)
+        removed = pool[:-POOL_SIZE] if len(pool) > POOL_SIZE else []
+        del pool[:len(removed)]
+
+    db.execute_and_commit(
+        "INSERT OR IGNORE INTO CatGPTGifs VALUES(?, ?)", (file_id, time.time()))
+
+    for r in removed:
+        db.execute_and_commit("DELETE FROM CatGPTGifs WHERE file_id = ?", (r,))
+
+
+def discard(file_id: str) -> None:
+    """Remove a GIF that can no longer be sent"""
+
+    with _POOL_LOCK:
+        pool = _load()
+
+        if file_id in pool:
+            pool.remove(file_id)
+
+    db.execute_and_commit("DELETE FROM CatGPTGifs WHERE file_id = ?", (file_id,))
+
+
+def pool_info() -> dict:
+    """Returns size of the pool and number of replies sent with a pooled / uploaded GIF"""
+
+    with _POOL_LOCK:
+        return dict(_STATS, size=len(_POOL) if _POOL != None else 0)
+
+
+metrics.register_info("bot_catgpt_gif_pool", "Pooled GIFs of /catgpt replies", pool_info)
+
+
+async def _async_refresh(token: str):
+    try:
+        async with MeteredClient(token) as client:
+            for _ in range(REFRESH_BATCH):
+                msg_obj: Message = await client(
+                    SendAnimation(WARMUP_CHAT_ID, f"{GIF_URL}?{datetime.datetime.now().microsecond}", disable_notification=True))
+
+                add(file_id_of(msg_obj))
+                await client(DeleteMessage(msg_obj.chat.id, msg_obj.message_id))
+
+        log.debug("GIF pool refreshed, %s GIFs", pool_info()["size"])
+
+    except Exception:
+        log.warning("Unable to refresh GIF pool", exc_info=True)
+
+    finally:
+        with _POOL_LOCK:
+            _REFRESH["running"] = False
+
+
+def schedule_refresh(token: str) -> None:
+    """Refresh the pool in the background if it is not full or the last refresh is too old"""
+
+    if WARMUP_CHAT_ID == None:
+        return
+
+    with _POOL_LOCK:
+        elapsed = time.monotonic() - _REFRESH["last"]
+        due = (len(_load()) < POOL_SIZE and elapsed > 60) or elapsed > REFRESH_INTERVAL
+
+        if _REFRESH["running"] or not due:
+            return
+
+        _REFRESH["running"] = True
+        _REFRESH["last"] = time.monotonic()
+
+    get_background_loop().submit(_async_refresh(token))
+
+
+async def _async_refresh_periodically(token: str):
+    while True:
+        schedule_refresh(token)
+        await asyncio.sleep(REFRESH_CHECK_INTERVAL)
+
+
+def setup(token: str) -> None:
+    """
+    Load the pool and, if BOT_CATGPT_GIF_CHAT_ID is set, fill it in the background right
+    away and keep it refreshed, so that the first replies after a start use pooled GIFs.
+    """
+
+    with _POOL_LOCK:
+        size = len(_load())
+
+    if WARMUP_CHAT_ID == None:
+        log.info("GIF pool loaded with %s GIFs, filled by replies only (BOT_CATGPT_GIF_CHAT_ID not set)", size)
+        return
+
+    log.debug("GIF pool loaded with %s GIFs, refreshing in the background", size)
+    get_background_loop().submit(_async_refresh_periodically(token))
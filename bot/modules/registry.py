@@ -0,0 +1,73 @@
+"""
+Lazy registration of modules.
+
+Only the metadata of a module (hook, description) is kept at boot. The implementation
+and its dependencies (e.g. Pillow, PyYAML, Jinja) are imported on first use.
+"""
+
+import importlib
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class LazyModule:
+    """
+    Stand-in for a BaseModule subclass that imports it on first use.
+
+    Attributes other than hook and description (e.g. handle_request, prefetch_safe)
+    are looked up on the imported class.
+
+    Parameters
+    ----------
+    hook : str
+        trigger of the module, e.g. "/weathersg"
+
+    description : str
+        module description, published to telegram
+
+    path : str
+        "package.module:ClassName" of the implementation
+    """
+
+    def __init__(self, hook: str, description: str, path: str) -> None:
+        self.hook = hook
+        self.description = description
+        self.path = path
+
+        self._cls = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._cls != None
+
+    def load(self) -> type:
+        """Import the implementation, once"""
+
+        if self._cls == None:
+            with self._lock:
+                if self._cls == None:
+                    module, _, name = self.path.partition(":")
+                    cls = getattr(importlib.import_module(module), name)
+
+                    if cls.hook != self.hook:
+                        log.warning("Module %s registered as %s has hook %s", self.path, self.hook, cls.hook)
+
+                    log.debug("Module %s loaded from %s", self.hook, self.path)
+                    self._cls = cls
+
+        return self._cls
+
+    async def handle_request(self, **kwargs):
+        return await self.load().handle_request(**kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        return f"LazyModule({self.hook!r}, {self.path!r}, loaded={self.loaded})"
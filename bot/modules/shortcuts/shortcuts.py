@@ -1,22 +1,84 @@
+import re
 import json
 import sqlite3
 import shlex
-from dataclasses import dataclass
-from dataclasses_json import DataClassJsonMixin
+import asyncio
+import logging
 
 from typing import Iterable
 
 from telegrambots.wrapper.types.api_method import TelegramBotsMethod
-from telegrambots.wrapper.types.methods import SendMessage, EditMessageText, SendPhoto, EditMessageMedia, EditMessageCaption
+from telegrambots.wrapper.types.methods import SendMessage, EditMessageText, SendPhoto, EditMessageMedia, EditMessageCaption, SendMediaGroup
 from telegrambots.wrapper.types.objects import InlineKeyboardMarkup, InlineKeyboardButton, InputFile, CallbackQuery, InputMediaPhoto
 
 
 import bot.core.database as db
-from bot.core.objects import UserSession
-from bot.modules import BaseModule
+import bot.core.handler
+from bot.core.objects import UserSession, ReadOnlyUserSession
+from bot.modules.base import BaseModule, cached_response, subcommand
 
 from bot.helper.templates import render_response_template
 
+log = logging.getLogger(__name__)
+
+# Telegram limits
+MESSAGE_MAX_LENGTH = 4096
+MEDIA_GROUP_MAX_SIZE = 10
+
+_HTML_TAG = re.compile(r"<(/?)([a-zA-Z-]+)[^>]*>")
+
+
+def _split_lines(text: str, limit: int):
+    """Yield the lines of text (with line endings), lines over limit are split on spaces"""
+
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            cut = line.rfind(" ", 0, limit) + 1
+
+            # no space, cut before a tag or entity that does not fit
+            if cut == 0:
+                start = max(line.rfind("<", 0, limit), line.rfind("&", 0, limit))
+                cut = start if start > max(line.rfind(">", 0, limit), line.rfind(";", 0, limit)) and start > 0 else limit
+
+            yield line[:cut]
+            line = line[cut:]
+
+        yield line
+
+
+def _split_html(text: str, limit: int = MESSAGE_MAX_LENGTH) -> list[str]:
+    """
+    Split HTML text into messages of at most limit characters on line boundaries. Tags
+    open at a boundary (e.g. <pre>) are closed at the end of the message and opened again
+    at the start of the next one, tags do not count in the telegram limit.
+    """
+
+    messages = []
+    message = ""
+
+    # (name, opening tag) of the open tags, outermost first
+    open_tags = []
+
+    for line in _split_lines(text, limit):
+        if message.strip() != "" and len(message) + len(line) > limit:
+            messages.append(message + "".join(f"</{name}>" for name, _ in reversed(open_tags)))
+            message = "".join(tag for _, tag in open_tags)
+
+        message += line
+
+        for m in _HTML_TAG.finditer(line):
+            name = m.group(2).lower()
+
+            if m.group(1) == "":
+                open_tags.append((name, m.group(0)))
+            elif len(open_tags) > 0 and open_tags[-1][0] == name:
+                open_tags.pop()
+
+    if message.strip() != "":
+        messages.append(message)
+
+    return messages
+
 
 class ShortcutsModule(BaseModule):
     """
@@ -32,12 +94,17 @@ class ShortcutsModule(BaseModule):
 
     hook = "/shortcuts"
     description = "Set custom inline keyboard"
+    prefetch_safe = ("help",)
+    collectable = (None, "show", "help")
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
         self.command_list = []
 
+        # commands of macros, by index in command_list
+        self.macros: dict[int, list[str]] = {}
+
     async def _print_command_list(self, command_list=None):
         if command_list == None:
             command_list = self.command_list
@@ -49,13 +116,18 @@ class ShortcutsModule(BaseModule):
 
         for i, command in enumerate(command_list):
             for name, data in command.items():
-                text = text + f"{i}. {name} '{data}'\n"
+                if i in self.macros:
+                    data = " + ".join(self.macros[i])
+                    text = text + f"{i}. {name} [macro] '{data}'\n"
+                else:
+                    text = text + f"{i}. {name} '{data}'\n"
 
         return text
 
     async def _db_get(self) -> list[dict]:
         """
-        Query database for saved command list. 
+        Query database for saved command list. Macros are stored as a callback to run them
+        by id, their commands are stored in self.macros
 
         Returns:
             list of key:value pair
@@ -63,16 +135,25 @@ class ShortcutsModule(BaseModule):
         Raises:
             sqlite3.Error: Database error
         """
+
         query = db.execute(
-            "SELECT command_list FROM Shortcuts WHERE user_id = ?", (self.session.user_id,))
+            "SELECT id, name, command, kind FROM ShortcutItems WHERE user_id = ? ORDER BY position", (self.session.user_id,))
+
+        self.command_list = []
+        self.macros = {}
+
+        for i, (id, name, command, kind) in enumerate(query):
+            if kind == "macro":
+                self.macros[i] = json.loads(command)
+                command = f"{ShortcutsModule.hook} run {id}"
 
-        self.command_list = json.loads(query[0][0]) if (query != []) else []
+            self.command_list.append({name: command})
 
         return self.command_list
 
-    async def _db_add(self, name, command) -> list[dict]:
+    async def _db_add(self, *items: tuple[str, str]) -> list[dict]:
         """
-        Adds a new shortcuts. 
+        Adds new shortcuts (name, command) in a single transaction.
 
         Returns: 
             list of command stored in db
@@ -81,57 +162,94 @@ class ShortcutsModule(BaseModule):
             sqlite3.Error: Database error
         """
 
-        self.command_list.append({name: command})
+        db.executemany_and_commit(
+            """
+            INSERT INTO ShortcutItems (user_id, position, name, command)
+            SELECT :user_id, COALESCE(MAX(position) + 1, 0), :name, :command
+            FROM ShortcutItems WHERE user_id = :user_id
+            """,
+            [{"user_id": self.session.user_id, "name": name, "command": command} for name, command in items]
+        )
+
+        self.command_list += [{name: command} for name, command in items]
+
+        return self.command_list
+
+    async def _db_add_macro(self, name: str, commands: list[str]) -> list[dict]:
+        """
+        Adds a new macro that runs several commands.
+
+        Returns: 
+            list of command stored in db
+
+        Raises: 
+            sqlite3.Error: Database error
+        """
 
         db.execute_and_commit(
             """
-            INSERT INTO shortcuts 
-            VALUES(:user_id,:command_list) 
-            ON CONFLICT(user_id) 
-            DO UPDATE SET command_list=:command_list 
-            WHERE user_id = :user_id
+            INSERT INTO ShortcutItems (user_id, position, name, command, kind)
+            SELECT :user_id, COALESCE(MAX(position) + 1, 0), :name, :command, 'macro'
+            FROM ShortcutItems WHERE user_id = :user_id
             """,
-            {
-                "user_id": self.session.user_id,
-                "command_list": json.dumps(self.command_list)
-            }
+            {"user_id": self.session.user_id, "name": name, "command": json.dumps(commands)}
         )
 
-        return self.command_list
+        return await self._db_get()
 
-    async def _db_delete(self, indexes: Iterable[int]) -> list[dict]:
+    async def _db_get_macro(self, id: int) -> tuple[str, list[str]]:
         """
-        Delete a shortcuts. 
+        Query database for a macro of the user by id.
 
         Returns: 
-            A message
+            name, list of commands
 
         Raises: 
             sqlite3.Error: Database error
-            IndexError: Invalid Indexes
+            KeyError: Macro does not exist
         """
 
-        old_list = self.command_list
+        query = db.execute(
+            "SELECT name, command FROM ShortcutItems WHERE id = ? AND user_id = ? AND kind = 'macro'",
+            (id, self.session.user_id)
+        )
 
-        self.command_list = [i for j, i in enumerate(
-            old_list) if j not in indexes]
+        if query == []:
+            raise KeyError(f"macro {id} does not exist")
 
-        if len(self.command_list) == 0:
-            sql = "DELETE from shortcuts WHERE user_id = :user_id;"
+        return query[0][0], json.loads(query[0][1])
 
-        else:
-            sql = """
-                UPDATE shortcuts SET command_list = :command_list
-                WHERE user_id = :user_id;
-                """
+    async def _db_delete(self, indexes: Iterable[int]) -> list[dict]:
+        """
+        Delete shortcuts by index in a single statement. Invalid indexes are ignored
+
+        Returns: 
+            A message
+
+        Raises: 
+            sqlite3.Error: Database error
+        """
+
+        indexes = set(indexes)
 
         db.execute_and_commit(
-            sql,
-            {
-                "user_id": self.session.user_id,
-                "command_list": json.dumps(self.command_list)
-            }
+            f"""
+            DELETE FROM ShortcutItems WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (ORDER BY position) - 1 AS idx
+                    FROM ShortcutItems WHERE user_id = ?
+                )
+                WHERE idx IN ({",".join("?" * len(indexes))})
+            )
+            """,
+            (self.session.user_id, *indexes)
         )
+
+        self.command_list = [i for j, i in enumerate(self.command_list) if j not in indexes]
+        self.macros = {
+            k - sum(1 for j in indexes if 0 <= j < k): v for k, v in self.macros.items() if k not in indexes
+        }
+
         return self.command_list
 
     async def _db_edit(self,index: int, name: str, command: str) -> list[dict]:
@@ -146,20 +264,35 @@ class ShortcutsModule(BaseModule):
             IndexError: Invalid index
         """
 
-        self.command_list[index] = {name: command}
+        if index < 0:
+            index += len(self.command_list)
 
-        sql = """ 
-            UPDATE shortcuts SET command_list = :command_list
-            WHERE user_id = :user_id;
+        query = db.execute_and_commit(
             """
+            UPDATE ShortcutItems SET name = :name, command = :command, kind = 'command'
+            WHERE id = (
+                SELECT id FROM ShortcutItems WHERE user_id = :user_id
+                ORDER BY position LIMIT 1 OFFSET :index
+            ) AND :index >= 0
+            RETURNING id
+            """,
+            {
+                "user_id": self.session.user_id,
+                "index": index,
+                "name": name,
+                "command": command
+            }
+        )
+
+        if query == []:
+            raise IndexError("list assignment index out of range")
 
-        db.execute_and_commit(sql, {
-            "user_id": self.session.user_id,
-            "command_list": json.dumps(self.command_list)
-        })
+        self.command_list[index] = {name: command}
+        self.macros.pop(index, None)
 
         return self.command_list
 
+    @subcommand("show", max_args=0, parse="shlex")
     async def _shortcuts_show_response(self) -> list[TelegramBotsMethod]:
         """Query database and replies with a message with InlineMarkup"""
 
@@ -183,10 +316,29 @@ class ShortcutsModule(BaseModule):
             return await self._text_response("Your shortcut list is empty")
 
     async def _shortcuts_add_response(self) -> list[TelegramBotsMethod]:
-        if self.argc != 5:
-            return await self._text_response(f'Too many/few arguments: \n\nExpected 5 for "add""', args=self.args[0:2])
+        if self.argc < 5 or self.argc % 2 != 1:
+            return await self._text_response(f'Too many/few arguments: \n\nExpected name and command pairs for "add""', args=self.args[0:2])
 
-        new_list = await self._db_add(self.args[3], self.args[4])
+        new_list = await self._db_add(*zip(self.args[3::2], self.args[4::2]))
+        text = "Added!\n" + await self._print_command_list(new_list)
+        return await self._text_response(text,args=self.args[0:2])
+
+    async def _shortcuts_macro_response(self) -> list[TelegramBotsMethod]:
+        if self.argc < 5:
+            return await self._text_response(f'Too few arguments: \n\nExpected name and >= 1 command for "macro"', args=self.args[0:2])
+
+        commands = list(self.args[4:])
+
+        for command in commands:
+            if not command.startswith("/"):
+                return await self._text_response(f"Invalid macro command: '{command}'", args=self.args[0:2])
+
+            if not bot.core.handler.is_collectable(command):
+                return await self._text_response(
+                    f"Invalid macro command: '{command}'\n\nIt is unknown or its reply cannot be merged into a macro (e.g. /catgpt chat, /shortcuts run)",
+                    args=self.args[0:2])
+
+        new_list = await self._db_add_macro(self.args[3], commands)
         text = "Added!\n" + await self._print_command_list(new_list)
         return await self._text_response(text,args=self.args[0:2])
 
@@ -221,33 +373,35 @@ class ShortcutsModule(BaseModule):
             await self.session.async_update_state(self.args[0:2], True)
             return await self._text_response(f"Invalid Index: \n\n {e}", args=self.args[0:2])
 
+    @subcommand("modify", parse="shlex", listen=True)
     async def _shortcuts_modify_response(self) -> list[TelegramBotsMethod]:
         """Modify the shortcuts list"""
 
         assert (self.args[1] == "modify")
 
-        if self.argc == 2:
-            self.command_list = await self._db_get()
+        self.command_list = await self._db_get()
 
+        if self.argc == 2:
             text = render_response_template(
                 "shortcuts/templates/modify.html"
             )
 
             text = text + await self._print_command_list(self.command_list)
 
-            await self.session.async_update_state(self.args, require_addl_args=True)
             return await self._text_response(text)
 
         # Check if enough arguments
         elif self.argc < 4:
-            await self.session.async_update_state(self.args[0:2], True)
             return await self._text_response(f"Not enough arguments, expected > 3, got {self.argc}", args=self.args[0:2])
 
         action = self.args[2].lower()
-        await self.session.async_update_state(self.args[0:2], True)
+
         if action == "add":
             return await self._shortcuts_add_response()
 
+        elif action == "macro":
+            return await self._shortcuts_macro_response()
+
         elif action == "delete":
             return await self._shortcuts_delete_response()
 
@@ -255,13 +409,91 @@ class ShortcutsModule(BaseModule):
             return await self._shortcuts_edit_response()
 
         else:
-            await self.session.async_update_state(self.args[0:2], True)
-
             return await self._text_response(
                 f'Unexpected Arguments: "{action}"',
                 args=self.args[0:2],
             )
 
+    async def _run_macro_command(self, command: str) -> list[TelegramBotsMethod]:
+        """Run a command of a macro and returns the responses instead of sending them"""
+
+        session = ReadOnlyUserSession(self.session.user_id, self.session.chat_id)
+        tg_obj = self.tg_obj.message if isinstance(self.tg_obj, CallbackQuery) else self.tg_obj
+
+        return await bot.core.handler.async_collect_request(tg_obj, session, command)
+
+    async def _merge_macro_responses(self, name: str, commands: list[str], results: list) -> list[TelegramBotsMethod]:
+        """
+        Merge the responses of the commands of a macro into a single message and album. The
+        message keeps the inline keyboard of the last response that has one.
+        """
+
+        texts = [f"<b>{name}</b>"]
+        photos = []
+        reply_markup = None
+
+        for command, result in zip(commands, results):
+            if isinstance(result, Exception):
+                log.info("Macro command '%s' failed: %s", command, result)
+                texts.append(f"[<pre>{command}</pre>]\nERROR: {result}")
+                continue
+
+            for r in result:
+                if isinstance(getattr(r, "reply_markup", None), InlineKeyboardMarkup):
+                    reply_markup = r.reply_markup
+
+                if isinstance(r, (SendMessage, EditMessageText)):
+                    texts.append(r.text)
+
+                elif isinstance(r, SendPhoto):
+                    photos.append(InputMediaPhoto(r.photo, caption=r.caption, parse_mode=r.parse_mode))
+
+                elif isinstance(r, EditMessageMedia) and isinstance(r.media, InputMediaPhoto):
+                    photos.append(r.media)
+
+        res = []
+        text = "\n\n".join(texts)
+
+        # sub-commands are labelled by their own responses
+        if len(text) <= MESSAGE_MAX_LENGTH:
+            res += await self._text_response(text, reply_markup, print_label=False, args=self.args[0:1])
+        else:
+            messages = _split_html(text)
+
+            for i, t in enumerate(messages):
+                res += await self._text_response(t, reply_markup if i == len(messages) - 1 else None,
+                                                  print_label=False, args=self.args[0:1], message_id=None)
+
+        chat_id = self.session.chat_id
+
+        if len(photos) == 1:
+            res.append(SendPhoto(chat_id, photos[0].media, caption=photos[0].caption,
+                       parse_mode=photos[0].parse_mode, disable_notification=True))
+
+        for i in range(0, len(photos) if len(photos) > 1 else 0, MEDIA_GROUP_MAX_SIZE):
+            res.append(SendMediaGroup(chat_id, photos[i:i + MEDIA_GROUP_MAX_SIZE], disable_notification=True))
+
+        return res
+
+    @subcommand("run", min_args=1, max_args=1, parse="shlex")
+    async def _shortcuts_run_response(self) -> list[TelegramBotsMethod]:
+        """Run the commands of a macro concurrently and reply with the merged responses"""
+
+        try:
+            name, commands = await self._db_get_macro(int(self.args[2]))
+
+        except (ValueError, KeyError) as e:
+            return await self._exception_response(f"Invalid macro: {e}", args=self.args[0:1])
+
+        results = await asyncio.gather(
+            *[self._run_macro_command(command) for command in commands],
+            return_exceptions=True
+        )
+
+        return await self._merge_macro_responses(name, commands, results)
+
+    @subcommand("help", max_args=0, parse="shlex")
+    @cached_response()
     async def _shortcuts_help_response(self) -> list[TelegramBotsMethod]:
         """Render and send the help response"""
 
@@ -271,6 +503,7 @@ class ShortcutsModule(BaseModule):
 
         return await self._text_response(msg)
 
+    @subcommand(max_args=0, parse="shlex")
     async def _shortcuts_hook_response(self):
         reply_markup = InlineKeyboardMarkup([[
             InlineKeyboardButton(
@@ -284,46 +517,6 @@ class ShortcutsModule(BaseModule):
         return await self._text_response(f"Select an option", reply_markup)
 
 
-    @classmethod
-    async def handle_request(cls, **kwargs) -> list[TelegramBotsMethod]:
-        """
-        Get replies for commands:
-
-        Args (required):
-            *args: parsed user inputs
-            **user_id: chat_id
-            **session: UserSession = None Object
-
-        Return:
-            list of TelegramBotsMethod
-
-        Raises:
-            ValueError: chat_id does not exist / not an int
-        """
-
-        args = shlex.split(kwargs['text'])
-
-        slf = cls(*args,**kwargs)
-        await slf.session.async_update_state(args,False)
-
-        assert (args[0] == slf.hook)
-
-        if len(slf.args) == 1:
-            res = await slf._shortcuts_hook_response()
-
-        else:
-            slf.command_list = await slf._db_get()
-            try:
-                res =  await getattr(slf, '_shortcuts_%s_response' % args[1])()
-
-            except AttributeError:
-                res = await slf._exception_response(f"Unexpected argument: '{args[1]}'",args=slf.args[0:1])
-        
-        async with slf.client as client:
-            for r in res:
-                await client(r)
-
-
 class ScShow(ShortcutsModule):
     hook = "/scshow"
     description = "Show Saved Shortcuts"
@@ -331,4 +524,5 @@ class ScShow(ShortcutsModule):
     @classmethod
     async def handle_request(cls, **kwargs) -> list[TelegramBotsMethod]:
         kwargs['text'] = f'{ShortcutsModule.hook} show'
+        kwargs['args'] = (ShortcutsModule.hook, "show")
         return await ShortcutsModule.handle_request(**kwargs)
\ No newline at end of file
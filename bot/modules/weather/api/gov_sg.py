@@ -1,3 +1,16 @@
+"""
+Client of the data.gov.sg weather apis and the weather.gov.sg rain area images.
+
+ENVIRONMENTAL VARIABLES
+-----------------------
+BOT_GOV_SG_API_URL:
+    Base url of the data.gov.sg api, defaults "https://api.data.gov.sg"
+
+BOT_GOV_SG_RAINMAP_URL:
+    Base url of the rain area images, defaults "http://www.weather.gov.sg"
+"""
+
+import os
 import requests
 import cachetools.func
 import json
@@ -6,8 +19,31 @@ from io import BytesIO
 
 
 import datetime
+import time as _time
 
 from bot.helper.datetime import round_datetime_mins
+from bot.core import metrics, tracing
+
+API_URL = os.getenv("BOT_GOV_SG_API_URL", "https://api.data.gov.sg").rstrip("/")
+RAINMAP_URL = os.getenv("BOT_GOV_SG_RAINMAP_URL", "http://www.weather.gov.sg").rstrip("/")
+
+
+def _get(endpoint: str, url: str, **kwargs) -> requests.Response:
+    """requests.get recording the latency and status of the endpoint in the metrics and trace"""
+
+    start = _time.perf_counter()
+    result = "error"
+
+    try:
+        with tracing.span(f"gov_sg.{endpoint}"):
+            r = requests.get(url, **kwargs)
+
+        result = str(r.status_code)
+        return r
+
+    finally:
+        metrics.UPSTREAM_DURATION.labels("gov_sg", endpoint).observe(_time.perf_counter() - start)
+        metrics.UPSTREAM_REQUESTS.labels("gov_sg", endpoint, result).inc()
 
 
 @cachetools.func.ttl_cache(ttl=60)
@@ -22,8 +58,8 @@ def get_forecast_24_hour() -> dict:
         requests.HTTPError: API error
     """
 
-    api_response = requests.get(
-        url='https://api.data.gov.sg/v1/environment/24-hour-weather-forecast')
+    api_response = _get(
+        "24-hour-weather-forecast", url=f'{API_URL}/v1/environment/24-hour-weather-forecast')
     api_response.raise_for_status()
 
     api_dict = api_response.json()['items'][0]
@@ -45,8 +81,8 @@ def get_forecast_2h() -> dict:
         requests.HTTPError: API error
     """
 
-    api_response = requests.get(
-        url='https://api.data.gov.sg/v1/environment/2-hour-weather-forecast')
+    api_response = _get(
+        "2-hour-weather-forecast", url=f'{API_URL}/v1/environment/2-hour-weather-forecast')
     api_response.raise_for_status()
 
     api_dict = api_response.json()
@@ -69,8 +105,8 @@ def get_forecast_4d() -> dict:
         requests.HTTPError: API error
     """
 
-    api_response = requests.get(
-        url='https://api.data.gov.sg/v1/environment/4-day-weather-forecast')
+    api_response = _get(
+        "4-day-weather-forecast", url=f'{API_URL}/v1/environment/4-day-weather-forecast')
     api_response.raise_for_status()
 
     api_dict = api_response.json()['items'][0]
@@ -100,14 +136,14 @@ def get_rainmap(dt: datetime = None)-> tuple[datetime.datetime, bytes]:
 @cachetools.func.mru_cache()
 def _rainmap_static_images():
     static_images_url = [
-        "http://www.weather.gov.sg/wp-content/themes/wiptheme/assets/img/base-853.png",
-        "http://www.weather.gov.sg/wp-content/themes/wiptheme/images/SG-Township.png",
+        f"{RAINMAP_URL}/wp-content/themes/wiptheme/assets/img/base-853.png",
+        f"{RAINMAP_URL}/wp-content/themes/wiptheme/images/SG-Township.png",
     ]
 
     images = []
 
     for url in static_images_url:
-        r = requests.get(url, stream=True)
+        r = _get("rainmap_static", url, stream=True)
         r.raise_for_status()
 
         r.raw.decode_content = True
@@ -119,8 +155,8 @@ def _rainmap_static_images():
 def _rainmap_overlay(time: datetime,max_it=5) -> tuple[datetime.datetime, Image.Image]:
     time = round_datetime_mins(time, 5)  # round to nearest 5mins
 
-    url = f"http://www.weather.gov.sg/files/rainarea/50km/v2/dpsri_70km_{time.strftime('%Y%m%d%H%M')}0000dBR.dpsri.png"
-    r = requests.get(url, stream=True)
+    url = f"{RAINMAP_URL}/files/rainarea/50km/v2/dpsri_70km_{time.strftime('%Y%m%d%H%M')}0000dBR.dpsri.png"
+    r = _get("rainmap_overlay", url, stream=True)
 
     if r.status_code == 200:
         r.raw.decode_content = True
@@ -140,6 +176,14 @@ def _rainmap_stich_images(time: datetime) -> tuple[datetime.datetime, bytes]:
     rainmap_time, overlay = _rainmap_overlay(time)
 
     static_images = _rainmap_static_images()
+
+    with tracing.span("gov_sg.rainmap_render"):
+        return time, _rainmap_compose(static_images, overlay)
+
+
+def _rainmap_compose(static_images: tuple[Image.Image, Image.Image], overlay: Image.Image) -> bytes:
+    """Returns the png of the rain area overlay between the base map and the township names"""
+
     base = static_images[0].convert("RGBA")
     town = static_images[1].resize(base.size).convert("RGBA")
     overlay = overlay.resize(base.size).convert("RGBA")
@@ -151,4 +195,10 @@ def _rainmap_stich_images(time: datetime) -> tuple[datetime.datetime, bytes]:
     base.save(photo, 'PNG')
     photo.seek(0)
 
-    return time, photo.read()
\ No newline at end of file
+    return photo.read()
+
+
+for _func in (get_forecast_24_hour, get_forecast_2h, get_forecast_4d, _rainmap_stich_images):
+    metrics.register_info(
+        "bot_cache", "Hits, misses and size of caches", lambda f=_func: f.cache_info()._asdict(),
+        cache=f"gov_sg.{_func.__name__}")
@@ -10,14 +10,31 @@ from telegrambots.wrapper.types.api_method import TelegramBotsMethod
 from telegrambots.wrapper.types.methods import *
 from telegrambots.wrapper.types.objects import *
 
-from ..base import BaseModule
+from ..base import BaseModule, cached_response, subcommand
 from bot.core.objects import UserSession
 
 
+def _closest_areas(area_list: list[dict], lat: float, long: float, n: int = 5) -> list[int]:
+    """Returns the indexes of the n areas closest to a gps location"""
+
+    distance_from_area = []
+
+    for area_dict in area_list:
+        tmp_distance = (area_dict["label_location"]["longitude"] - long)**2 + (
+            area_dict["label_location"]["latitude"] - lat)**2
+        distance_from_area.append(tmp_distance**0.5)
+
+    return sorted(range(len(distance_from_area)), key=lambda sub: distance_from_area[sub])[:n]
+
+
 class WeatherModule(BaseModule):
     hook = "/weathersg"
     description = "Get the latest Singapore Weather"
+    # rainmap is not prefetched, photos are not cached (see cached_response)
+    prefetch_safe = ("help", "forecast2h", "forecast24h", "forecast4d")
+    collectable = (None, "help", "rainmap", "forecast2h", "forecast24h", "forecast4d")
 
+    @subcommand(max_args=0)
     async def _weather_hook_response(self) -> list[TelegramBotsMethod]:
         """Return message with inline keyboard"""
 
@@ -38,6 +55,8 @@ class WeatherModule(BaseModule):
 
         return await self._text_response(f"Select an Option", reply_markup)
 
+    @subcommand("help", max_args=0)
+    @cached_response()
     async def _weather_help_response(self) -> list[TelegramBotsMethod]:
         """Render help response"""
         text = render_response_template(
@@ -61,6 +80,8 @@ class WeatherModule(BaseModule):
 
         return await self._text_response(text, reply_markup)
 
+    @subcommand("forecast2h")
+    @cached_response(key=lambda slf: (api.get_forecast_2h()[2]["update_timestamp"],) if len(slf.args) > 2 and not (isinstance(slf.tg_obj, Message) and slf.tg_obj.location != None) else None)
     async def _weather_forecast2h_response(self) -> list[TelegramBotsMethod]:
         """24 hr forecast reply"""
 
@@ -107,20 +128,12 @@ class WeatherModule(BaseModule):
         if lat != None and long != None:
             self.args = list(self.args[0:2]) + [f"gps={lat},{long}"]
 
-            selected_index = []
-            distance_from_area = []
-
-            for i, area_dict in enumerate(area_list):
-                tmp_distance = (area_dict["label_location"]["longitude"] - long)**2 + (
-                    area_dict["label_location"]["latitude"] - lat)**2
-                distance_from_area.append(tmp_distance**0.5)
-
             # select the 5 closest to gps location
-            selected_index = sorted(
-                range(len(distance_from_area)), key=lambda sub: distance_from_area[sub])[:5]
+            selected_index = _closest_areas(area_list, lat, long)
 
         else:
             await self.session.async_update_state(self.args[0:2], True)
+            self._response_cacheable = False
 
             possible_areas = difflib.get_close_matches(
                 chosen_area, [a_dict["name"] for a_dict in area_list], 10, 0.1)
@@ -135,14 +148,13 @@ class WeatherModule(BaseModule):
             forecasts=[forecast_list[i] for i in selected_index]
         )
 
-        if self.session.message_id != None:
-            text += f"\nts:{datetime.datetime.now()}"
-
         reply_markup = InlineKeyboardMarkup(
             [[InlineKeyboardButton("Refresh", callback_data=" ".join(self.args))]])
 
         return await self._text_response(text, reply_markup)
 
+    @subcommand("forecast24h", max_args=1)
+    @cached_response(key=lambda slf: (api.get_forecast_24_hour()["update_timestamp"],) if len(slf.args) == 3 else ())
     async def _weather_forecast24h_response(self) -> list[TelegramBotsMethod]:
         """24 hr forecast reply"""
         self.args = [s.lower() for s in self.args]
@@ -193,14 +205,13 @@ class WeatherModule(BaseModule):
             reply_markup = InlineKeyboardMarkup(
                 [[InlineKeyboardButton("Refresh", callback_data=" ".join(self.args))]])
 
-            if self.session.message_id != None:
-                text += f"\nts:{datetime.datetime.now()}"
-
             return await self._text_response(text, reply_markup)
 
         else:
             return await self._exception_response(f"Too many arguments, expected max of 3, got {len(self.args)}")
 
+    @subcommand("forecast4d", max_args=0)
+    @cached_response(key=lambda slf: (api.get_forecast_4d()["update_timestamp"],))
     async def _weather_forecast4d_response(self) -> list[TelegramBotsMethod]:
 
         assert self.args[1] == "forecast4d"
@@ -220,11 +231,9 @@ class WeatherModule(BaseModule):
         reply_markup = InlineKeyboardMarkup(
             [[InlineKeyboardButton("Refresh", callback_data=" ".join(self.args))]])
 
-        if self.session.message_id != None:
-            text += f"\nts:{datetime.datetime.now()}"
-
         return await self._text_response(text, reply_markup)
 
+    @subcommand("rainmap", max_args=0)
     async def _weather_rainmap_response(self) -> list[TelegramBotsMethod]:
         assert self.args[1] == "rainmap"
 
@@ -243,38 +252,8 @@ class WeatherModule(BaseModule):
         # check CallbackQuery is under the photo object
         if isinstance(self.tg_obj, CallbackQuery) and self.tg_obj.message.photo != None:
             self.session.message_id = self.session.message_id
-            caption += f"\n\nts: {datetime.datetime.now()}"
 
         else:
             self.session.message_id = None
 
         return await self._photo_response(photo, "rainmap.png", caption=caption, reply_markup=reply_markup)
-
-    @classmethod
-    async def handle_request(cls, **kwargs) -> list[TelegramBotsMethod]:
-        """
-        Get replies for commands
-        """
-        args = kwargs['text'].split(" ")
-
-        assert (args[0] == cls.hook)  # Sanity check
-
-        slf = cls(*args, **kwargs)
-        await slf.session.async_update_state(args,False)
-
-        if len(args) == 1:
-            res = await slf._weather_hook_response()
-
-        else:
-            sub_module = '_weather_%s_response' % args[1]
-
-            if hasattr(slf, sub_module):
-                res = await getattr(slf, sub_module)()
-
-            else:
-                res = await slf._exception_response(f"Invalid arguments: {args[1:]}")
-        
-        async with slf.client as client:
-            for r in res:
-                await client(r)
-
@@ -4,11 +4,12 @@ import logging
 
 import bot.core.database as db
 import bot.core.server as server
+from bot.core import logs
 from bot.modules import *
+import bot.modules.catgpt.gif_pool as gif_pool
 
-logging.basicConfig(format= "[%(asctime)s] [%(levelname)-5s] [%(name)-20s] -- %(message)s (%(filename)s:%(lineno)s) ")
+logs.setup()
 logging.getLogger('werkzeug').disabled = True
-logging.getLogger().setLevel(logging.DEBUG)
 
 os.environ["BOT_CONFIG_DIR"] = os.getenv('BOT_CONFIG_DIR',"/config")
 if os.getenv("BOT_TOKEN") == None:
@@ -23,6 +24,15 @@ if __name__ == "__main__":
         WeatherModule,
         ShortcutsModule, ScShow, 
         CatGPTModule
-    ])
+    ], bulkheads={
+        # modules waiting on upstream apis hold at most 22 worker threads, 10 of the default
+        # 32 BOT_WORKERS stay free for the others. Macros run with the /shortcuts slots
+        "/weathersg": {"max_concurrent": 6, "max_queued": 4},
+        "/catgpt": {"max_concurrent": 6, "max_queued": 2},
+        "/shortcuts": {"max_concurrent": 3, "max_queued": 1},
+    })
+
+    # pooled GIFs for the first /catgpt replies, the module itself is loaded on first use
+    gif_pool.setup(server.BOT_TOKEN)
     
     server.run(debug=True)
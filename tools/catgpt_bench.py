@@ -0,0 +1,64 @@
+"""
+Load test of the cat-gpt client against the local stand-in (tools/stubs/catgpt.py).
+
+Usage:
+    python -m tools.stubs.catgpt --latency 1 &
+    BOT_CATGPT_API_URL=http://127.0.0.1:8090 python -m tools.catgpt_bench --calls 200 --users 50
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BOT_CONFIG_DIR", "/config")
+
+import bot.modules.catgpt.api.cat_gpt as api
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=100)
+    parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+
+    latencies = []
+    errors = []
+
+    # Like the bot, every caller runs in its own thread and event loop
+    def call(i):
+        start = time.perf_counter()
+        try:
+            asyncio.run(api.async_conversation(
+                {"userPrompt": "", "userRequests": [{"role": "user", "content": "hi"}]},
+                {"Authorization": "bench"},
+                i % args.users
+            ))
+            latencies.append(time.perf_counter() - start)
+
+        except Exception as e:
+            errors.append(repr(e))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(args.calls)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    elapsed = time.perf_counter() - start
+
+    print(f"calls: {args.calls}, users: {args.users}, errors: {len(errors)}, elapsed: {elapsed:.2f}s")
+    if latencies:
+        print(f"p50: {percentile(latencies, 0.5):.3f}s p95: {percentile(latencies, 0.95):.3f}s p99: {percentile(latencies, 0.99):.3f}s")
+    for e in sorted(set(errors)):
+        print(f"  {errors.count(e)}x {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Offline load test of the bot.
+
+Starts the local stand-ins of the telegram bot api (tools/stubs/telegram.py), data.gov.sg
+and the rain area images (tools/stubs/gov_sg.py) and cat-gpt.com (tools/stubs/catgpt.py),
+optionally the bot itself, then posts synthetic updates to the webhook at a target rate.
+
+Each scenario runs in a new chat. The latency of an update is the time from posting it
+to the first bot api call for its chat, steps before the last one of a scenario (e.g.
+the command before a location) are not reported.
+
+Usage:
+    python -m tools.loadtest --spawn-bot --rate 20 --duration 30
+    python -m tools.loadtest --rate 20 --duration 30 --mix start=1,forecast2h=3,location=1
+
+Without --spawn-bot the bot must be started with the environment printed at start.
+"""
+
+import os
+import sys
+import time
+import random
+import signal
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import logging
+import collections
+
+import requests
+from werkzeug.serving import make_server
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from tools.stubs import telegram, gov_sg, catgpt
+
+TOKEN = "1:loadtest"
+
+_UPDATE_IDS = itertools.count(1)
+_CHAT_IDS = itertools.count(1_000_000)
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def message(chat_id: int, text: str = None, location: tuple[float, float] = None) -> dict:
+    msg = {
+        "message_id": next(_UPDATE_IDS), "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "load"},
+    }
+
+    if text != None:
+        msg["text"] = text
+
+    if location != None:
+        msg["location"] = {"latitude": location[0], "longitude": location[1]}
+
+    return {"update_id": next(_UPDATE_IDS), "message": msg}
+
+
+def callback_query(chat_id: int, data: str) -> dict:
+    return {
+        "update_id": next(_UPDATE_IDS),
+        "callback_query": {
+            # answerCallbackQuery is matched to the chat by the query id
+            "id": str(chat_id), "chat_instance": str(chat_id), "data": data,
+            "from": {"id": chat_id, "is_bot": False, "first_name": "load"},
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": "menu"},
+        }
+    }
+
+
+# name -> steps, each step returns the update for a chat
+SCENARIOS = {
+    "start": [lambda c: message(c, "/start")],
+    "forecast2h": [lambda c: message(c, "/weathersg forecast2h bishan")],
+    "forecast4d": [lambda c: message(c, "/weathersg forecast4d")],
+    "forecast24h_tap": [lambda c: callback_query(c, "/weathersg forecast24h north")],
+    "rainmap": [lambda c: message(c, "/weathersg rainmap")],
+    "location": [lambda c: message(c, "/weathersg forecast2h"), lambda c: message(c, location=(1.35, 103.84))],
+    "shortcuts": [lambda c: message(c, "/shortcuts")],
+    "catgpt": [lambda c: message(c, f"/catgpt chat ai {c} hello")],
+}
+
+DEFAULT_MIX = "start=2,forecast2h=3,forecast4d=1,forecast24h_tap=2,rainmap=1,location=1,shortcuts=1,catgpt=1"
+
+
+class Recorder:
+    """Time of the bot api calls per chat, fed by the telegram stand-in"""
+
+    def __init__(self) -> None:
+        self._calls = collections.defaultdict(list)
+        self._cond = threading.Condition()
+
+    def on_call(self, method: str, params: dict, t: float) -> None:
+        key = str(params.get("chat_id", params.get("callback_query_id", "")))
+
+        with self._cond:
+            self._calls[key].append(t)
+            self._cond.notify_all()
+
+    def wait(self, chat_id: int, after: float, timeout: float) -> float | None:
+        """Returns the time of the first call for chat_id after a time, None on timeout"""
+
+        deadline = time.perf_counter() + timeout
+
+        with self._cond:
+            while True:
+                calls = [t for t in self._calls[str(chat_id)] if t >= after]
+
+                if calls != []:
+                    return calls[0]
+
+                remaining = deadline - time.perf_counter()
+
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    return None
+
+
+def serve(app, port: int) -> None:
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def bot_environment(opts, config_dir: str) -> dict:
+    return {
+        "BOT_TOKEN": TOKEN,
+        "BOT_CONFIG_DIR": config_dir,
+        "BOT_SERVER_IS_STANDALONE": "false",
+        "BOT_SERVER_HOSTNAME": "127.0.0.1",
+        "BOT_SERVER_PORT": str(opts.bot_port),
+        "BOT_SERVER_PUBLISHED_URL": f"http://127.0.0.1:{opts.bot_port}/",
+        "BOT_TELEGRAM_API_URL": f"http://127.0.0.1:{opts.telegram_port}",
+        "BOT_GOV_SG_API_URL": f"http://127.0.0.1:{opts.gov_sg_port}",
+        "BOT_GOV_SG_RAINMAP_URL": f"http://127.0.0.1:{opts.gov_sg_port}",
+        "BOT_CATGPT_API_URL": f"http://127.0.0.1:{opts.catgpt_port}",
+        "BOT_CATGPT_AUTH": "loadtest",
+        "BOT_CATGPT_EMAIL": "loadtest@localhost",
+    }
+
+
+def spawn_bot(env: dict, config_dir: str, webhook: str, timeout: float = 30) -> subprocess.Popen:
+    log_file = open(os.path.join(config_dir, "bot.log"), "w")
+    proc = subprocess.Popen(
+        [sys.executable, "main.py"], cwd=ROOT, env=dict(os.environ, **env),
+        stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True
+    )
+
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if proc.poll() != None:
+            raise RuntimeError(f"Bot exited with {proc.returncode}, see {log_file.name}")
+
+        try:
+            requests.get(webhook + "metrics", timeout=1)
+            return proc
+        except requests.ConnectionError:
+            time.sleep(0.2)
+
+    os.killpg(proc.pid, signal.SIGTERM)
+    raise RuntimeError(f"Bot not ready within {timeout}s, see {log_file.name}")
+
+
+def run_scenario(name: str, opts, recorder: Recorder, results: dict, lock: threading.Lock) -> None:
+    chat_id = next(_CHAT_IDS)
+    latency = None
+
+    try:
+        for step in SCENARIOS[name]:
+            start = time.perf_counter()
+            requests.post(opts.webhook, json=step(chat_id), timeout=opts.timeout).raise_for_status()
+
+            reply = recorder.wait(chat_id, start, opts.timeout)
+
+            if reply == None:
+                raise TimeoutError(f"no reply within {opts.timeout}s")
+
+            latency = reply - start
+
+    except Exception as e:
+        with lock:
+            results[name]["errors"][type(e).__name__] += 1
+        return
+
+    with lock:
+        results[name]["latencies"].append(latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--webhook", help="webhook url of the bot, defaults http://127.0.0.1:{bot-port}/")
+    parser.add_argument("--spawn-bot", action="store_true", help="start main.py with the stand-ins")
+    parser.add_argument("--rate", type=float, default=10, help="scenarios started per second")
+    parser.add_argument("--duration", type=float, default=30, help="test duration (s)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="scenario weights, e.g. start=1,rainmap=2")
+    parser.add_argument("--timeout", type=float, default=30, help="timeout of an update (s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bot-port", type=int, default=8088)
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--gov-sg-port", type=int, default=8082)
+    parser.add_argument("--catgpt-port", type=int, default=8090)
+    parser.add_argument("--telegram-latency", type=float, default=telegram.CONFIG["latency"], help="bot api response time (s)")
+    parser.add_argument("--telegram-rate-limit", type=float, default=0.0, help="fraction of bot api calls rejected with 429")
+    parser.add_argument("--gov-sg-latency", type=float, default=gov_sg.CONFIG["latency"], help="data.gov.sg response time (s)")
+    parser.add_argument("--catgpt-latency", type=float, default=catgpt.CONFIG["latency"], help="cat-gpt response time (s)")
+    opts = parser.parse_args()
+
+    opts.webhook = opts.webhook or f"http://127.0.0.1:{opts.bot_port}/"
+    mix = {k: float(v) for k, v in (item.split("=") for item in opts.mix.split(","))}
+    unknown = set(mix) - set(SCENARIOS)
+
+    if unknown != set():
+        parser.error(f"unknown scenarios {sorted(unknown)}, expected {sorted(SCENARIOS)}")
+
+    random.seed(opts.seed)
+
+    logging.getLogger('werkzeug').disabled = True
+
+    recorder = Recorder()
+    telegram.CONFIG.update(latency=opts.telegram_latency, jitter=opts.telegram_latency / 2, rate_limit=opts.telegram_rate_limit)
+    telegram.on_call = recorder.on_call
+    gov_sg.CONFIG.update(latency=opts.gov_sg_latency, jitter=opts.gov_sg_latency / 2)
+    catgpt.CONFIG.update(latency=opts.catgpt_latency, jitter=opts.catgpt_latency / 2, words=20)
+
+    serve(telegram.flask, opts.telegram_port)
+    serve(gov_sg.flask, opts.gov_sg_port)
+    serve(catgpt.flask, opts.catgpt_port)
+
+    config_dir = tempfile.mkdtemp(prefix="loadtest-")
+    env = bot_environment(opts, config_dir)
+    bot = None
+
+    if opts.spawn_bot:
+        bot = spawn_bot(env, config_dir, opts.webhook)
+    else:
+        print("Start the bot with:\n  " + " ".join(f"{k}={v}" for k, v in env.items()) + " python main.py")
+        input("Press enter when the bot is running...")
+
+    results = {name: {"latencies": [], "errors": collections.Counter()} for name in mix}
+    lock = threading.Lock()
+    threads = []
+    names, weights = list(mix), list(mix.values())
+
+    print(f"Running {opts.rate}/s for {opts.duration}s, mix {opts.mix}")
+
+    try:
+        start = time.perf_counter()
+
+        # Open loop: scenarios start on schedule whether or not earlier ones completed
+        for i in range(int(opts.rate * opts.duration)):
+            delay = start + i / opts.rate - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+            t = threading.Thread(target=run_scenario, args=(random.choices(names, weights)[0], opts, recorder, results, lock))
+            t.start()
+            threads.append(t)
+
+        [t.join() for t in threads]
+        elapsed = time.perf_counter() - start
+
+    finally:
+        if bot != None:
+            os.killpg(bot.pid, signal.SIGTERM)
+
+    completed = sum(len(r["latencies"]) for r in results.values())
+    print(f"\ncompleted {completed}/{len(threads)} in {elapsed:.1f}s, throughput {completed / elapsed:.1f}/s")
+    print(f"{'scenario':<16}{'n':>6}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+
+    everything = []
+    for name, r in results.items():
+        latencies = r["latencies"]
+        everything += latencies
+
+        if latencies == []:
+            print(f"{name:<16}{0:>6}{sum(r['errors'].values()):>8}")
+            continue
+
+        print(f"{name:<16}{len(latencies):>6}{sum(r['errors'].values()):>8}" +
+              "".join(f"{percentile(latencies, p) * 1000:>7.0f}ms" for p in (0.5, 0.95, 0.99)))
+
+    if everything != []:
+        print(f"{'all':<16}{len(everything):>6}{'':>8}" +
+              "".join(f"{percentile(everything, p) * 1000:>7.0f}ms" for p in (0.5, 0.95, 0.99)))
+
+    for name, r in results.items():
+        for error, count in r["errors"].items():
+            print(f"  {name}: {count}x {error}")
+
+    print(f"\nbot api calls: {dict(telegram.CALLS)}")
+
+    if bot != None:
+        print(f"bot log: {os.path.join(config_dir, 'bot.log')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Replay of recorded updates (see bot.core.recorder) for A/B benchmarks on real traffic.
+
+Updates are fed to the bot in process, each in its own thread, at the recorded pace
+(--speed 1), N times faster (--speed N) or as fast as possible (--speed 0). The rate
+limits and the scheduler of bot.core.ingress are bypassed. The telegram bot api and the
+upstream apis are the local stand-ins of tools/loadtest.py and the bot starts with an
+empty database in a temporary directory. Reports the processing time of the updates
+(p50/p95/p99) overall and per command.
+
+Usage:
+    python -m tools.replay /config/recordings --speed 10
+    python -m tools.replay updates-20240101-120000.000.jsonl.gz --speed 0 --json before.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import logging
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from tools.stubs import telegram, gov_sg, catgpt
+from tools.loadtest import serve, bot_environment, percentile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="recording files or directories")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed, 0 for as fast as possible")
+    parser.add_argument("--limit", type=int, help="maximum number of updates")
+    parser.add_argument("--json", help="write the results to a json file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--gov-sg-port", type=int, default=8082)
+    parser.add_argument("--catgpt-port", type=int, default=8090)
+    parser.add_argument("--telegram-latency", type=float, default=telegram.CONFIG["latency"], help="bot api response time (s)")
+    parser.add_argument("--gov-sg-latency", type=float, default=gov_sg.CONFIG["latency"], help="data.gov.sg response time (s)")
+    parser.add_argument("--catgpt-latency", type=float, default=catgpt.CONFIG["latency"], help="cat-gpt response time (s)")
+    opts = parser.parse_args()
+    opts.bot_port = 0
+
+    random.seed(opts.seed)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').disabled = True
+
+    telegram.CONFIG.update(latency=opts.telegram_latency, jitter=opts.telegram_latency / 2)
+    gov_sg.CONFIG.update(latency=opts.gov_sg_latency, jitter=opts.gov_sg_latency / 2)
+    catgpt.CONFIG.update(latency=opts.catgpt_latency, jitter=opts.catgpt_latency / 2, words=20)
+
+    serve(telegram.flask, opts.telegram_port)
+    serve(gov_sg.flask, opts.gov_sg_port)
+    serve(catgpt.flask, opts.catgpt_port)
+
+    # The bot reads its configuration at import
+    os.environ.update(bot_environment(opts, tempfile.mkdtemp(prefix="replay-")), BOT_RECORD="0")
+
+    import bot.core.database as db
+    import bot.core.server as server
+    from bot.core import metrics, recorder
+    from bot.core.objects import LazyUpdate
+    from bot.modules import StartModule, WeatherModule, ShortcutsModule, ScShow, CatGPTModule
+
+    db.setup()
+    server.setup([StartModule, WeatherModule, ShortcutsModule, ScShow, CatGPTModule])
+
+    updates = list(recorder.read(opts.paths))[:opts.limit]
+
+    if updates == []:
+        parser.error("no updates recorded")
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def process(raw):
+        start = time.perf_counter()
+
+        try:
+            tg_update = LazyUpdate(raw)
+            metrics.UPDATES_IN_FLIGHT.labels().inc()
+            server.request_callback(tg_update)
+
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+            return
+
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    print(f"Replaying {len(updates)} updates at {'max' if opts.speed <= 0 else f'{opts.speed}x'} speed")
+
+    threads = []
+    first = updates[0][0]
+    start = time.perf_counter()
+
+    for received, raw in updates:
+        if opts.speed > 0:
+            delay = start + (received - first) / opts.speed - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+
+        t = threading.Thread(target=process, args=(raw,))
+        t.start()
+        threads.append(t)
+
+    [t.join() for t in threads]
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "updates": len(updates),
+        "errors": len(errors),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.5) if latencies != [] else None,
+        "p95": percentile(latencies, 0.95) if latencies != [] else None,
+        "p99": percentile(latencies, 0.99) if latencies != [] else None,
+        "commands": {},
+        "bot_api_calls": dict(telegram.CALLS),
+    }
+
+    for (update_type, hook, subcommand), h in metrics.UPDATE_DURATION.items():
+        count = sum(h.counts)
+        results["commands"][" ".join(filter(None, (update_type, hook, subcommand)))] = {"count": count, "mean": h.sum / count}
+
+    print(f"\nprocessed {len(latencies)}/{len(updates)} in {elapsed:.1f}s, throughput {results['throughput']:.1f}/s")
+
+    if latencies != []:
+        print("p50 {:.0f}ms p95 {:.0f}ms p99 {:.0f}ms".format(*(results[p] * 1000 for p in ("p50", "p95", "p99"))))
+
+    print(f"\n{'command':<40}{'n':>6}{'mean':>9}")
+    for name, r in sorted(results["commands"].items(), key=lambda x: -x[1]["count"]):
+        print(f"{name:<40}{r['count']:>6}{r['mean'] * 1000:>7.0f}ms")
+
+    for e in sorted(set(errors)):
+        print(f"  {errors.count(e)}x {e}")
+
+    if opts.json != None:
+        with open(opts.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Local stand-in for the cat-gpt.com conversation api, for offline load tests.
+
+Usage:
+    python -m tools.stubs.catgpt --port 8090 --latency 2 --jitter 1 --error-rate 0.05
+
+    BOT_CATGPT_API_URL=http://127.0.0.1:8090 python main.py
+"""
+
+import time
+import random
+import argparse
+import logging
+
+from flask import Flask, request, jsonify
+
+flask = Flask(__name__)
+
+CONFIG = {
+    "latency": 1.0,
+    "jitter": 0.5,
+    "error_rate": 0.0,
+    "words": 40
+}
+
+
+@flask.route('/api/conversation', methods=['PUT'])
+def conversation():
+    """Answer after a random delay, fails with 503 (with Retry-After) at error_rate"""
+
+    if request.headers.get("Authorization") == None:
+        return jsonify({"error": "unauthorized"}), 401
+
+    time.sleep(max(0, CONFIG["latency"] + random.uniform(-CONFIG["jitter"], CONFIG["jitter"])))
+
+    if random.random() < CONFIG["error_rate"]:
+        return jsonify({"error": "unavailable"}), 503, {"Retry-After": "1"}
+
+    content = " ".join(random.choice(("meow", "purr", "hiss", "human", "now")) for _ in range(CONFIG["words"]))
+    return jsonify({"data": {"message": {"content": content}}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=CONFIG["latency"], help="mean response time (s)")
+    parser.add_argument("--jitter", type=float, default=CONFIG["jitter"], help="uniform jitter (s)")
+    parser.add_argument("--error-rate", type=float, default=CONFIG["error_rate"], help="fraction of 503 responses")
+    parser.add_argument("--words", type=int, default=CONFIG["words"], help="words per reply")
+    args = parser.parse_args()
+
+    CONFIG.update(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, words=args.words)
+
+    logging.getLogger('werkzeug').disabled = True
+    flask.run(args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Local stand-in for the data.gov.sg weather apis and the weather.gov.sg rain area images,
+for offline load tests. Forecasts are synthetic, update_timestamp changes every
+--update-interval seconds like the real api.
+
+Usage:
+    python -m tools.stubs.gov_sg --port 8082 --latency 0.2
+
+    BOT_GOV_SG_API_URL=http://127.0.0.1:8082 BOT_GOV_SG_RAINMAP_URL=http://127.0.0.1:8082 python main.py
+"""
+
+import io
+import time
+import random
+import datetime
+import functools
+import argparse
+import logging
+
+from flask import Flask, Response, jsonify
+from PIL import Image, ImageDraw
+
+flask = Flask(__name__)
+
+CONFIG = {
+    "latency": 0.2,
+    "jitter": 0.1,
+    "update_interval": 60,
+}
+
+AREAS = {
+    "Ang Mo Kio": (1.375, 103.839),
+    "Bedok": (1.321, 103.924),
+    "Bishan": (1.350648, 103.839),
+    "Bukit Timah": (1.3294, 103.8021),
+    "Changi": (1.357, 103.987),
+    "Clementi": (1.315, 103.76),
+    "Jurong West": (1.34039, 103.705),
+    "Pasir Ris": (1.37, 103.949),
+    "Queenstown": (1.291, 103.7872),
+    "Tampines": (1.345, 103.9437),
+    "Toa Payoh": (1.334304, 103.856327),
+    "Woodlands": (1.4382, 103.7890),
+    "Yishun": (1.4304, 103.8354),
+}
+
+FORECASTS = ("Fair", "Partly Cloudy (Day)", "Cloudy", "Light Rain", "Showers", "Thundery Showers")
+
+SGT = datetime.timezone(datetime.timedelta(hours=8))
+
+
+def _delay():
+    time.sleep(max(0, CONFIG["latency"] + random.uniform(-CONFIG["jitter"], CONFIG["jitter"])))
+
+
+def _update_time() -> datetime.datetime:
+    now = time.time()
+    return datetime.datetime.fromtimestamp(now - now % CONFIG["update_interval"], SGT).replace(microsecond=0)
+
+
+@flask.route('/v1/environment/2-hour-weather-forecast')
+def forecast_2h():
+    _delay()
+    updated = _update_time()
+
+    return jsonify({
+        "area_metadata": [
+            {"name": name, "label_location": {"latitude": lat, "longitude": long}} for name, (lat, long) in AREAS.items()
+        ],
+        "items": [{
+            "update_timestamp": updated.isoformat(),
+            "timestamp": updated.isoformat(),
+            "valid_period": {"start": updated.isoformat(), "end": (updated + datetime.timedelta(hours=2)).isoformat()},
+            "forecasts": [{"area": name, "forecast": random.choice(FORECASTS)} for name in AREAS],
+        }],
+        "api_info": {"status": "healthy"},
+    })
+
+
+@flask.route('/v1/environment/24-hour-weather-forecast')
+def forecast_24h():
+    _delay()
+    updated = _update_time()
+
+    periods = [
+        {
+            "time": {
+                "start": (updated + datetime.timedelta(hours=6 * i)).isoformat(),
+                "end": (updated + datetime.timedelta(hours=6 * (i + 1))).isoformat(),
+            },
+            "regions": {r: random.choice(FORECASTS) for r in ("west", "east", "central", "south", "north")},
+        }
+        for i in range(3)
+    ]
+
+    return jsonify({"items": [{"update_timestamp": updated.isoformat(), "timestamp": updated.isoformat(), "periods": periods}]})
+
+
+@flask.route('/v1/environment/4-day-weather-forecast')
+def forecast_4d():
+    _delay()
+    updated = _update_time()
+
+    forecasts = [
+        {
+            "date": (updated + datetime.timedelta(days=i + 1)).isoformat(),
+            "forecast": random.choice(FORECASTS),
+            "temperature": {"low": 24, "high": 33},
+            "relative_humidity": {"low": 55, "high": 95},
+            "wind": {"speed": {"low": 10, "high": 20}, "direction": "NE"},
+        }
+        for i in range(4)
+    ]
+
+    return jsonify({"items": [{"update_timestamp": updated.isoformat(), "timestamp": updated.isoformat(), "forecasts": forecasts}]})
+
+
+@functools.lru_cache(maxsize=64)
+def _png(size: tuple[int, int], color: tuple, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    image = Image.new("RGBA", size, color)
+    draw = ImageDraw.Draw(image)
+
+    for _ in range(20):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse((x, y, x + 40, y + 40), fill=(0, 120, 255, 160))
+
+    out = io.BytesIO()
+    image.save(out, "PNG")
+    return out.getvalue()
+
+
+_STATIC = {
+    "wp-content/themes/wiptheme/assets/img/base-853.png": _png((853, 479), (230, 230, 230, 255), 1),
+    "wp-content/themes/wiptheme/images/SG-Township.png": _png((853, 479), (0, 0, 0, 0), 2),
+}
+
+
+@flask.route('/<path:path>.png')
+def image(path):
+    _delay()
+
+    if path + ".png" in _STATIC:
+        return Response(_STATIC[path + ".png"], mimetype="image/png")
+
+    if path.startswith("files/rainarea/"):
+        return Response(_png((853, 479), (0, 0, 0, 0), hash(path)), mimetype="image/png")
+
+    return "", 404
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=CONFIG["latency"], help="mean response time (s)")
+    parser.add_argument("--jitter", type=float, default=CONFIG["jitter"], help="uniform jitter (s)")
+    parser.add_argument("--update-interval", type=int, default=CONFIG["update_interval"], help="forecast update interval (s)")
+    args = parser.parse_args()
+
+    CONFIG.update(latency=args.latency, jitter=args.jitter, update_interval=args.update_interval)
+
+    logging.getLogger('werkzeug').disabled = True
+    flask.run(args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
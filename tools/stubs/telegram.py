@@ -0,0 +1,139 @@
+"""
+Local stand-in for the telegram bot api, for offline load tests.
+
+Every call is acknowledged with a plausible result (a Message for send* / edit* methods)
+after a random delay, and recorded. A fraction of the calls can be rejected with 429.
+
+Usage:
+    python -m tools.stubs.telegram --port 8081 --latency 0.05 --rate-limit 0.01
+
+    BOT_TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+"""
+
+import time
+import random
+import argparse
+import threading
+import itertools
+import collections
+import logging
+
+from flask import Flask, request, jsonify
+
+flask = Flask(__name__)
+
+CONFIG = {
+    "latency": 0.05,
+    "jitter": 0.02,
+    "rate_limit": 0.0,
+    "retry_after": 1,
+}
+
+# method -> number of calls, "429" -> number of rejected calls
+CALLS = collections.Counter()
+_LOCK = threading.Lock()
+_MESSAGE_IDS = itertools.count(1)
+
+# Called with (method, params, time) for every acknowledged call, set by tools.loadtest
+on_call = None
+
+
+def _params() -> dict:
+    params = dict(request.args)
+    params.update(request.form)
+    params.update(request.get_json(silent=True) or {})
+
+    return params
+
+
+def _message(params: dict) -> dict:
+    chat_id = params.get("chat_id", 0)
+    msg = {
+        "message_id": int(params.get("message_id", next(_MESSAGE_IDS))),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+    }
+
+    if "text" in params:
+        msg["text"] = params["text"]
+
+    if "caption" in params:
+        msg["caption"] = params["caption"]
+
+    if "photo" in params or "photo" in request.files:
+        msg["photo"] = [{"file_id": "photo", "file_unique_id": "photo", "width": 853, "height": 479}]
+
+    if "animation" in params:
+        msg["animation"] = {"file_id": f"gif{msg['message_id']}", "file_unique_id": f"gif{msg['message_id']}",
+                            "width": 320, "height": 240, "duration": 3}
+
+    return msg
+
+
+_RESULTS = {
+    "getMe": lambda p: {"id": 1, "is_bot": True, "first_name": "Load Test", "username": "loadtest_bot"},
+    "getWebhookInfo": lambda p: {"url": "", "has_custom_certificate": False, "pending_update_count": 0},
+    "getMyCommands": lambda p: [],
+}
+
+
+@flask.route('/bot<token>/<method>', methods=['GET', 'POST'])
+def bot_api(token, method):
+    """Acknowledge a bot api call"""
+
+    time.sleep(max(0, CONFIG["latency"] + random.uniform(-CONFIG["jitter"], CONFIG["jitter"])))
+
+    if random.random() < CONFIG["rate_limit"]:
+        with _LOCK:
+            CALLS["429"] += 1
+
+        return jsonify({
+            "ok": False, "error_code": 429,
+            "description": f"Too Many Requests: retry after {CONFIG['retry_after']}",
+            "parameters": {"retry_after": CONFIG["retry_after"]}
+        }), 429
+
+    params = _params()
+
+    with _LOCK:
+        CALLS[method] += 1
+
+    if on_call != None:
+        on_call(method, params, time.perf_counter())
+
+    if method in _RESULTS:
+        result = _RESULTS[method](params)
+    elif method.startswith("send") and method != "sendChatAction" or method.startswith("edit"):
+        result = _message(params)
+    else:
+        result = True
+
+    return jsonify({"ok": True, "result": result})
+
+
+@flask.route('/stats', methods=['GET'])
+def stats():
+    """Number of calls per method"""
+
+    with _LOCK:
+        return jsonify(dict(CALLS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=CONFIG["latency"], help="mean response time (s)")
+    parser.add_argument("--jitter", type=float, default=CONFIG["jitter"], help="uniform jitter (s)")
+    parser.add_argument("--rate-limit", type=float, default=CONFIG["rate_limit"], help="fraction of 429 responses")
+    parser.add_argument("--retry-after", type=int, default=CONFIG["retry_after"], help="retry_after of 429 responses (s)")
+    args = parser.parse_args()
+
+    CONFIG.update(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit, retry_after=args.retry_after)
+
+    logging.getLogger('werkzeug').disabled = True
+    flask.run(args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()